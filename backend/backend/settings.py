@@ -11,7 +11,9 @@ https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
 from pathlib import Path
+import multiprocessing
 import os
+import tempfile
 from dotenv import load_dotenv
 from datetime import timedelta
 
@@ -51,6 +53,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "vault.middleware.RequestIdMiddleware",
+    "vault.middleware.MetricsMiddleware",
+    "vault.middleware.CompressionMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -59,6 +64,7 @@ MIDDLEWARE = [
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
     "corsheaders.middleware.CorsMiddleware",
+    "vault.middleware.DatabaseConnectionMiddleware",
 ]
 
 ROOT_URLCONF = "backend.urls"
@@ -85,21 +91,54 @@ WSGI_APPLICATION = "backend.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
 
+# Connections are kept open for VAULT_DB_CONN_MAX_AGE seconds and checked
+# before reuse. Under ASGI the ORM may run on a new thread per request, so
+# persistent connections are off by default there; use PgBouncer instead.
+# The vault.db backends are Django's, timing how long requests wait for their
+# connection (vault_db_connection_seconds, Server-Timing).
 DATABASES = {
     "default": {
-        "ENGINE": "django.db.backends.postgresql",
+        "ENGINE": "vault.db.postgresql",
         "NAME": os.getenv("POSTGRES_DB"),
         "USER": os.getenv("POSTGRES_USER"),
         "PASSWORD": os.getenv("POSTGRES_PASSWORD"),
-        "HOST": "db",
-        "PORT": "5432",
+        "HOST": os.getenv("POSTGRES_HOST", "db"),
+        "PORT": os.getenv("POSTGRES_PORT", "5432"),
+        "CONN_MAX_AGE": int(
+            os.getenv(
+                "VAULT_DB_CONN_MAX_AGE",
+                0 if os.getenv("VAULT_SERVER") == "asgi" else 60,
+            )
+        ),
+        "CONN_HEALTH_CHECKS": True,
     }
 }
 
+# VAULT_DB=sqlite uses a SQLite file instead, e.g. to run the benchmarks
+# (manage.py benchmark_suite) without a Postgres server.
+if os.getenv("VAULT_DB") == "sqlite":
+    DATABASES["default"] = {
+        "ENGINE": "vault.db.sqlite3",
+        "NAME": os.getenv("VAULT_SQLITE_PATH", BASE_DIR / "db.sqlite3"),
+        "CONN_MAX_AGE": DATABASES["default"]["CONN_MAX_AGE"],
+        "CONN_HEALTH_CHECKS": True,
+    }
+    # The early vault migrations only run on Postgres; create the tables from
+    # the models instead, with manage.py migrate --run-syncdb.
+    MIGRATION_MODULES = {"vault": None}
+
+# PgBouncer in transaction pooling mode may hand each transaction a different
+# server connection, so server-side cursors (and psycopg server-side binding,
+# which Django leaves off by default) cannot be used.
+if os.getenv("VAULT_DB_PGBOUNCER") == "1":
+    DATABASES["default"]["DISABLE_SERVER_SIDE_CURSORS"] = True
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
+AUTHENTICATION_BACKENDS = ["vault.backends.HashingModelBackend"]
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         "NAME": "django.contrib.auth.password_validation.UserAttributeSimilarityValidator",
@@ -141,25 +180,127 @@ STATIC_URL = "/static/"
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
+# JSON lines with the request id, written by a background thread per process
+# so request threads never wait on the log disk (see vault/logs.py). All
+# processes append to VAULT_LOG_FILE, rotated at VAULT_LOG_MAX_BYTES.
 LOGGING = {
     "version": 1,
     "disable_existing_loggers": False,
-    "handlers": {
-        "console": {
-            "class": "logging.StreamHandler",
+    "filters": {
+        "request_id": {
+            "()": "vault.logs.RequestIdFilter",
         },
-        "file": {
-            "level": "INFO",
-            "class": "logging.FileHandler",
-            "filename": "vault.log",
+    },
+    "handlers": {
+        "queue": {
+            "()": "vault.logs.QueueHandler",
+            "filename": os.getenv("VAULT_LOG_FILE", "vault.log"),
+            "max_bytes": int(os.getenv("VAULT_LOG_MAX_BYTES", 10 * 1024 * 1024)),
+            "backup_count": int(os.getenv("VAULT_LOG_BACKUP_COUNT", 5)),
+            "filters": ["request_id"],
         },
     },
     "root": {
-        "handlers": ["console", "file"],
+        "handlers": ["queue"],
         "level": "INFO",
     },
 }
 
+# Encrypted attachments
+VAULT_MAX_FILE_SIZE = int(os.getenv("VAULT_MAX_FILE_SIZE", 5 * 1024 * 1024))
+# Largest body accepted by a single resumable upload request
+VAULT_UPLOAD_CHUNK_SIZE = int(os.getenv("VAULT_UPLOAD_CHUNK_SIZE", 1024 * 1024))
+# Resumable uploads not completed within VAULT_UPLOAD_TTL seconds are
+# abandoned; ./manage.py expire_uploads deletes them (run it from cron). A
+# user may have at most VAULT_MAX_OPEN_UPLOADS unfinished uploads at a time.
+VAULT_UPLOAD_TTL = int(os.getenv("VAULT_UPLOAD_TTL", 24 * 60 * 60))
+VAULT_MAX_OPEN_UPLOADS = int(os.getenv("VAULT_MAX_OPEN_UPLOADS", 5))
+
+# Vault and file responses of at least VAULT_COMPRESS_MIN_SIZE bytes are
+# compressed for clients that accept it (vault.middleware.CompressionMiddleware).
+# vault/add-batch, vault/edit-batch and vault/files/add take compressed
+# bodies, up to VAULT_MAX_DECOMPRESSED_SIZE bytes once decompressed: room for
+# a VAULT_MAX_FILE_SIZE file in legacy byte objects.
+VAULT_COMPRESS_MIN_SIZE = int(os.getenv("VAULT_COMPRESS_MIN_SIZE", 1024))
+VAULT_MAX_DECOMPRESSED_SIZE = int(
+    os.getenv("VAULT_MAX_DECOMPRESSED_SIZE", 16 * VAULT_MAX_FILE_SIZE)
+)
+
+# Rows written per INSERT/UPDATE statement by the batch endpoints
+VAULT_BATCH_CHUNK_SIZE = int(os.getenv("VAULT_BATCH_CHUNK_SIZE", 500))
+
+# Largest page of vault/retrieve?limit=, and entries fetched per query when
+# vault/retrieve streams NDJSON
+VAULT_RETRIEVE_PAGE_SIZE = int(os.getenv("VAULT_RETRIEVE_PAGE_SIZE", 1000))
+
+# Where attachment ciphertext lives. None keeps it in the fileEntry table;
+# existing rows can be moved out with ./manage.py migrate_blobs.
+VAULT_BLOB_STORAGE = None
+if os.getenv("VAULT_BLOB_BACKEND") == "filesystem":
+    VAULT_BLOB_STORAGE = {
+        "BACKEND": "vault.storage.FileSystemStorage",
+        "OPTIONS": {"location": os.getenv("VAULT_BLOB_LOCATION", BASE_DIR / "blobs")},
+    }
+elif os.getenv("VAULT_BLOB_BACKEND") == "s3":
+    VAULT_BLOB_STORAGE = {
+        "BACKEND": "vault.storage.S3Storage",
+        "OPTIONS": {
+            "bucket": os.getenv("VAULT_BLOB_BUCKET"),
+            "prefix": os.getenv("VAULT_BLOB_PREFIX", ""),
+            "endpoint_url": os.getenv("VAULT_BLOB_ENDPOINT_URL"),
+            "region_name": os.getenv("VAULT_BLOB_REGION"),
+            "access_key": os.getenv("VAULT_BLOB_ACCESS_KEY"),
+            "secret_key": os.getenv("VAULT_BLOB_SECRET_KEY"),
+        },
+    }
+
+# Password hashing runs in VAULT_HASH_WORKERS processes per server process
+# (0 hashes in the request thread). At most VAULT_HASH_CONCURRENCY hashes run
+# at once across the host; further logins get a 503. See vault/hashing.py.
+VAULT_HASH_WORKERS = int(os.getenv("VAULT_HASH_WORKERS", 1))
+VAULT_HASH_CONCURRENCY = int(
+    os.getenv("VAULT_HASH_CONCURRENCY", multiprocessing.cpu_count())
+)
+VAULT_HASH_SLOT_DIR = os.getenv(
+    "VAULT_HASH_SLOT_DIR", os.path.join(tempfile.gettempdir(), "vault-hash-slots")
+)
+
+# Adds a Server-Timing header with the time spent acquiring a database
+# connection for the request.
+VAULT_SERVER_TIMING = os.getenv("VAULT_SERVER_TIMING", str(DEBUG)) in ("1", "True")
+
+# Under ASGI (VAULT_SERVER=asgi, see gunicorn_config.py) vault/retrieve,
+# vault/sync and file downloads are served by the async views.
+VAULT_ASYNC_VIEWS = os.getenv("VAULT_SERVER") == "asgi"
+
+# Request metrics, served in Prometheus format on /metrics. Server processes
+# share them through VAULT_METRICS_DIR, which gunicorn_config.py sets up;
+# without it /metrics only covers the process that answers. Scrapes must send
+# VAULT_METRICS_TOKEN as a bearer token; without a token /metrics answers 403,
+# unless VAULT_METRICS_PUBLIC=1 opens it to anyone who can reach it.
+VAULT_METRICS_DIR = os.getenv("VAULT_METRICS_DIR")
+VAULT_METRICS_TOKEN = os.getenv("VAULT_METRICS_TOKEN")
+VAULT_METRICS_PUBLIC = os.getenv("VAULT_METRICS_PUBLIC") == "1"
+# How long a user's vault size bucket is reused before it is counted again
+VAULT_METRICS_SIZE_TTL = int(os.getenv("VAULT_METRICS_SIZE_TTL", 300))
+
+# Where rate limit counters live (see vault/throttling.py). The default
+# counts in each server process; with VAULT_THROTTLE_REDIS_URL every process
+# on every host shares them.
+VAULT_THROTTLE_STORE = {"BACKEND": "vault.throttling.LocalStore"}
+if os.getenv("VAULT_THROTTLE_REDIS_URL"):
+    VAULT_THROTTLE_STORE = {
+        "BACKEND": "vault.throttling.RedisStore",
+        "OPTIONS": {"url": os.getenv("VAULT_THROTTLE_REDIS_URL")},
+    }
+# Scopes counted in VAULT_THROTTLE_SHARED_STORE, which every process shares
+# (the database unless Redis is configured), and refused rather than allowed
+# while it is unreachable: recovery secrets have no second factor behind them.
+VAULT_THROTTLE_FAIL_CLOSED = ["recovery-account"]
+VAULT_THROTTLE_SHARED_STORE = {"BACKEND": "vault.throttling.DatabaseStore"}
+if os.getenv("VAULT_THROTTLE_REDIS_URL"):
+    VAULT_THROTTLE_SHARED_STORE = VAULT_THROTTLE_STORE
+
 CORS_ORIGIN_ALLOW_ALL = True
 
 CORS_ALLOWED_ORIGINS = ["http://localhost:5173"]
@@ -168,11 +309,33 @@ REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": [
         "rest_framework_simplejwt.authentication.JWTAuthentication",
     ],
+    # orjson-backed; they fall back to the stdlib json module if orjson is
+    # not installed.
+    "DEFAULT_RENDERER_CLASSES": [
+        "vault.renderers.ORJSONRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ],
+    "DEFAULT_PARSER_CLASSES": [
+        "vault.renderers.ORJSONParser",
+        "rest_framework.parsers.FormParser",
+        "rest_framework.parsers.MultiPartParser",
+    ],
     "DEFAULT_THROTTLE_CLASSES": [
-        "rest_framework.throttling.ScopedRateThrottle",
+        "vault.throttling.SlidingWindowThrottle",
     ],
-    # TODO 3/hour
-    "DEFAULT_THROTTLE_RATES": {"strict": "5000/hour"},
+    # Proxies in front of the server that append to X-Forwarded-For. With
+    # none (the default, gunicorn serving clients directly) clients are
+    # counted by REMOTE_ADDR, as they can send any X-Forwarded-For.
+    "NUM_PROXIES": int(os.getenv("VAULT_NUM_PROXIES", 0)),
+    # Per client address, except recovery-account, which counts recovery
+    # secret attempts per account
+    "DEFAULT_THROTTLE_RATES": {
+        # TODO 3/hour
+        "strict": "5000/hour",
+        "login": os.getenv("VAULT_LOGIN_RATE", "30/minute"),
+        "register": os.getenv("VAULT_REGISTER_RATE", "20/hour"),
+        "recovery-account": "3/hour",
+    },
 }
 
 SIMPLE_JWT = {
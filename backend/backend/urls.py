@@ -16,8 +16,10 @@ Including another URLconf
 
 from django.contrib import admin
 from django.urls import path, include
+from vault.views import Metrics
 
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("api/", include("vault.urls")),
+    path("metrics", Metrics.as_view(), name="metrics"),
 ]
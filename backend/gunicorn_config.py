@@ -1,4 +1,59 @@
 import multiprocessing
+import os
+import shutil
+import tempfile
 
 bind = "0.0.0.0:8000"
-workers = multiprocessing.cpu_count() * 2 + 1
+
+# VAULT_SERVER=asgi serves the ASGI application with uvicorn workers, each of
+# which keeps handling requests while slow clients drain long responses.
+if os.getenv("VAULT_SERVER") == "asgi":
+    wsgi_app = "backend.asgi:application"
+    worker_class = "uvicorn_worker.UvicornWorker"
+    workers = int(os.getenv("GUNICORN_WORKERS", multiprocessing.cpu_count() + 1))
+else:
+    wsgi_app = "backend.wsgi:application"
+    workers = int(os.getenv("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+
+# Workers write their metrics here for /metrics to add up; a new directory
+# per server start, so counters of a previous run are not carried over, and
+# removed when the server stops.
+metrics_dir = os.getenv("VAULT_METRICS_DIR")
+created_metrics_dir = metrics_dir is None
+if created_metrics_dir:
+    metrics_dir = os.environ["VAULT_METRICS_DIR"] = tempfile.mkdtemp(
+        prefix="vault-metrics-"
+    )
+
+
+# Writes what the worker counted since its last snapshot
+def worker_exit(server, worker):
+    from vault import metrics
+
+    metrics.write_snapshot(metrics_dir)
+
+
+# Merges an exited worker's metrics into those of earlier workers
+def child_exit(server, worker):
+    from vault import metrics
+
+    try:
+        metrics.compact(metrics_dir, worker.pid)
+    except Exception as e:
+        server.log.error(f"Failed to compact metrics of worker {worker.pid}: {e}")
+
+
+def on_exit(server):
+    if created_metrics_dir:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+# Rate limits other than VAULT_THROTTLE_FAIL_CLOSED scopes are only shared
+# between workers through Redis
+def when_ready(server):
+    if workers > 1 and not os.getenv("VAULT_THROTTLE_REDIS_URL"):
+        server.log.warning(
+            "Login and registration rate limits are counted per worker "
+            "(%d workers); set VAULT_THROTTLE_REDIS_URL to share them",
+            workers,
+        )
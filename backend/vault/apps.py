@@ -4,3 +4,13 @@ from django.apps import AppConfig
 class VaultConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'vault'
+
+    # Builds the configured blob storage and rate limit store, so a missing
+    # dependency or bad option stops the server at startup
+    def ready(self):
+        from vault.storage import get_storage
+        from vault.throttling import get_store
+
+        get_storage()
+        get_store()
+        get_store("VAULT_THROTTLE_SHARED_STORE")
@@ -0,0 +1,208 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from django.views import View
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework_simplejwt.exceptions import InvalidToken
+from vault import models
+from vault.authentication import StatelessJWTAuthentication
+from vault.renderers import NDJSONRenderer, ORJSONRenderer, RenderTimer
+from vault.views import (
+    ByteEncoding,
+    CacheHeaders,
+    EntryPage,
+    NotModified,
+    ParsePage,
+    RangeNotSatisfiable,
+    RetrieveETag,
+    SerializeChanges,
+    SerializeEntry,
+    StreamFile,
+    StreamRequested,
+    SyncChanges,
+    VaultEntries,
+)
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Async counterparts of VaultRetrieve, VaultSync and FileDownload, routed
+# instead of them when VAULT_ASYNC_VIEWS is set (see urls.py). Under ASGI a
+# slow client draining a large response then holds a coroutine rather than
+# a whole worker. DRF views are sync only, so these are plain Django views
+# that authenticate the bearer token themselves and reuse the querysets and
+# serializers of the sync views.
+def JsonResponse(data, status=200):
+    render = RenderTimer(ORJSONRenderer().render)
+    response = HttpResponse(
+        render(data), status=status, content_type="application/json"
+    )
+    response.render_timer = render
+    return response
+
+
+class AsyncAPIView(View):
+    authentication = StatelessJWTAuthentication()
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            request.user = await self.authenticate(request)
+        except (AuthenticationFailed, InvalidToken) as e:
+            return self.unauthorized(request, e.detail)
+        if request.user is None:
+            return self.unauthorized(
+                request, "Authentication credentials were not provided."
+            )
+        return await super().dispatch(request, *args, **kwargs)
+
+    # Same body and header as DRF's NotAuthenticated/AuthenticationFailed
+    def unauthorized(self, request, detail):
+        response = JsonResponse(
+            detail if isinstance(detail, dict) else {"detail": detail}, status=401
+        )
+        response["WWW-Authenticate"] = self.authentication.authenticate_header(request)
+        return response
+
+    # No database access: request.user is a LazyUser
+    async def authenticate(self, request):
+        header = self.authentication.get_header(request)
+        if header is None:
+            return None
+        raw_token = self.authentication.get_raw_token(header)
+        if raw_token is None:
+            return None
+        token = self.authentication.get_validated_token(raw_token)
+        return self.authentication.get_user(token)
+
+
+async def CurrentRevision(user):
+    revision = await (
+        models.VaultRevision.objects.filter(user_id=user.id)
+        .values_list("revision", flat=True)
+        .afirst()
+    )
+    return revision or 0
+
+
+class AsyncVaultRetrieve(AsyncAPIView):
+    async def get(self, request):
+        try:
+            after, limit = ParsePage(request)
+        except ValueError:
+            return JsonResponse({"message": "Invalid cursor"}, status=400)
+        try:
+            encoding = ByteEncoding(request)
+            stream = StreamRequested(request)
+            revision = await CurrentRevision(request.user)
+            etag = RetrieveETag(request.user, revision, encoding, stream, after, limit)
+            if NotModified(request, etag):
+                response = HttpResponse(status=304)
+            elif stream:
+                render = RenderTimer(NDJSONRenderer().render)
+                response = StreamingHttpResponse(
+                    AsyncStreamEntries(request.user, encoding, render, after),
+                    content_type=NDJSONRenderer.media_type,
+                )
+                response.render_timer = render
+            elif limit is not None:
+                entries = [
+                    entry async for entry in EntryPage(request.user, after, limit)
+                ]
+                response = JsonResponse(
+                    {
+                        "entries": [
+                            SerializeEntry(entry, encoding) for entry in entries
+                        ],
+                        "next": entries[-1].id if len(entries) == limit else None,
+                    }
+                )
+            else:
+                response = JsonResponse(
+                    [
+                        SerializeEntry(entry, encoding)
+                        async for entry in VaultEntries(request.user)
+                    ]
+                )
+            response["X-Vault-Revision"] = revision
+            patch_vary_headers(response, ["Accept"])
+            return CacheHeaders(response, etag)
+        except Exception as e:
+            return JsonResponse({"message": "Failed to retrieve entries"}, status=400)
+
+
+# StreamEntries with the pages fetched by the async ORM
+async def AsyncStreamEntries(user, encoding, render, after=0):
+    size = settings.VAULT_RETRIEVE_PAGE_SIZE
+    while True:
+        entries = [entry async for entry in EntryPage(user, after, size)]
+        for entry in entries:
+            yield render(SerializeEntry(entry, encoding))
+            # Prefetched files point back at their entry. Breaking the cycle
+            # lets each page be freed as soon as it is sent instead of by
+            # the next full garbage collection.
+            entry._prefetched_objects_cache.clear()
+        if len(entries) < size:
+            return
+        after = entries[-1].id
+
+
+class AsyncVaultSync(AsyncAPIView):
+    async def get(self, request):
+        try:
+            since = int(request.GET.get("since", 0))
+        except ValueError:
+            return JsonResponse({"message": "Invalid cursor"}, status=400)
+        try:
+            encoding = ByteEncoding(request)
+            revision = await CurrentRevision(request.user)
+            entries, files, tombstones = SyncChanges(request.user, since)
+            response = JsonResponse(
+                SerializeChanges(
+                    revision,
+                    [entry async for entry in entries],
+                    [file async for file in files],
+                    [tombstone async for tombstone in tombstones],
+                    encoding,
+                )
+            )
+            patch_vary_headers(response, ["Accept"])
+            return response
+        except Exception as e:
+            logger.error(f"Sync failed: {str(e)}")
+            return JsonResponse({"message": "Failed to sync entries"}, status=400)
+
+
+# Chunks of blobs in external storage are read off the event loop; inline
+# files are already in memory.
+async def AsyncChunks(chunks):
+    iterator = iter(chunks)
+    while True:
+        chunk = await sync_to_async(next, thread_sensitive=False)(iterator, None)
+        if chunk is None:
+            break
+        yield chunk
+
+
+async def MemoryChunks(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+class AsyncFileDownload(AsyncAPIView):
+    async def get(self, request, id):
+        try:
+            file = await models.fileEntry.objects.select_related("VaultEntry").aget(
+                id=id
+            )
+        except models.fileEntry.DoesNotExist:
+            return JsonResponse({"message": "File not found"}, status=404)
+        if file.VaultEntry.user_id != request.user.id:
+            return JsonResponse({"message": "Unauthorized"}, status=401)
+        try:
+            return StreamFile(request, file, AsyncChunks if file.blob else MemoryChunks)
+        except RangeNotSatisfiable:
+            response = JsonResponse({"message": "Range Not Satisfiable"}, status=416)
+            response["Content-Range"] = "bytes */{}".format(file.size)
+            return response
@@ -0,0 +1,29 @@
+from django.contrib.auth import get_user_model
+from django.utils.translation import gettext_lazy as _
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+UserModel = get_user_model()
+
+
+# A User with only its primary key loaded. Its other fields are deferred, so
+# reading one (user.username, user.password) loads it from the database on
+# first access, and saving it only writes the fields that were loaded.
+def LazyUser(user_id):
+    return UserModel.from_db(None, [UserModel._meta.pk.attname], [user_id])
+
+
+# JWTAuthentication without the user lookup: the signed user_id claim is
+# trusted as is and request.user is a LazyUser. The vault endpoints only use
+# the user's id, so this saves a query per request. Unlike JWTAuthentication
+# it does not notice a user deleted or deactivated after the access token was
+# issued; tokens for those expire with ACCESS_TOKEN_LIFETIME, and writes for
+# a deleted user fail on its foreign keys.
+class StatelessJWTAuthentication(JWTAuthentication):
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken(_("Token contained no recognizable user identification"))
+        return LazyUser(user_id)
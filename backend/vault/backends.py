@@ -0,0 +1,36 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from vault import hashing
+
+UserModel = get_user_model()
+
+
+# ModelBackend with the password check run through vault.hashing. The user is
+# loaded together with its 2FA device and recovery secret, which the token
+# serializer checks on every login.
+class HashingModelBackend(ModelBackend):
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        if username is None:
+            username = kwargs.get(UserModel.USERNAME_FIELD)
+        if username is None or password is None:
+            return
+        try:
+            user = (
+                UserModel._default_manager.select_related(
+                    "totpdevice", "recovery_secret"
+                )
+                # Only its existence matters at login
+                .defer(
+                    "recovery_secret__secret_hash",
+                    "recovery_secret__password",
+                    "recovery_secret__iv",
+                ).get(**{UserModel.USERNAME_FIELD: username})
+            )
+        except UserModel.DoesNotExist:
+            # Hash once anyway so unknown usernames take as long as known ones
+            hashing.make_password(password)
+        else:
+            if hashing.check_user_password(
+                user, password
+            ) and self.user_can_authenticate(user):
+                return user
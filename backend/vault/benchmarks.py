@@ -0,0 +1,65 @@
+from django.db import transaction
+from vault import models
+from vault.codec import FromBytes
+import os
+import pyotp
+
+# Synthetic vault data and statistics shared by the benchmark,
+# benchmark_suite and loadtest management commands.
+
+
+def entry_payload(name, encoding="legacy"):
+    return {
+        "name": name,
+        "username": "user@example.com",
+        "password": FromBytes(os.urandom(48), encoding),
+        "iv": FromBytes(os.urandom(12), encoding),
+    }
+
+
+def seed_entries(user_id, count, prefix="entry"):
+    return models.VaultEntry.objects.bulk_create(
+        models.VaultEntry(
+            user_id=user_id,
+            name="{}-{}".format(prefix, i),
+            username="user-{}@example.com".format(i),
+            password=os.urandom(48),
+            iv=os.urandom(12),
+        )
+        for i in range(count)
+    )
+
+
+# `count` files of `size` random bytes on the given entries in turn, stored
+# where uploads are (see fileEntry.write)
+def seed_files(entry_ids, count, size, prefix="file"):
+    files = [
+        models.fileEntry(
+            VaultEntry_id=entry_ids[i % len(entry_ids)],
+            name="{}-{}.zip".format(prefix, i),
+            iv=os.urandom(12),
+        )
+        for i in range(count)
+    ]
+    with transaction.atomic():
+        for file in files:
+            file.write(os.urandom(size))
+        return models.fileEntry.objects.bulk_create(files)
+
+
+# Confirmed 2FA, a recovery secret and a key derivation salt; without the
+# first two a login deletes the account. Returns the TOTP secret.
+def seed_account(user, secret_hash="!"):
+    models.RecoverySecret.objects.create(
+        user=user, secret_hash=secret_hash, password=os.urandom(48), iv=b"0"
+    )
+    models.ClientKeyDerivationSalt.objects.create(user=user)
+    device = models.TOTPDevice.objects.create(
+        user=user, secret=pyotp.random_base32(), confirmed=True
+    )
+    return device.secret
+
+
+# Of sorted values
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
@@ -0,0 +1,41 @@
+import base64
+import itertools
+import operator
+
+# Keys "0".."65535" are kept around so encoding and validating anything up
+# to 64KB does not format a string per byte. Longer inputs format the rest.
+KEY_CACHE_SIZE = 64 * 1024
+_KEYS = [str(i) for i in range(KEY_CACHE_SIZE)]
+
+
+def _keys(n):
+    if n <= KEY_CACHE_SIZE:
+        return itertools.islice(_KEYS, n)
+    return itertools.chain(_KEYS, map(str, range(KEY_CACHE_SIZE, n)))
+
+
+# Accepts base64 strings and the legacy {"0": byte, "1": byte, ...} objects.
+# Clients send legacy objects with keys in order, which is checked in one
+# pass and converted with a single bytes() call; anything else falls back to
+# placing each byte by its index.
+def ToBytes(input):
+    if isinstance(input, str):
+        return base64.b64decode(input, validate=True)
+    if not isinstance(input, dict):
+        raise TypeError("Expected a base64 string or a byte object")
+    n = len(input)
+    if all(map(operator.eq, input, _keys(n))):
+        return bytes(input.values())
+    positions = list(map(int, input))
+    if len(set(positions)) != n or min(positions) < 0 or max(positions) >= n:
+        raise ValueError("Byte object keys must be 0..{}".format(n - 1))
+    output = bytearray(n)
+    for position, byte in zip(positions, input.values()):
+        output[position] = byte
+    return bytes(output)
+
+
+def FromBytes(input, encoding="legacy"):
+    if encoding == "base64":
+        return base64.b64encode(input).decode("ascii")
+    return dict(zip(_keys(len(input)), input))
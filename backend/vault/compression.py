@@ -0,0 +1,133 @@
+from rest_framework.exceptions import APIException
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bytes of a compressed request body read at a time
+READ_SIZE = 64 * 1024
+
+
+class DecompressionError(APIException):
+    status_code = 400
+    default_detail = "Malformed compressed request body."
+    default_code = "malformed_body"
+
+
+class UnsupportedEncoding(DecompressionError):
+    status_code = 415
+    default_detail = "Unsupported Content-Encoding."
+    default_code = "unsupported_encoding"
+
+
+class BodyTooLarge(DecompressionError):
+    status_code = 413
+    default_detail = "Request body too large once decompressed."
+    default_code = "body_too_large"
+
+
+class BrotliCompressor:
+    def __init__(self):
+        self.compressor = brotli.Compressor(quality=4)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.finish()
+
+
+# Response content codings, most preferred first. Each makes an object with
+# compress(data) and flush() like zlib's. Levels favour speed: responses are
+# compressed per request, and these compress vault JSON nearly as well as
+# their slowest levels do. zstd and br need the optional zstandard and
+# brotli packages.
+COMPRESSORS = {}
+if zstandard is not None:
+    COMPRESSORS["zstd"] = lambda: zstandard.ZstdCompressor(level=3).compressobj()
+if brotli is not None:
+    COMPRESSORS["br"] = BrotliCompressor
+COMPRESSORS["gzip"] = lambda: zlib.compressobj(1, zlib.DEFLATED, 31)
+
+
+# The most preferred of COMPRESSORS that an Accept-Encoding header allows,
+# or None. The client's q-values only rule codings in or out.
+def negotiate(header):
+    accepted = {}
+    for item in header.split(","):
+        name, _, params = item.partition(";")
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for name in COMPRESSORS:
+        if accepted.get(name, accepted.get("*", 0)) > 0:
+            return name
+    return None
+
+
+def compressor(encoding):
+    return COMPRESSORS[encoding]()
+
+
+def inflate(stream, limit):
+    decompressor = zlib.decompressobj(31)
+    output = bytearray()
+    try:
+        while not decompressor.eof:
+            data = decompressor.unconsumed_tail or stream.read(READ_SIZE)
+            if not data:
+                raise DecompressionError()
+            output += decompressor.decompress(data, limit + 1 - len(output))
+            if len(output) > limit:
+                raise BodyTooLarge()
+    except zlib.error:
+        raise DecompressionError()
+    return bytes(output)
+
+
+def unzstd(stream, limit):
+    reader = zstandard.ZstdDecompressor().stream_reader(stream)
+    output = bytearray()
+    try:
+        while True:
+            data = reader.read(min(READ_SIZE, limit + 1 - len(output)))
+            if not data:
+                break
+            output += data
+            if len(output) > limit:
+                raise BodyTooLarge()
+    except zstandard.ZstdError:
+        raise DecompressionError()
+    return bytes(output)
+
+
+# Request content codings. Both decompress incrementally, so a small body
+# that expands without end is cut off at the limit instead of exhausting
+# memory.
+DECOMPRESSORS = {"gzip": inflate}
+if zstandard is not None:
+    DECOMPRESSORS["zstd"] = unzstd
+
+
+# Reads a body sent with Content-Encoding `encoding` from `stream` and
+# returns it decompressed. Raises UnsupportedEncoding, BodyTooLarge once it
+# grows past `limit` bytes, or DecompressionError if it is malformed.
+def decompress(stream, encoding, limit):
+    try:
+        function = DECOMPRESSORS[encoding.strip().lower()]
+    except KeyError:
+        raise UnsupportedEncoding()
+    return function(stream, limit)
@@ -0,0 +1,67 @@
+from vault import metrics
+import contextlib
+import contextvars
+import time
+
+connection_seconds = metrics.histogram(
+    "vault_db_connection_seconds",
+    "Time a request waited for its database connection",
+)
+
+# Set per request by vault.middleware: the seconds spent acquiring database
+# connections (a list, appended to), and the QueryRecorder counting queries.
+# Context variables follow the request into the threads asgiref runs its
+# ORM calls in, which thread-local connection state does not.
+connection_waits = contextvars.ContextVar("connection_waits", default=None)
+request_queries = contextvars.ContextVar("request_queries", default=None)
+
+
+class QueryRecorder:
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - start
+
+
+def record_query(execute, sql, params, many, context):
+    recorder = request_queries.get()
+    if recorder is None:
+        return execute(sql, params, many, context)
+    return recorder(execute, sql, params, many, context)
+
+
+# Database backends (ENGINE "vault.db.postgresql" or "vault.db.sqlite3")
+# that time opening a connection ("new") and the health check of a
+# persistent one before reuse ("reused") where Django does them: on the
+# first query of a request, so requests that make no query cost nothing.
+class TimedConnectionMixin:
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.execute_wrappers.append(record_query)
+
+    @contextlib.contextmanager
+    def timed(self, state):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            connection_seconds.observe(elapsed, connection=state)
+            waits = connection_waits.get()
+            if waits is not None:
+                waits.append(elapsed)
+
+    def get_new_connection(self, conn_params):
+        with self.timed("new"):
+            return super().get_new_connection(conn_params)
+
+    def is_usable(self):
+        with self.timed("reused"):
+            return super().is_usable()
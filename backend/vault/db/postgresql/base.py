@@ -0,0 +1,6 @@
+from django.db.backends.postgresql import base
+from vault.db import TimedConnectionMixin
+
+
+class DatabaseWrapper(TimedConnectionMixin, base.DatabaseWrapper):
+    pass
@@ -0,0 +1,6 @@
+from django.db.backends.sqlite3 import base
+from vault.db import TimedConnectionMixin
+
+
+class DatabaseWrapper(TimedConnectionMixin, base.DatabaseWrapper):
+    pass
@@ -0,0 +1,154 @@
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.contrib.auth import hashers
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from rest_framework.exceptions import APIException
+from vault import metrics
+import django
+import fcntl
+import multiprocessing
+import os
+import threading
+import time
+
+hash_seconds = metrics.histogram(
+    "vault_password_hash_seconds",
+    "Time to hash or check a password, including time queued for a worker",
+)
+hash_rejected = metrics.counter(
+    "vault_password_hash_rejected_total",
+    "Password hashing requests refused because every slot was busy",
+)
+
+
+# Raised instead of queueing when VAULT_HASH_CONCURRENCY hashes are already
+# running on this host. DRF turns it into a 503 with Retry-After.
+class HashingBusy(APIException):
+    status_code = 503
+    default_detail = "Server busy, try again shortly."
+    default_code = "hashing_busy"
+    wait = 1
+
+
+# Password hashes (PBKDF2 by default) take hundreds of milliseconds of CPU.
+# They run in a small process pool per server process, and at most
+# VAULT_HASH_CONCURRENCY of them run at once across all server processes on
+# the host, so a burst of logins or registrations gets fast 503s instead of
+# occupying every worker while vault requests queue behind them.
+#
+# The host-wide limit uses flock()ed slot files in VAULT_HASH_SLOT_DIR, which
+# works across gunicorn workers without coordination from the master and
+# releases the slot if a worker dies mid-hash.
+class Slots:
+    def __init__(self, directory, count):
+        self.directory = directory
+        self.count = count
+
+    def acquire(self):
+        os.makedirs(self.directory, exist_ok=True)
+        for slot in range(self.count):
+            fd = os.open(
+                os.path.join(self.directory, "slot-{}".format(slot)),
+                os.O_RDWR | os.O_CREAT,
+                0o600,
+            )
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except BlockingIOError:
+                os.close(fd)
+        raise HashingBusy()
+
+    def release(self, fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+# Spawned rather than forked: server processes hold database connections
+# and, under ASGI, threads.
+def get_executor():
+    global _executor
+    if not settings.VAULT_HASH_WORKERS:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=settings.VAULT_HASH_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=django.setup,
+            )
+        return _executor
+
+
+@receiver(setting_changed)
+def reset_executor(setting, **kwargs):
+    global _executor
+    if setting in ("VAULT_HASH_WORKERS", "PASSWORD_HASHERS"):
+        with _executor_lock:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            _executor = None
+
+
+def run(operation, algorithm, function, *args):
+    slots = Slots(settings.VAULT_HASH_SLOT_DIR, settings.VAULT_HASH_CONCURRENCY)
+    try:
+        fd = slots.acquire()
+    except HashingBusy:
+        hash_rejected.inc(operation=operation)
+        raise
+    start = time.perf_counter()
+    try:
+        executor = get_executor()
+        if executor is None:
+            return function(*args)
+        return executor.submit(function, *args).result()
+    finally:
+        slots.release(fd)
+        hash_seconds.observe(
+            time.perf_counter() - start, algorithm=algorithm, operation=operation
+        )
+
+
+def algorithm_of(encoded):
+    try:
+        return hashers.identify_hasher(encoded).algorithm
+    except ValueError:
+        return "unknown"
+
+
+def make_password(password):
+    algorithm = hashers.get_hasher().algorithm
+    return run("make", algorithm, hashers.make_password, password)
+
+
+def check_password(password, encoded):
+    is_correct, _ = verify_password(password, encoded)
+    return is_correct
+
+
+def verify_password(password, encoded):
+    return run(
+        "check", algorithm_of(encoded), hashers.verify_password, password, encoded
+    )
+
+
+# Equivalents of AbstractBaseUser.set_password/check_password, including
+# the upgrade of hashes made with an outdated algorithm or iteration count.
+def set_user_password(user, password):
+    user.password = make_password(password)
+    user._password = password
+
+
+def check_user_password(user, password):
+    is_correct, must_update = verify_password(password, user.password)
+    if is_correct and must_update:
+        set_user_password(user, password)
+        user._password = None
+        user.save(update_fields=["password"])
+    return is_correct
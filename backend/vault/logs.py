@@ -0,0 +1,137 @@
+from vault import metrics
+import contextvars
+import copy
+import datetime
+import fcntl
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+# Id of the request being handled, set by RequestIdMiddleware
+request_id = contextvars.ContextVar("request_id", default=None)
+
+dropped = metrics.counter(
+    "vault_log_records_dropped_total",
+    "Log records discarded because the log queue was full",
+)
+
+
+# Adds request_id to records in the thread that logs them, before they are
+# queued; the writing thread has no request context. django.request logs
+# responses after the middleware has returned, but passes the request.
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id.get() or getattr(
+            getattr(record, "request", None), "id", None
+        )
+        return True
+
+
+# One JSON object per line
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            "time": datetime.datetime.fromtimestamp(
+                record.created, datetime.timezone.utc
+            ).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+            "process": record.process,
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exception"] = record.exc_text
+        return json.dumps(data, default=str)
+
+
+# Every server process appends to the same file. Rollover happens under an
+# flock() on "<file>.lock", and only if the file is still over the limit
+# once the lock is held; a process whose file was rotated by another one
+# reopens it before writing.
+class RotatingFileHandler(logging.handlers.RotatingFileHandler):
+    def shouldRollover(self, record):
+        if self.stream is not None and self.rotated_elsewhere():
+            self.stream.close()
+            self.stream = self._open()
+        return super().shouldRollover(record)
+
+    def rotated_elsewhere(self):
+        try:
+            current = os.stat(self.baseFilename).st_ino
+        except FileNotFoundError:
+            return True
+        return current != os.fstat(self.stream.fileno()).st_ino
+
+    def doRollover(self):
+        with open(self.baseFilename + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if os.path.getsize(self.baseFilename) >= self.maxBytes:
+                    super().doRollover()
+                elif self.stream is not None:
+                    self.stream.close()
+                    self.stream = self._open()
+            except FileNotFoundError:
+                self.stream = self._open()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+# Request threads only put records on a bounded queue; a QueueListener
+# thread per process formats them as JSON and writes them to a rotating
+# file and to stderr. A slow or stalled log disk then delays log lines
+# instead of requests, and once `maxsize` records are waiting further
+# records are dropped (and counted) rather than blocking.
+#
+# Configured from settings.LOGGING with "()": "vault.logs.QueueHandler".
+class QueueHandler(logging.handlers.QueueHandler):
+    def __init__(
+        self,
+        filename,
+        max_bytes=10 * 1024 * 1024,
+        backup_count=5,
+        console=True,
+        maxsize=10000,
+    ):
+        super().__init__(queue.Queue(maxsize))
+        handlers = [RotatingFileHandler(filename, "a", max_bytes, backup_count)]
+        if console:
+            handlers.append(logging.StreamHandler(sys.stderr))
+        for handler in handlers:
+            handler.setFormatter(JSONFormatter())
+        self.listener = logging.handlers.QueueListener(
+            self.queue, *handlers, respect_handler_level=True
+        )
+        self.listener.start()
+
+    # Like QueueHandler.prepare, but keeps the traceback out of the message
+    # so JSONFormatter can put it in its own field
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = JSONFormatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped.inc()
+
+    # Called by logging.shutdown() at exit; writes out what is still queued
+    def close(self):
+        listener, self.listener = self.listener, None
+        if listener is not None:
+            listener.stop()
+            for handler in listener.handlers:
+                handler.close()
+        super().close()
@@ -0,0 +1,226 @@
+from django.core.management.base import BaseCommand
+from django.test import Client
+from django.test.utils import override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+from vault import logs, models, throttling
+from vault.benchmarks import entry_payload, seed_entries, seed_files
+from vault.codec import FromBytes, ToBytes
+from vault.renderers import ORJSONParser, ORJSONRenderer
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+import io
+import json
+import logging
+import os
+import tempfile
+import time
+
+
+def old_to_bytes(input):
+    return bytes([input[str(k)] for k in sorted(input.keys(), key=int)])
+
+
+def old_from_bytes(input):
+    return {str(index): byte for index, byte in enumerate(input)}
+
+
+# A log file on a slow disk: every write takes `delay` seconds and every
+# `every`th write stalls for `stall` seconds.
+class SlowStream:
+    def __init__(self, stream, delay=0.001, stall=0.1, every=50):
+        self.stream = stream
+        self.delay = delay
+        self.stall = stall
+        self.every = every
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        time.sleep(self.stall if self.writes % self.every == 0 else self.delay)
+        return self.stream.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+# Runs API scenarios in-process through the full middleware stack against
+# the configured database, each against a fresh throwaway user.
+class Command(BaseCommand):
+    help = "Time vault API operations for synthetic vaults of several sizes"
+
+    def add_arguments(self, parser):
+        parser.add_argument("scenario", choices=sorted(self.scenarios()))
+        parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+        parser.add_argument("--repeat", type=int, default=3)
+
+    def scenarios(self):
+        return {
+            "add-batch": self.add_batch,
+            "codec": self.codec,
+            "json": self.json,
+            "edit-batch": self.edit_batch,
+            "logging": self.slow_log,
+            "throttle": self.throttle,
+        }
+
+    def handle(self, *args, **options):
+        scenario = self.scenarios()[options["scenario"]]
+        for size in options["sizes"]:
+            timings = {}
+            for _ in range(options["repeat"]):
+                user = models.User.objects.create_user(
+                    username="benchmark-{}".format(os.urandom(8).hex())
+                )
+                try:
+                    client = Client(
+                        HTTP_AUTHORIZATION="Bearer {}".format(
+                            AccessToken.for_user(user)
+                        )
+                    )
+                    result = scenario(client, user, size)
+                finally:
+                    user.delete()
+                if not isinstance(result, dict):
+                    result = {options["scenario"]: result}
+                for label, elapsed in result.items():
+                    timings.setdefault(label, []).append(elapsed)
+            for label, runs in timings.items():
+                self.stdout.write(
+                    "{:<12} size={:<7} best={:.6f}s mean={:.6f}s".format(
+                        label, size, min(runs), sum(runs) / len(runs)
+                    )
+                )
+
+    def post(self, client, path, data):
+        body = json.dumps(data)
+        start = time.perf_counter()
+        response = client.post(path, body, content_type="application/json")
+        elapsed = time.perf_counter() - start
+        if response.status_code != 200:
+            raise RuntimeError("{} returned {}".format(path, response.status_code))
+        return elapsed
+
+    def add_batch(self, client, user, size):
+        entries = [entry_payload("benchmark-{}".format(i)) for i in range(size)]
+        return self.post(client, "/api/vault/add-batch", {"entries": entries})
+
+    # Re-encrypts a seeded vault the way the client does after a master
+    # password change; one file per ten entries.
+    def edit_batch(self, client, user, size):
+        entries = seed_entries(user.id, size, "benchmark")
+        ids = [entry.id for entry in entries]
+        files = seed_files(ids[::10], len(ids[::10]), 4096)
+        files = {file.VaultEntry_id: file for file in files}
+        edits = []
+        for i, entry in enumerate(entries):
+            edit = dict(entry_payload("benchmark-{}".format(i)), id=entry.id, files=[])
+            if entry.id in files:
+                edit["files"].append(
+                    {
+                        "id": files[entry.id].id,
+                        "name": files[entry.id].name,
+                        "file": FromBytes(os.urandom(4096)),
+                        "iv": FromBytes(os.urandom(12)),
+                    }
+                )
+            edits.append(edit)
+        return self.post(client, "/api/vault/edit-batch", {"entries": edits})
+
+    # Compares the byte-object codec with the implementation it replaced;
+    # sizes are in bytes here, e.g. --sizes 16 65536 5242880.
+    def codec(self, client, user, size):
+        data = os.urandom(size)
+        legacy = json.loads(json.dumps(FromBytes(data)))
+
+        # Small inputs are timed over enough calls to be measurable
+        calls = max(1, 65536 // max(size, 1))
+
+        def timed(function, value):
+            start = time.perf_counter()
+            for _ in range(calls):
+                function(value)
+            return (time.perf_counter() - start) / calls
+
+        return {
+            "decode-old": timed(old_to_bytes, legacy),
+            "decode": timed(ToBytes, legacy),
+            "encode-old": timed(old_from_bytes, data),
+            "encode": timed(FromBytes, data),
+        }
+
+    # Renders a legacy-encoded retrieve response and parses an add-batch body
+    # of the same size with the stdlib and orjson classes, then times the
+    # retrieve request through the configured renderer.
+    def json(self, client, user, size):
+        seed_entries(user.id, size, "benchmark")
+        start = time.perf_counter()
+        response = client.get("/api/vault/retrieve")
+        retrieve = time.perf_counter() - start
+        data = response.json()
+        body = json.dumps(
+            {"entries": [entry_payload("benchmark-{}".format(i)) for i in range(size)]}
+        )
+        body = body.encode()
+
+        def timed(function, *args):
+            start = time.perf_counter()
+            function(*args)
+            return time.perf_counter() - start
+
+        return {
+            "render-json": timed(JSONRenderer().render, data),
+            "render-orjson": timed(ORJSONRenderer().render, data),
+            "parse-json": timed(JSONParser().parse, io.BytesIO(body)),
+            "parse-orjson": timed(ORJSONParser().parse, io.BytesIO(body)),
+            "retrieve": retrieve,
+        }
+
+    # Cost per request of the rate limit check, through a process-local
+    # store and through the configured VAULT_THROTTLE_STORE and
+    # VAULT_THROTTLE_SHARED_STORE. Sizes are hits, spread over 100 keys that
+    # all stay under their limit.
+    def throttle(self, client, user, size):
+        def timed(store):
+            start = time.perf_counter()
+            for i in range(size):
+                store.hit("benchmark:{}".format(i % 100), size, 60)
+            return (time.perf_counter() - start) / size
+
+        return {
+            "local": timed(throttling.LocalStore()),
+            "configured": timed(throttling.get_store()),
+            "shared": timed(throttling.get_store("VAULT_THROTTLE_SHARED_STORE")),
+        }
+
+    # Median and 99th percentile latency of requests that log, with the log
+    # file on a SlowStream, through a plain FileHandler and through
+    # vault.logs.QueueHandler. The requests are rejected vault/sync calls,
+    # which django.request logs as warnings. Sizes are requests.
+    def slow_log(self, client, user, size):
+        directory = tempfile.mkdtemp()
+        direct = logging.FileHandler(os.path.join(directory, "direct.log"))
+        direct.stream = SlowStream(direct.stream)
+        queued = logs.QueueHandler(os.path.join(directory, "queued.log"), console=False)
+        for handler in queued.listener.handlers:
+            handler.stream = SlowStream(handler.stream)
+        root = logging.getLogger()
+        handlers = root.handlers[:]
+        result = {}
+        try:
+            # DEBUG off so Django's own console handler stays quiet
+            with override_settings(DEBUG=False):
+                for label, handler in (("direct", direct), ("queue", queued)):
+                    root.handlers = [handler]
+                    latencies = []
+                    for _ in range(size):
+                        start = time.perf_counter()
+                        client.get("/api/vault/sync?since=invalid")
+                        latencies.append(time.perf_counter() - start)
+                    latencies.sort()
+                    result[label + "-p50"] = latencies[len(latencies) // 2]
+                    result[label + "-p99"] = latencies[int(len(latencies) * 0.99)]
+        finally:
+            root.handlers = handlers
+            direct.close()
+            queued.close()
+        return result
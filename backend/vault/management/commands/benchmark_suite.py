@@ -0,0 +1,548 @@
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.handlers.base import BaseHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, transaction
+from django.test import RequestFactory
+from django.test.utils import override_settings
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+from vault import hashing, models
+from vault.benchmarks import (
+    entry_payload,
+    percentile,
+    seed_account,
+    seed_entries,
+    seed_files,
+)
+from vault.codec import FromBytes
+from vault.db import QueryRecorder
+import collections
+import datetime
+import django
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import pyotp
+import resource
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+PASSWORD = "benchmark"
+SECRET = "benchmark-recovery-secret"
+# Every rate limit, and the cap on a user's open uploads, is raised out of
+# the way of the measurements, and /metrics is scraped without a token
+UNTHROTTLED = dict(
+    settings.REST_FRAMEWORK,
+    DEFAULT_THROTTLE_RATES={
+        scope: "1000000/second"
+        for scope in settings.REST_FRAMEWORK["DEFAULT_THROTTLE_RATES"]
+    },
+)
+
+
+# Each scenario sends one kind of request to one endpoint of vault/urls.py
+# (plus /metrics). `build(plan, i)` returns the i-th request as (user or
+# None, method, path, JSON body or raw bytes, headers). `pool(user, count,
+# file_size)`, if set, seeds the objects the endpoint consumes, one per
+# request (entries and files to delete, uploads to complete), for the user
+# sending it.
+Scenario = collections.namedtuple("Scenario", "build pool", defaults=[None])
+
+
+def owner(plan, i):
+    return plan["users"][i % len(plan["users"])]
+
+
+def token(plan, i):
+    user = owner(plan, i)
+    body = {"username": user["username"], "password": PASSWORD}
+    body["twoFA"] = pyotp.TOTP(user["totp"]).now()
+    return None, "POST", "/api/token", body, {}
+
+
+def token_refresh(plan, i):
+    body = {"refresh": owner(plan, i)["refresh"]}
+    return None, "POST", "/api/token/refresh", body, {}
+
+
+def register(plan, i):
+    body = {
+        "username": "{}-register-{}".format(plan["prefix"], i),
+        "password": PASSWORD,
+    }
+    return None, "POST", "/api/register", body, {}
+
+
+def salt(plan, i):
+    return owner(plan, i), "GET", "/api/salt", None, {}
+
+
+def confirm2fa(plan, i):
+    return None, "POST", "/api/confirm2fa", {"user": owner(plan, i)["username"]}, {}
+
+
+def vault_add(plan, i):
+    body = entry_payload("add-{}".format(i), plan["encoding"])
+    return owner(plan, i), "POST", "/api/vault/add", body, {}
+
+
+def vault_add_batch(plan, i):
+    body = {
+        "entries": [
+            entry_payload("batch-{}-{}".format(i, j), plan["encoding"])
+            for j in range(plan["batch"])
+        ]
+    }
+    return owner(plan, i), "POST", "/api/vault/add-batch", body, {}
+
+
+def vault_retrieve(plan, i):
+    return owner(plan, i), "GET", "/api/vault/retrieve", None, {}
+
+
+# Polls with an up to date cursor, as a synced client does
+def vault_sync(plan, i):
+    user = owner(plan, i)
+    path = "/api/vault/sync?since={}".format(user["revision"])
+    return user, "GET", path, None, {}
+
+
+def vault_delete(plan, i):
+    return owner(plan, i), "POST", "/api/vault/delete", {"id": plan["pool"][i]}, {}
+
+
+def vault_edit(plan, i):
+    user = owner(plan, i)
+    id, name = user["entries"][i // len(plan["users"]) % len(user["entries"])]
+    body = dict(entry_payload(name, plan["encoding"]), id=id)
+    return user, "POST", "/api/vault/edit", body, {}
+
+
+# Re-encrypts up to --batch entries of the vault at once
+def vault_edit_batch(plan, i):
+    user = owner(plan, i)
+    body = {
+        "entries": [
+            dict(entry_payload(name, plan["encoding"]), id=id)
+            for id, name in user["entries"][: plan["batch"]]
+        ]
+    }
+    return user, "POST", "/api/vault/edit-batch", body, {}
+
+
+def file_add(plan, i):
+    user = owner(plan, i)
+    body = {
+        "id": user["entries"][0][0],
+        "name": "add-{}.zip".format(i),
+        "file": FromBytes(os.urandom(plan["file_size"]), plan["encoding"]),
+        "iv": FromBytes(os.urandom(12), plan["encoding"]),
+    }
+    return user, "POST", "/api/vault/files/add", body, {}
+
+
+def file_download(plan, i):
+    user = owner(plan, i)
+    path = "/api/vault/files/{}".format(
+        user["files"][i // len(plan["users"]) % len(user["files"])]
+    )
+    return user, "GET", path, None, {}
+
+
+def file_upload_start(plan, i):
+    user = owner(plan, i)
+    body = {
+        "id": user["entries"][0][0],
+        "name": "upload-{}.zip".format(i),
+        "size": plan["file_size"],
+        "iv": FromBytes(os.urandom(12), plan["encoding"]),
+    }
+    return user, "POST", "/api/vault/files/uploads", body, {}
+
+
+# Sends a whole file (at most VAULT_UPLOAD_CHUNK_SIZE) as one chunk, which
+# also completes the upload
+def file_upload_append(plan, i):
+    path = "/api/vault/files/uploads/{}".format(plan["pool"][i])
+    body = os.urandom(plan["file_size"])
+    return owner(plan, i), "PUT", path, body, {"Upload-Offset": "0"}
+
+
+def file_delete(plan, i):
+    body = {"id": plan["pool"][i]}
+    return owner(plan, i), "POST", "/api/vault/files/delete", body, {}
+
+
+def recovery(plan, i):
+    body = {"username": owner(plan, i)["username"], "verify": True, "secret": SECRET}
+    return None, "POST", "/api/recovery", body, {}
+
+
+# Sets the password it already has, so every request succeeds
+def reset_password(plan, i):
+    body = {"oldPassword": PASSWORD, "newPassword": PASSWORD}
+    return owner(plan, i), "POST", "/api/recovery/password", body, {}
+
+
+def metrics(plan, i):
+    headers = {}
+    if settings.VAULT_METRICS_TOKEN:
+        headers["Authorization"] = "Bearer {}".format(settings.VAULT_METRICS_TOKEN)
+    return None, "GET", "/metrics", None, headers
+
+
+def seed_entry_pool(user, count, file_size):
+    return [entry.id for entry in seed_entries(user["id"], count, "pool")]
+
+
+def seed_file_pool(user, count, file_size):
+    files = seed_files([user["entries"][0][0]], count, file_size, "pool")
+    return [file.id for file in files]
+
+
+def seed_upload_pool(user, count, file_size):
+    uploads = models.FileUpload.objects.bulk_create(
+        models.FileUpload(
+            VaultEntry_id=user["entries"][0][0],
+            name="pool-{}.zip".format(i),
+            iv=os.urandom(12),
+            size=file_size,
+        )
+        for i in range(count)
+    )
+    return [str(upload.id) for upload in uploads]
+
+
+SCENARIOS = {
+    "token": Scenario(token),
+    "token/refresh": Scenario(token_refresh),
+    "register": Scenario(register),
+    "salt": Scenario(salt),
+    "confirm2fa": Scenario(confirm2fa),
+    "vault/add": Scenario(vault_add),
+    "vault/add-batch": Scenario(vault_add_batch),
+    "vault/retrieve": Scenario(vault_retrieve),
+    "vault/sync": Scenario(vault_sync),
+    "vault/delete": Scenario(vault_delete, seed_entry_pool),
+    "vault/edit": Scenario(vault_edit),
+    "vault/files/add": Scenario(file_add),
+    "vault/files/<id>": Scenario(file_download),
+    "vault/files/uploads": Scenario(file_upload_start),
+    "vault/files/uploads/<id>": Scenario(file_upload_append, seed_upload_pool),
+    "vault/files/delete": Scenario(file_delete, seed_file_pool),
+    "recovery": Scenario(recovery),
+    "recovery/password": Scenario(reset_password),
+    "vault/edit-batch": Scenario(vault_edit_batch),
+    "metrics": Scenario(metrics),
+}
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return round(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1024 / 1024, 1
+    )
+
+
+# Runs in a fresh spawned process per scenario, so peak RSS is that of the
+# scenario alone. Requests go through the full middleware stack, as in a
+# server process, from `concurrency` threads with a database connection each.
+def run_scenario(name, plan):
+    # The database this command seeded, which under the test runner is not
+    # the one in settings
+    connections.settings["default"]["NAME"] = plan["database"]
+    build = SCENARIOS[name].build
+    factory = RequestFactory()
+    handler = BaseHandler()
+    handler.load_middleware()
+    tokens = {
+        user["id"]: str(AccessToken.for_user(models.User(id=user["id"])))
+        for user in plan["users"]
+    }
+    counter = itertools.count()
+    results = []
+    baseline_rss = peak_rss_mb()
+
+    def worker():
+        recorder = QueryRecorder()
+        try:
+            with connection.execute_wrapper(recorder):
+                while True:
+                    i = next(counter)
+                    if i >= plan["requests"]:
+                        break
+                    user, method, path, body, headers = build(plan, i)
+                    if user is not None:
+                        headers["Authorization"] = "Bearer {}".format(
+                            tokens[user["id"]]
+                        )
+                    if isinstance(body, bytes):
+                        content_type = "application/octet-stream"
+                    else:
+                        body = "" if body is None else json.dumps(body)
+                        content_type = "application/json"
+                    request = factory.generic(
+                        method, path, body, content_type, headers=headers
+                    )
+                    queries = recorder.count
+                    start = time.perf_counter()
+                    response = handler.get_response(request)
+                    if response.streaming:
+                        for _ in response:
+                            pass
+                    else:
+                        response.content
+                    response.close()
+                    results.append(
+                        (
+                            time.perf_counter() - start,
+                            response.status_code,
+                            recorder.count - queries,
+                        )
+                    )
+        finally:
+            connection.close()
+
+    with override_settings(
+        REST_FRAMEWORK=UNTHROTTLED,
+        VAULT_MAX_OPEN_UPLOADS=sys.maxsize,
+        VAULT_METRICS_PUBLIC=True,
+    ):
+        start = time.perf_counter()
+        threads = [threading.Thread(target=worker) for _ in range(plan["concurrency"])]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+    # Its worker process would otherwise keep this one from exiting
+    hashing.reset_executor("VAULT_HASH_WORKERS")
+
+    latencies = sorted(result[0] * 1000 for result in results)
+    queries = [result[2] for result in results]
+    statuses = collections.Counter(str(result[1]) for result in results)
+    return {
+        "requests": len(results),
+        "statuses": dict(sorted(statuses.items())),
+        "seconds": round(elapsed, 3),
+        "throughput": round(len(results) / elapsed, 1),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50), 2),
+            "p95": round(percentile(latencies, 0.95), 2),
+            "p99": round(percentile(latencies, 0.99), 2),
+            "mean": round(statistics.mean(latencies), 2),
+            "max": round(latencies[-1], 2),
+        },
+        "queries": {
+            "mean": round(statistics.mean(queries), 1),
+            "max": max(queries),
+        },
+        "baseline_rss_mb": baseline_rss,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def git_revision():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = bool(
+            subprocess.run(
+                ["git", "status", "--porcelain", "--untracked-files=no"],
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout.strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+# Seeds synthetic users (a vault of --entries entries with --files files of
+# --file-size bytes each, 2FA and a recovery secret) and drives every API
+# endpoint with them at --concurrency, one endpoint at a time against freshly
+# seeded users, on the configured database (Postgres, or SQLite with
+# VAULT_DB=sqlite, which takes one request at a time: concurrent writers
+# would fail on its database lock). Writes a JSON report to compare across
+# commits:
+#
+#   manage.py benchmark_suite --output before.json
+#   (change something)
+#   manage.py benchmark_suite --output after.json --compare before.json
+class Command(BaseCommand):
+    help = "Benchmark every API endpoint and write a JSON report"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=4)
+        parser.add_argument("--entries", type=int, default=100)
+        parser.add_argument(
+            "--files", type=int, default=1, help="Files per user, on its first entries"
+        )
+        parser.add_argument("--file-size", type=int, default=16 * 1024)
+        parser.add_argument("--concurrency", type=int, default=4)
+        parser.add_argument(
+            "--requests", type=int, default=200, help="Requests per endpoint"
+        )
+        parser.add_argument(
+            "--batch", type=int, default=50, help="Entries per add-batch/edit-batch"
+        )
+        parser.add_argument(
+            "--encoding", choices=["legacy", "base64"], default="legacy"
+        )
+        parser.add_argument(
+            "--endpoints", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS)
+        )
+        parser.add_argument("--output", help="Write the report here")
+        parser.add_argument("--compare", help="Earlier report to compare with")
+
+    def handle(self, *args, **options):
+        if options["users"] < 1 or options["entries"] < 1 or options["files"] < 1:
+            raise CommandError("--users, --entries and --files must be at least 1")
+        if options["file_size"] > settings.VAULT_UPLOAD_CHUNK_SIZE:
+            raise CommandError("--file-size must fit in one VAULT_UPLOAD_CHUNK_SIZE")
+        if connection.vendor == "sqlite" and options["concurrency"] > 1:
+            self.stderr.write(
+                "SQLite allows one writer at a time, using --concurrency 1"
+            )
+            options["concurrency"] = 1
+        baseline = None
+        if options["compare"]:
+            with open(options["compare"]) as f:
+                baseline = json.load(f)
+
+        commit, dirty = git_revision()
+        report = {
+            "commit": commit,
+            "dirty": dirty,
+            "time": datetime.datetime.now(datetime.timezone.utc).isoformat(
+                timespec="seconds"
+            ),
+            "database": connection.vendor,
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "cpus": os.cpu_count(),
+            "options": {
+                key: options[key]
+                for key in (
+                    "users",
+                    "entries",
+                    "files",
+                    "file_size",
+                    "concurrency",
+                    "requests",
+                    "batch",
+                    "encoding",
+                )
+            },
+            "endpoints": {},
+        }
+        password_hash = make_password(PASSWORD)
+        secret_hash = make_password(SECRET)
+        context = multiprocessing.get_context("spawn")
+        for name in options["endpoints"]:
+            prefix = "benchmark-{}".format(os.urandom(6).hex())
+            try:
+                plan = self.seed(name, prefix, password_hash, secret_hash, options)
+                with ProcessPoolExecutor(
+                    max_workers=1, mp_context=context, initializer=django.setup
+                ) as executor:
+                    result = executor.submit(run_scenario, name, plan).result()
+            finally:
+                models.User.objects.filter(username__startswith=prefix).delete()
+            report["endpoints"][name] = result
+            self.stderr.write(self.summary(name, result, baseline))
+
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output + "\n")
+        else:
+            self.stdout.write(output)
+
+    # Users are created directly, with the password and recovery secret
+    # hashed once, so seeding does not pay for a hash per user.
+    def seed(self, name, prefix, password_hash, secret_hash, options):
+        plan = {
+            "database": connection.settings_dict["NAME"],
+            "prefix": prefix,
+            "users": [],
+            "pool": [],
+            "encoding": options["encoding"],
+            "file_size": options["file_size"],
+            "batch": options["batch"],
+            "requests": options["requests"],
+            "concurrency": options["concurrency"],
+        }
+        users = models.User.objects.bulk_create(
+            models.User(username="{}-{}".format(prefix, i), password=password_hash)
+            for i in range(options["users"])
+        )
+        for user in users:
+            totp = seed_account(user, secret_hash)
+            entries = seed_entries(user.id, options["entries"])
+            ids = [entry.id for entry in entries]
+            files = seed_files(ids, options["files"], options["file_size"])
+            plan["users"].append(
+                {
+                    "id": user.id,
+                    "username": user.username,
+                    "totp": totp,
+                    "refresh": str(RefreshToken.for_user(user)),
+                    "entries": [(entry.id, entry.name) for entry in entries],
+                    "files": [file.id for file in files],
+                }
+            )
+
+        pool = SCENARIOS[name].pool
+        if pool is not None:
+            # Request i belongs to user i % users, see owner()
+            per_user = [
+                len(range(i, options["requests"], len(users)))
+                for i in range(len(users))
+            ]
+            pools = [
+                pool(user, count, options["file_size"])
+                for user, count in zip(plan["users"], per_user)
+            ]
+            plan["pool"] = [
+                pools[i % len(users)][i // len(users)]
+                for i in range(options["requests"])
+            ]
+
+        for user in plan["users"]:
+            with transaction.atomic():
+                user["revision"] = models.bump_revision(models.User(id=user["id"]))
+        return plan
+
+    def summary(self, name, result, baseline):
+        line = "{:<26} {:>7.1f}/s  p50 {:>8.2f}ms  p95 {:>8.2f}ms  p99 {:>8.2f}ms  {:>5.1f} queries  {:>6.1f}MB  {}".format(
+            name,
+            result["throughput"],
+            result["latency_ms"]["p50"],
+            result["latency_ms"]["p95"],
+            result["latency_ms"]["p99"],
+            result["queries"]["mean"],
+            result["peak_rss_mb"],
+            result["statuses"],
+        )
+        before = (baseline or {}).get("endpoints", {}).get(name)
+        if before:
+            line += "\n{:<26} {:>+7.1%}    p50 {:>+8.1%}    p95 {:>+8.1%}    p99 {:>+8.1%}    {:>+5.1f} queries  {:>+6.1f}MB".format(
+                "  vs " + str((baseline.get("commit") or "?")[:8]),
+                result["throughput"] / before["throughput"] - 1,
+                result["latency_ms"]["p50"] / before["latency_ms"]["p50"] - 1,
+                result["latency_ms"]["p95"] / before["latency_ms"]["p95"] - 1,
+                result["latency_ms"]["p99"] / before["latency_ms"]["p99"] - 1,
+                result["queries"]["mean"] - before["queries"]["mean"],
+                result["peak_rss_mb"] - before["peak_rss_mb"],
+            )
+        return line
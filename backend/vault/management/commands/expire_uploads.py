@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from vault import models
+
+
+class Command(BaseCommand):
+    help = "Delete resumable uploads older than VAULT_UPLOAD_TTL, with their parts"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true")
+
+    def handle(self, *args, **options):
+        expired = models.FileUpload.objects.filter(
+            created_at__lt=models.FileUpload.cutoff()
+        )
+        if options["dry_run"]:
+            self.stdout.write("{} uploads would be deleted".format(expired.count()))
+            return
+        # Parts are deleted by their foreign key cascade, without being loaded
+        _, deleted = expired.delete()
+        self.stdout.write(
+            self.style.SUCCESS(
+                "Deleted {} uploads".format(deleted.get("vault.FileUpload", 0))
+            )
+        )
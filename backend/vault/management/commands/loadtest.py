@@ -0,0 +1,170 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework_simplejwt.tokens import AccessToken
+from vault import models
+from vault.benchmarks import percentile, seed_account, seed_entries, seed_files
+from urllib.parse import urlsplit
+import asyncio
+import collections
+import json
+import os
+import socket
+import statistics
+import time
+
+
+# Drives a running server (gunicorn in either VAULT_SERVER mode) with slow
+# clients, which download the largest allowed file a few KB at a time, and
+# login clients hammering /api/token, while fast clients poll vault/sync.
+# Shows how much of the server the slow connections and the password hashing
+# take away from everyone else. The server must use the same database as
+# this command.
+class Command(BaseCommand):
+    help = "Load test a running server with slow downloads and concurrent syncs"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="http://127.0.0.1:8000")
+        parser.add_argument("--slow-clients", type=int, default=20)
+        parser.add_argument("--fast-clients", type=int, default=10)
+        parser.add_argument("--login-clients", type=int, default=0)
+        parser.add_argument("--duration", type=float, default=10.0)
+        parser.add_argument("--entries", type=int, default=1000)
+        parser.add_argument(
+            "--read-rate",
+            type=int,
+            default=64 * 1024,
+            help="Bytes per second read by each slow client",
+        )
+
+    def handle(self, *args, **options):
+        url = urlsplit(options["url"])
+        self.host, self.port = url.hostname, url.port or 80
+        user = models.User.objects.create_user(
+            username="loadtest-{}".format(os.urandom(8).hex()), password="loadtest"
+        )
+        try:
+            seed_account(user)
+            entries = seed_entries(user.id, options["entries"], "loadtest")
+            [file] = seed_files(
+                [entries[0].id], 1, settings.VAULT_MAX_FILE_SIZE, "large"
+            )
+            # Fast clients poll with an up to date cursor, as a synced client
+            # would.
+            with transaction.atomic():
+                models.bump_revision(user)
+            self.token = str(AccessToken.for_user(user))
+            result = asyncio.run(
+                self.run(
+                    "/api/vault/files/{}".format(file.id),
+                    "/api/vault/sync?since={}".format(models.current_revision(user)),
+                    json.dumps({"username": user.username, "password": "loadtest"}),
+                    options,
+                )
+            )
+        finally:
+            user.delete()
+        for key, value in result.items():
+            self.stdout.write("{:<16} {}".format(key, value))
+
+    async def run(self, download_path, sync_path, login, options):
+        deadline = time.monotonic() + options["duration"]
+        latencies, failures, downloaded = [], [0], [0]
+        logins = collections.Counter()
+        delay = 4096 / options["read_rate"]
+
+        async def slow_client():
+            while time.monotonic() < deadline:
+                _, total = await self.request(download_path, deadline, 4096, delay)
+                downloaded[0] += total
+
+        async def fast_client():
+            while time.monotonic() < deadline:
+                start = time.monotonic()
+                status, _ = await self.request(sync_path, deadline)
+                if status and time.monotonic() < deadline:
+                    latencies.append(time.monotonic() - start)
+                else:
+                    failures[0] += 1
+
+        # Logins send no 2FA code, so they end in 400 after the password
+        # check; 503 means the server refused to hash.
+        async def login_client():
+            while time.monotonic() < deadline:
+                status, _ = await self.request("/api/token", deadline, body=login)
+                if status:
+                    logins[status] += 1
+
+        await asyncio.gather(
+            *[slow_client() for _ in range(options["slow_clients"])],
+            *[fast_client() for _ in range(options["fast_clients"])],
+            *[login_client() for _ in range(options["login_clients"])],
+        )
+        latencies.sort()
+
+        def milliseconds(p):
+            if not latencies:
+                return "-"
+            return "{:.1f}ms".format(percentile(latencies, p) * 1000)
+
+        return {
+            "sync requests": len(latencies),
+            "sync per second": round(len(latencies) / options["duration"], 1),
+            "sync p50": milliseconds(0.50),
+            "sync p95": milliseconds(0.95),
+            "sync p99": milliseconds(0.99),
+            "sync mean": (
+                "{:.1f}ms".format(statistics.mean(latencies) * 1000)
+                if latencies
+                else "-"
+            ),
+            "sync unanswered": failures[0],
+            "downloaded MB": round(downloaded[0] / 1024 / 1024, 1),
+            "logins": dict(sorted(logins.items())),
+        }
+
+    # Minimal HTTP/1.1 client: GET, or POST of a JSON body. Slow readers
+    # (delay > 0) use a small receive buffer so they apply back-pressure to
+    # the server instead of letting the kernel buffer the whole response.
+    # Returns the status (None if no response arrived) and how many body
+    # bytes were read before the response ended or the deadline passed.
+    async def request(self, path, deadline, read_size=64 * 1024, delay=0, body=None):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if delay:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        sock.setblocking(False)
+        await asyncio.get_running_loop().sock_connect(sock, (self.host, self.port))
+        reader, writer = await asyncio.open_connection(sock=sock)
+        status, total = None, 0
+        headers = [
+            "{} {} HTTP/1.1".format("GET" if body is None else "POST", path),
+            "Host: {}".format(self.host),
+            "Authorization: Bearer {}".format(self.token),
+            "Connection: close",
+        ]
+        if body is not None:
+            headers += [
+                "Content-Type: application/json",
+                "Content-Length: {}".format(len(body)),
+            ]
+        try:
+            writer.write("\r\n".join(headers + ["", body or ""]).encode())
+            await writer.drain()
+            head = await asyncio.wait_for(
+                reader.readuntil(b"\r\n\r\n"), deadline - time.monotonic()
+            )
+            status = int(head.split(b" ", 2)[1])
+            while True:
+                chunk = await asyncio.wait_for(
+                    reader.read(read_size), deadline - time.monotonic()
+                )
+                if not chunk:
+                    break
+                total += len(chunk)
+                if delay:
+                    await asyncio.sleep(delay)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            writer.close()
+        return status, total
@@ -0,0 +1,71 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from vault import models
+from vault.storage import get_storage
+import itertools
+
+
+class Command(BaseCommand):
+    help = "Move attachment ciphertext stored in the database to VAULT_BLOB_STORAGE"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=50)
+        parser.add_argument("--dry-run", action="store_true")
+        parser.add_argument(
+            "--sweep",
+            action="store_true",
+            help="Also delete stored blobs that no file refers to, such as "
+            "those written by uploads whose transaction rolled back",
+        )
+
+    def handle(self, *args, **options):
+        storage = get_storage()
+        if storage is None:
+            raise CommandError("VAULT_BLOB_STORAGE is not configured")
+
+        pending = models.fileEntry.objects.filter(blob=None, file__isnull=False)
+        total = pending.count()
+        if options["dry_run"]:
+            self.stdout.write("{} files would be moved".format(total))
+        else:
+            self.move(pending, total, options["batch_size"])
+        if options["sweep"]:
+            self.sweep(storage, options["batch_size"], options["dry_run"])
+
+    def move(self, pending, total, batch_size):
+        moved = 0
+        # Rows leave the pending set as they are moved, so always take the
+        # first batch again; memory stays bounded by batch_size files.
+        while True:
+            with transaction.atomic():
+                batch = list(pending.order_by("id")[:batch_size])
+                if not batch:
+                    break
+                for file in batch:
+                    file.write(bytes(file.file))
+                models.fileEntry.objects.bulk_update(batch, ["blob", "size", "file"])
+            moved += len(batch)
+            self.stdout.write("Moved {}/{} files".format(moved, total))
+        self.stdout.write(self.style.SUCCESS("Moved {} files".format(moved)))
+
+    def sweep(self, storage, batch_size, dry_run):
+        keys = storage.keys()
+        unused = 0
+        while batch := list(itertools.islice(keys, batch_size)):
+            if dry_run:
+                unused += len(
+                    set(batch)
+                    - set(
+                        models.fileEntry.objects.filter(blob__in=batch).values_list(
+                            "blob", flat=True
+                        )
+                    )
+                )
+            else:
+                unused += len(models.delete_unreferenced(batch))
+        if dry_run:
+            self.stdout.write("{} unused blobs would be deleted".format(unused))
+        else:
+            self.stdout.write(
+                self.style.SUCCESS("Deleted {} unused blobs".format(unused))
+            )
@@ -0,0 +1,299 @@
+import bisect
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+# Process-local metrics; each gunicorn worker keeps its own values. Samples
+# are kept per set of label values, Prometheus style.
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, documentation, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts[index] += 1
+            self.values[key] = (counts, total + value)
+
+    # {labels: (per-bucket counts with +Inf last, sum)}, copied
+    def samples(self):
+        with self.lock:
+            return {
+                key: (list(counts), total)
+                for key, (counts, total) in self.values.items()
+            }
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            return dict(self.values)
+
+
+REGISTRY = {}
+_registry_lock = threading.Lock()
+
+
+def _register(cls, name, *args):
+    with _registry_lock:
+        if name not in REGISTRY:
+            REGISTRY[name] = cls(name, *args)
+        return REGISTRY[name]
+
+
+def histogram(name, documentation, buckets=DEFAULT_BUCKETS):
+    return _register(Histogram, name, documentation, buckets)
+
+
+def counter(name, documentation):
+    return _register(Counter, name, documentation)
+
+
+# Every metric of this process as plain JSON-compatible data:
+# {name: {"type", "documentation", "buckets", "samples": [[labels, value]]}},
+# value being the count for counters and per-bucket counts followed by the
+# sum for histograms.
+def snapshot():
+    with _registry_lock:
+        metrics = list(REGISTRY.values())
+    data = {}
+    for metric in metrics:
+        samples = []
+        for labels, value in metric.samples().items():
+            if metric.type == "histogram":
+                counts, total = value
+                value = counts + [total]
+            samples.append([list(labels), value])
+        data[metric.name] = {
+            "type": metric.type,
+            "documentation": metric.documentation,
+            "buckets": list(getattr(metric, "buckets", [])),
+            "samples": samples,
+        }
+    return data
+
+
+# Server processes each keep their own metrics. With a shared directory each
+# writes its snapshot there (see MetricsMiddleware) and /metrics adds up the
+# snapshots of every process. Other processes' numbers can lag by the time
+# since their last snapshot.
+#
+# Snapshot files are named by pid and a token drawn per process, so a worker
+# that gets the pid of an exited one does not overwrite its file. When a
+# worker exits, compact() merges its snapshot into AGGREGATE, so counters
+# never go backwards when a worker is replaced and scrapes read one file per
+# live worker. AGGREGATE also lists the files merged into it: collect()
+# reads it last and skips those, so a scrape racing a compaction counts each
+# file once.
+AGGREGATE = "exited.json"
+# Seconds a compacted file stays listed in AGGREGATE, well beyond a scrape
+COMPACTED_TTL = 3600
+
+_snapshot_name = (None, None)
+
+
+def snapshot_name():
+    global _snapshot_name
+    pid = os.getpid()
+    if _snapshot_name[0] != pid:
+        _snapshot_name = (pid, "{}-{}.json".format(pid, os.urandom(4).hex()))
+    return _snapshot_name[1]
+
+
+def _write_json(directory, name, data):
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, os.path.join(directory, name))
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def _read_json(directory, name):
+    try:
+        with open(os.path.join(directory, name)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        # Being replaced or removed
+        return None
+
+
+def write_snapshot(directory):
+    _write_json(directory, snapshot_name(), snapshot())
+
+
+# Merges the snapshots of exited process `pid` into AGGREGATE and removes
+# them. Called by the gunicorn master once the worker has been reaped
+# (gunicorn_config.py), so only one process ever writes AGGREGATE.
+def compact(directory, pid, now=None):
+    now = time.time() if now is None else now
+    prefix = "{}-".format(pid)
+    names = [
+        name
+        for name in os.listdir(directory)
+        if name.startswith(prefix) and name.endswith(".json")
+    ]
+    if not names:
+        return
+    aggregate = _read_json(directory, AGGREGATE) or {"metrics": {}, "compacted": {}}
+    snapshots = [aggregate["metrics"]]
+    for name in names:
+        data = _read_json(directory, name)
+        if data is not None:
+            snapshots.append(data)
+    compacted = {
+        name: at
+        for name, at in aggregate["compacted"].items()
+        if at > now - COMPACTED_TTL
+    }
+    compacted.update(dict.fromkeys(names, now))
+    _write_json(
+        directory,
+        AGGREGATE,
+        {"metrics": _as_snapshot(merge(snapshots)), "compacted": compacted},
+    )
+    for name in names:
+        os.unlink(os.path.join(directory, name))
+
+
+def collect(directory=None):
+    snapshots = {}
+    own = snapshot_name()
+    for name in sorted(os.listdir(directory)) if directory else []:
+        if name.endswith(".json") and name not in (own, AGGREGATE):
+            data = _read_json(directory, name)
+            if data is not None:
+                snapshots[name] = data
+    if directory:
+        aggregate = _read_json(directory, AGGREGATE)
+        if aggregate is not None:
+            for name in aggregate["compacted"]:
+                snapshots.pop(name, None)
+            snapshots[AGGREGATE] = aggregate["metrics"]
+    return merge([snapshot(), *snapshots.values()])
+
+
+# {name: metric} of snapshot() format, samples keyed by label tuples and
+# added up
+def merge(snapshots):
+    merged = {}
+    for data in snapshots:
+        for name, metric in data.items():
+            target = merged.setdefault(name, {**metric, "samples": {}})
+            for labels, value in metric["samples"]:
+                key = tuple(tuple(pair) for pair in labels)
+                if key not in target["samples"]:
+                    target["samples"][key] = value
+                elif metric["type"] == "histogram":
+                    target["samples"][key] = [
+                        a + b for a, b in zip(target["samples"][key], value)
+                    ]
+                else:
+                    target["samples"][key] += value
+    return merged
+
+
+def _as_snapshot(merged):
+    return {
+        name: {
+            **metric,
+            "samples": [
+                [[list(pair) for pair in labels], value]
+                for labels, value in metric["samples"].items()
+            ],
+        }
+        for name, metric in merged.items()
+    }
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(
+                key,
+                str(value)
+                .replace("\\", "\\\\")
+                .replace("\n", "\\n")
+                .replace('"', '\\"'),
+            )
+            for key, value in labels
+        )
+    )
+
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Prometheus text exposition format 0.0.4 of collect() output
+def exposition(metrics):
+    lines = []
+    for name, metric in sorted(metrics.items()):
+        lines.append("# HELP {} {}".format(name, metric["documentation"]))
+        lines.append("# TYPE {} {}".format(name, metric["type"]))
+        for labels, value in sorted(metric["samples"].items()):
+            if metric["type"] == "counter":
+                lines.append("{}{} {}".format(name, _labels(labels), _number(value)))
+                continue
+            cumulative = 0
+            for bound, count in zip(metric["buckets"] + [math.inf], value[:-1]):
+                cumulative += count
+                lines.append(
+                    "{}_bucket{} {}".format(
+                        name, _labels(labels + (("le", _number(bound)),)), cumulative
+                    )
+                )
+            lines.append(
+                "{}_sum{} {}".format(name, _labels(labels), _number(value[-1]))
+            )
+            lines.append("{}_count{} {}".format(name, _labels(labels), cumulative))
+    return "\n".join(lines) + "\n"
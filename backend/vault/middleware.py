@@ -0,0 +1,348 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.functional import SimpleLazyObject, empty
+from vault import compression, db, logs, metrics, models
+from vault.db import QueryRecorder
+import re
+import time
+import uuid
+
+request_seconds = metrics.histogram(
+    "vault_request_seconds",
+    "Time to produce a response, by view, method, status and vault size",
+)
+query_count = metrics.histogram(
+    "vault_db_queries",
+    "Database queries run by a request",
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500),
+)
+query_seconds = metrics.histogram(
+    "vault_db_query_seconds", "Time a request spent in database queries"
+)
+render_seconds = metrics.histogram(
+    "vault_render_seconds", "Time to render an API response body"
+)
+response_bytes = metrics.histogram(
+    "vault_response_bytes",
+    "Size of response bodies, including streamed ones",
+    buckets=tuple(4**i for i in range(3, 14)),
+)
+
+
+# The vault middleware runs in either mode of the handler: with a coroutine
+# get_response (ASGI) its __call__ returns a coroutine, so Django does not
+# move it to a thread per request.
+class HybridMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+
+# Returns the time the request waited for database connections in a
+# Server-Timing header: opening a new connection (or waiting for PgBouncer to
+# hand one out), or the health check of a persistent one. Both are timed by
+# the vault.db backends where Django does them, on the first query, so
+# requests that make none (/metrics, unmatched URLs) don't connect at all.
+class DatabaseConnectionMiddleware(HybridMiddleware):
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        waits = []
+        token = db.connection_waits.set(waits)
+        try:
+            response = self.get_response(request)
+        finally:
+            db.connection_waits.reset(token)
+        return self.add_timing(response, waits)
+
+    async def __acall__(self, request):
+        waits = []
+        token = db.connection_waits.set(waits)
+        try:
+            response = await self.get_response(request)
+        finally:
+            db.connection_waits.reset(token)
+        return self.add_timing(response, waits)
+
+    def add_timing(self, response, waits):
+        if waits and settings.VAULT_SERVER_TIMING:
+            response["Server-Timing"] = "db-connect;dur={:.1f}".format(
+                sum(waits) * 1000
+            )
+        return response
+
+
+# Tags the request's log records with an id (see vault.logs), taken from
+# X-Request-ID when a proxy in front already assigned one, and returns it in
+# the same header.
+class RequestIdMiddleware(HybridMiddleware):
+    VALID_ID = re.compile(r"[A-Za-z0-9._-]{1,64}")
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = logs.request_id.set(self.assign(request))
+        try:
+            response = self.get_response(request)
+        finally:
+            logs.request_id.reset(token)
+        response["X-Request-ID"] = request.id
+        return response
+
+    async def __acall__(self, request):
+        token = logs.request_id.set(self.assign(request))
+        try:
+            response = await self.get_response(request)
+        finally:
+            logs.request_id.reset(token)
+        response["X-Request-ID"] = request.id
+        return response
+
+    def assign(self, request):
+        request_id = request.headers.get("X-Request-ID", "")
+        if not self.VALID_ID.fullmatch(request_id):
+            request_id = uuid.uuid4().hex
+        request.id = request_id
+        return request_id
+
+
+VAULT_SIZE_BUCKETS = (10, 100, 1000, 10000)
+_vault_sizes = {}
+
+
+# The smallest of VAULT_SIZE_BUCKETS holding the user's entry count, or
+# "+Inf", counted at most once every VAULT_METRICS_SIZE_TTL seconds per user
+# and process.
+def VaultSize(user_id):
+    size = CachedVaultSize(user_id)
+    if size is not None:
+        return size
+    count = models.VaultEntry.objects.filter(user_id=user_id).count()
+    size = next((str(b) for b in VAULT_SIZE_BUCKETS if count <= b), "+Inf")
+    if len(_vault_sizes) >= 10000:
+        _vault_sizes.clear()
+    _vault_sizes[user_id] = (time.monotonic() + settings.VAULT_METRICS_SIZE_TTL, size)
+    return size
+
+
+def CachedVaultSize(user_id):
+    cached = _vault_sizes.get(user_id)
+    if cached is not None and cached[0] > time.monotonic():
+        return cached[1]
+    return None
+
+
+# Records, per view: latency (also by status and the user's vault size),
+# the number and duration of database queries, rendering time of API
+# responses and response size, for /metrics. Queries and bytes of a streamed
+# body are only partly covered: the bytes are counted as the body is sent,
+# queries made while streaming are not.
+class MetricsMiddleware(HybridMiddleware):
+    # Seconds between snapshots written to VAULT_METRICS_DIR
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.flushed = 0
+        if iscoroutinefunction(self):
+            self.process_template_response = self.aprocess_template_response
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        start = time.perf_counter()
+        queries = QueryRecorder()
+        token = db.request_queries.set(queries)
+        try:
+            response = self.get_response(request)
+        finally:
+            db.request_queries.reset(token)
+        elapsed = time.perf_counter() - start
+
+        user = getattr(request, "user", None)
+        size = VaultSize(user.id) if user and user.is_authenticated else "none"
+        self.record(request, response, elapsed, queries, size)
+        if self.flush_due():
+            metrics.write_snapshot(settings.VAULT_METRICS_DIR)
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        queries = QueryRecorder()
+        token = db.request_queries.set(queries)
+        try:
+            response = await self.get_response(request)
+        finally:
+            db.request_queries.reset(token)
+        elapsed = time.perf_counter() - start
+
+        # request.user of AuthenticationMiddleware loads the session user
+        # when first used, which only request.auser() may do here
+        user = getattr(request, "user", None)
+        if isinstance(user, SimpleLazyObject) and user._wrapped is empty:
+            user = await request.auser()
+        size = "none"
+        if user and user.is_authenticated:
+            size = CachedVaultSize(user.id) or await sync_to_async(VaultSize)(user.id)
+        self.record(request, response, elapsed, queries, size)
+        if self.flush_due():
+            await sync_to_async(metrics.write_snapshot, thread_sensitive=False)(
+                settings.VAULT_METRICS_DIR
+            )
+        return response
+
+    def record(self, request, response, elapsed, queries, size):
+        match = request.resolver_match
+        view = match.view_name if match else "unmatched"
+        labels = {"view": view, "method": request.method}
+        request_seconds.observe(
+            elapsed, status=response.status_code, vault_size=size, **labels
+        )
+        query_count.observe(queries.count, view=view)
+        query_seconds.observe(queries.seconds, view=view)
+        if response.streaming:
+            response.streaming_content = self.count_streamed(response, view)
+            return
+        response_bytes.observe(len(response.content), view=view)
+        timer = getattr(response, "render_timer", None)
+        if timer is not None:
+            render_seconds.observe(timer.seconds, view=view)
+
+    def flush_due(self):
+        if not settings.VAULT_METRICS_DIR:
+            return False
+        if time.monotonic() - self.flushed <= self.FLUSH_INTERVAL:
+            return False
+        self.flushed = time.monotonic()
+        return True
+
+    # Called after the view, right before a DRF Response is rendered. Other
+    # responses carry a render_timer (see vault.renderers.RenderTimer).
+    def process_template_response(self, request, response):
+        started = time.perf_counter()
+        view = request.resolver_match.view_name
+
+        def rendered(response):
+            render_seconds.observe(time.perf_counter() - started, view=view)
+
+        response.add_post_render_callback(rendered)
+        return response
+
+    async def aprocess_template_response(self, request, response):
+        return MetricsMiddleware.process_template_response(self, request, response)
+
+    # Streamed bodies are rendered as they are sent, so their size and
+    # rendering time are recorded once the stream ends
+    def count_streamed(self, response, view):
+        timer = getattr(response, "render_timer", None)
+
+        def done(total):
+            response_bytes.observe(total, view=view)
+            if timer is not None:
+                render_seconds.observe(timer.seconds, view=view)
+
+        if response.is_async:
+
+            async def counted(content):
+                total = 0
+                try:
+                    async for chunk in content:
+                        total += len(chunk)
+                        yield chunk
+                finally:
+                    done(total)
+
+        else:
+
+            def counted(content):
+                total = 0
+                try:
+                    for chunk in content:
+                        total += len(chunk)
+                        yield chunk
+                finally:
+                    done(total)
+
+        return counted(response.streaming_content)
+
+
+# Compresses the JSON and NDJSON responses of the vault and file endpoints
+# with the coding the client accepts that vault.compression prefers: bodies
+# of at least VAULT_COMPRESS_MIN_SIZE bytes whole, streamed ones chunk by
+# chunk as they are sent. File downloads are left as they are, since
+# ciphertext does not compress and Range requests address its stored bytes.
+# So are the account endpoints, so the tokens and secrets they return are
+# never compressed alongside request data (BREACH).
+class CompressionMiddleware(HybridMiddleware):
+    VIEWS = ("vault-", "file-")
+    CONTENT_TYPES = ("application/json", "application/x-ndjson")
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self.compress(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.compress(request, await self.get_response(request))
+
+    def compress(self, request, response):
+        match = request.resolver_match
+        content_type = response.get("Content-Type", "").partition(";")[0]
+        if (
+            match is None
+            or not match.view_name.startswith(self.VIEWS)
+            or content_type.strip() not in self.CONTENT_TYPES
+            or response.has_header("Content-Encoding")
+        ):
+            return response
+        patch_vary_headers(response, ["Accept-Encoding"])
+        encoding = compression.negotiate(request.headers.get("Accept-Encoding", ""))
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            response.streaming_content = self.compress_stream(response, encoding)
+            del response["Content-Length"]
+        else:
+            if len(response.content) < settings.VAULT_COMPRESS_MIN_SIZE:
+                return response
+            compressor = compression.compressor(encoding)
+            content = compressor.compress(response.content) + compressor.flush()
+            if len(content) >= len(response.content):
+                return response
+            response.content = content
+            response["Content-Length"] = str(len(content))
+        # The compressed body is a different byte sequence, so its ETag can
+        # only be weak (NotModified compares ETags weakly)
+        etag = response.get("ETag")
+        if etag and etag.startswith('"'):
+            response["ETag"] = "W/" + etag
+        response["Content-Encoding"] = encoding
+        return response
+
+    def compress_stream(self, response, encoding):
+        compressor = compression.compressor(encoding)
+        if response.is_async:
+
+            async def compressed(content):
+                async for chunk in content:
+                    data = compressor.compress(chunk)
+                    if data:
+                        yield data
+                yield compressor.flush()
+
+        else:
+
+            def compressed(content):
+                for chunk in content:
+                    data = compressor.compress(chunk)
+                    if data:
+                        yield data
+                yield compressor.flush()
+
+        return compressed(response.streaming_content)
@@ -0,0 +1,28 @@
+# Generated by Django 5.0.7 on 2026-10-18 18:45
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vault', '0013_alter_totpdevice_confirmed'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecoverySecret',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('secret_hash', models.CharField(max_length=128)),
+                ('password', models.CharField()),
+                ('iv', models.CharField()),
+                ('attempts', models.IntegerField(default=0)),
+                ('last_attempt', models.DateTimeField(null=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='recovery_secret', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+    ]
@@ -0,0 +1,167 @@
+from django.db import migrations, models
+
+
+# model -> (hex columns to convert, rows per chunk). File rows carry up to
+# 5MB of ciphertext each, so they are converted a few at a time.
+BINARY_FIELDS = {
+    "vaultentry": (("password", "iv"), 1000),
+    "fileentry": (("file", "iv"), 20),
+    "recoverysecret": (("password", "iv"), 1000),
+}
+
+
+def convert(apps, decode):
+    for model_name, (fields, chunk_size) in BINARY_FIELDS.items():
+        model = apps.get_model("vault", model_name)
+        columns = [column for field in fields for column in (field, field + "_bin")]
+        batch = []
+        for row in model.objects.only(*columns).iterator(chunk_size=chunk_size):
+            for field in fields:
+                decode(row, field)
+            batch.append(row)
+            if len(batch) >= chunk_size:
+                model.objects.bulk_update(batch, columns)
+                batch = []
+        if batch:
+            model.objects.bulk_update(batch, columns)
+
+
+def hex_to_binary(apps, schema_editor):
+    def decode(row, field):
+        setattr(row, field + "_bin", bytes.fromhex(getattr(row, field)))
+
+    convert(apps, decode)
+
+
+def binary_to_hex(apps, schema_editor):
+    def encode(row, field):
+        setattr(row, field, bytes(getattr(row, field + "_bin")).hex())
+
+    convert(apps, encode)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("vault", "0014_recoverysecret"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="vaultentry",
+            name="password_bin",
+            field=models.BinaryField(default=b""),
+        ),
+        migrations.AddField(
+            model_name="vaultentry",
+            name="iv_bin",
+            field=models.BinaryField(default=b""),
+        ),
+        migrations.AddField(
+            model_name="fileentry",
+            name="file_bin",
+            field=models.BinaryField(default=b""),
+        ),
+        migrations.AddField(
+            model_name="fileentry",
+            name="iv_bin",
+            field=models.BinaryField(default=b""),
+        ),
+        migrations.AddField(
+            model_name="recoverysecret",
+            name="password_bin",
+            field=models.BinaryField(default=b""),
+        ),
+        migrations.AddField(
+            model_name="recoverysecret",
+            name="iv_bin",
+            field=models.BinaryField(default=b""),
+        ),
+        # Relax the hex columns first so a rollback can re-add them before
+        # binary_to_hex refills them.
+        migrations.AlterField(
+            model_name="vaultentry",
+            name="password",
+            field=models.CharField(null=True),
+        ),
+        migrations.AlterField(
+            model_name="vaultentry",
+            name="iv",
+            field=models.CharField(null=True),
+        ),
+        migrations.AlterField(
+            model_name="fileentry",
+            name="file",
+            field=models.CharField(null=True),
+        ),
+        migrations.AlterField(
+            model_name="fileentry",
+            name="iv",
+            field=models.CharField(max_length=255, null=True),
+        ),
+        migrations.AlterField(
+            model_name="recoverysecret",
+            name="password",
+            field=models.CharField(null=True),
+        ),
+        migrations.AlterField(
+            model_name="recoverysecret",
+            name="iv",
+            field=models.CharField(null=True),
+        ),
+        migrations.RunPython(hex_to_binary, binary_to_hex),
+        migrations.RemoveField(model_name="vaultentry", name="password"),
+        migrations.RemoveField(model_name="vaultentry", name="iv"),
+        migrations.RemoveField(model_name="fileentry", name="file"),
+        migrations.RemoveField(model_name="fileentry", name="iv"),
+        migrations.RemoveField(model_name="recoverysecret", name="password"),
+        migrations.RemoveField(model_name="recoverysecret", name="iv"),
+        migrations.RenameField(
+            model_name="vaultentry", old_name="password_bin", new_name="password"
+        ),
+        migrations.RenameField(
+            model_name="vaultentry", old_name="iv_bin", new_name="iv"
+        ),
+        migrations.RenameField(
+            model_name="fileentry", old_name="file_bin", new_name="file"
+        ),
+        migrations.RenameField(
+            model_name="fileentry", old_name="iv_bin", new_name="iv"
+        ),
+        migrations.RenameField(
+            model_name="recoverysecret", old_name="password_bin", new_name="password"
+        ),
+        migrations.RenameField(
+            model_name="recoverysecret", old_name="iv_bin", new_name="iv"
+        ),
+        migrations.AlterField(
+            model_name="vaultentry",
+            name="password",
+            field=models.BinaryField(),
+        ),
+        migrations.AlterField(
+            model_name="vaultentry",
+            name="iv",
+            field=models.BinaryField(),
+        ),
+        migrations.AlterField(
+            model_name="fileentry",
+            name="file",
+            field=models.BinaryField(),
+        ),
+        migrations.AlterField(
+            model_name="fileentry",
+            name="iv",
+            field=models.BinaryField(max_length=255),
+        ),
+        migrations.AlterField(
+            model_name="recoverysecret",
+            name="password",
+            field=models.BinaryField(),
+        ),
+        migrations.AlterField(
+            model_name="recoverysecret",
+            name="iv",
+            field=models.BinaryField(),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.0.7 on 2026-10-18 18:45
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vault', '0015_binary_ciphertext_fields'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FileUpload',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=255)),
+                ('iv', models.BinaryField(max_length=255)),
+                ('size', models.BigIntegerField()),
+                ('offset', models.BigIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('VaultEntry', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='uploads', to='vault.vaultentry')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='FileUploadPart',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('offset', models.BigIntegerField()),
+                ('data', models.BinaryField()),
+                ('upload', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='parts', to='vault.fileupload')),
+            ],
+            options={
+                'ordering': ['offset'],
+            },
+        ),
+    ]
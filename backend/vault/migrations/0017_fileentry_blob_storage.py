@@ -0,0 +1,35 @@
+# Generated by Django 5.0.7 on 2026-10-18 18:46
+
+from django.db import migrations, models
+from django.db.models.functions import Length
+
+
+def fill_sizes(apps, schema_editor):
+    fileEntry = apps.get_model("vault", "fileEntry")
+    fileEntry.objects.update(size=Length("file"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('vault', '0016_fileupload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fileentry',
+            name='blob',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='fileentry',
+            name='size',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='fileentry',
+            name='file',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.RunPython(fill_sizes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,101 @@
+# Generated by Django 5.0.7 on 2026-10-18 18:48
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("vault", "0017_fileentry_blob_storage"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Tombstone",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[("entry", "Entry"), ("file", "File")], max_length=8
+                    ),
+                ),
+                ("object_id", models.BigIntegerField()),
+                ("revision", models.BigIntegerField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name="VaultRevision",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("revision", models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="fileentry",
+            name="revision",
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="fileentry",
+            name="updated_at",
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name="vaultentry",
+            name="revision",
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="vaultentry",
+            name="updated_at",
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name="vaultentry",
+            index=models.Index(
+                fields=["user", "revision"], name="vault_vault_user_id_2de37a_idx"
+            ),
+        ),
+        migrations.AddField(
+            model_name="tombstone",
+            name="user",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL
+            ),
+        ),
+        migrations.AddField(
+            model_name="vaultrevision",
+            name="user",
+            field=models.OneToOneField(
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="vault_revision",
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="tombstone",
+            index=models.Index(
+                fields=["user", "revision"], name="vault_tombs_user_id_dc414e_idx"
+            ),
+        ),
+    ]
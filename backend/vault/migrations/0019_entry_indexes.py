@@ -0,0 +1,86 @@
+# Generated by Django 5.0.7 on 2026-10-18 19:02
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+# Keeps the oldest entry of each (user, name) pair and renames the others to
+# "name (2)", "name (3)", ... so the unique constraint can be added without
+# losing data. Renamed entries get a new revision so clients pick them up on
+# their next sync.
+def rename_duplicates(apps, schema_editor):
+    VaultEntry = apps.get_model("vault", "VaultEntry")
+    VaultRevision = apps.get_model("vault", "VaultRevision")
+    duplicates = list(
+        VaultEntry.objects.values("user_id", "name")
+        .annotate(count=Count("id"))
+        .filter(count__gt=1)
+    )
+    for duplicate in duplicates:
+        user_id, name = duplicate["user_id"], duplicate["name"]
+        taken = set(
+            VaultEntry.objects.filter(user_id=user_id).values_list("name", flat=True)
+        )
+        revision, _ = VaultRevision.objects.get_or_create(user_id=user_id)
+        revision.revision += 1
+        revision.save()
+        entries = VaultEntry.objects.filter(user_id=user_id, name=name).order_by("id")
+        n = 2
+        for entry in entries[1:]:
+            while True:
+                suffix = " ({})".format(n)
+                candidate = name[: 255 - len(suffix)] + suffix
+                n += 1
+                if candidate not in taken:
+                    break
+            taken.add(candidate)
+            entry.name = candidate
+            entry.revision = revision.revision
+            entry.save(update_fields=["name", "revision"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("vault", "0018_vault_revisions"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="fileentry",
+            name="VaultEntry",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="files",
+                to="vault.vaultentry",
+            ),
+        ),
+        migrations.AlterField(
+            model_name="vaultentry",
+            name="user",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                to=settings.AUTH_USER_MODEL,
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="fileentry",
+            index=models.Index(
+                fields=["VaultEntry"],
+                include=("id", "blob", "size"),
+                name="vault_file_entry_covering",
+            ),
+        ),
+        migrations.RunPython(rename_duplicates, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name="vaultentry",
+            constraint=models.UniqueConstraint(
+                fields=("user", "name"), name="vault_entry_unique_user_name"
+            ),
+        ),
+    ]
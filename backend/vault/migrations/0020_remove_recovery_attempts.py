@@ -0,0 +1,21 @@
+# Generated by Django 5.0.7 on 2026-10-18 19:36
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("vault", "0019_entry_indexes"),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name="recoverysecret",
+            name="attempts",
+        ),
+        migrations.RemoveField(
+            model_name="recoverysecret",
+            name="last_attempt",
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.0.7 on 2026-10-18 21:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("vault", "0021_blob"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ThrottleWindow",
+            fields=[
+                (
+                    "key",
+                    models.CharField(max_length=255, primary_key=True, serialize=False),
+                ),
+                ("hits", models.JSONField(default=list)),
+                ("expires", models.FloatField(db_index=True)),
+            ],
+        ),
+    ]
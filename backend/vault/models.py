@@ -1,10 +1,15 @@
-from django.contrib.auth.hashers import make_password, check_password
+from django.conf import settings
 from django.contrib.postgres.fields import ArrayField
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth import get_user_model
+from django.utils import timezone
 from django_otp.models import Device
 from encrypted_model_fields.fields import EncryptedCharField
+from vault import hashing
+from vault.storage import get_storage
+import datetime
 import os
+import uuid
 
 User = get_user_model()
 
@@ -18,17 +23,15 @@ class RecoverySecret(models.Model):
         User, on_delete=models.CASCADE, related_name="recovery_secret"
     )
     secret_hash = models.CharField(max_length=128)
-    password = models.CharField()
-    iv = models.CharField()
-    attempts = models.IntegerField(default=0)
-    last_attempt = models.DateTimeField(null=True)
+    password = models.BinaryField()
+    iv = models.BinaryField()
 
     def set_secret(self, raw_secret):
-        self.secret_hash = make_password(raw_secret)
+        self.secret_hash = hashing.make_password(raw_secret)
         self.save()
 
     def check_secret(self, raw_secret):
-        return check_password(raw_secret, self.secret_hash)
+        return hashing.check_password(raw_secret, self.secret_hash)
 
     def __str__(self):
         return self.user.username
@@ -42,12 +45,59 @@ class ClientKeyDerivationSalt(models.Model):
         return self.user.username
 
 
+# Every change to a user's vault takes the next value of their revision
+# counter and stamps it on the rows it writes (or on a Tombstone for
+# deletions). Clients keep the highest revision they have seen as a cursor
+# for vault/sync.
+class VaultRevision(models.Model):
+    user = models.OneToOneField(
+        User, on_delete=models.CASCADE, related_name="vault_revision"
+    )
+    revision = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return "{}: {}".format(self.user.username, self.revision)
+
+
+# Must be called inside the transaction that writes the change: the row lock
+# is held until commit, so revisions become visible in increasing order and a
+# client never skips a change by syncing between two concurrent writers.
+def bump_revision(user):
+    with transaction.atomic():
+        revision, _ = VaultRevision.objects.select_for_update().get_or_create(
+            user_id=user.id
+        )
+        revision.revision += 1
+        revision.save(update_fields=["revision"])
+    return revision.revision
+
+
+def current_revision(user):
+    return (
+        VaultRevision.objects.filter(user_id=user.id)
+        .values_list("revision", flat=True)
+        .first()
+        or 0
+    )
+
+
 class VaultEntry(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    # Indexed through the (user, ...) constraint and index below
+    user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=False)
     name = models.CharField(max_length=255, null=False)
     username = models.CharField(max_length=255)
-    password = models.CharField(null=False)
-    iv = models.CharField(null=False)
+    password = models.BinaryField(null=False)
+    iv = models.BinaryField(null=False)
+    revision = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user", "name"], name="vault_entry_unique_user_name"
+            )
+        ]
+        indexes = [models.Index(fields=["user", "revision"])]
 
     def __str__(self):
         return "{}: {}".format(self.user.username, self.id)
@@ -61,11 +111,168 @@ class TOTPDevice(Device):
 
 class fileEntry(models.Model):
     VaultEntry = models.ForeignKey(
-        VaultEntry, on_delete=models.CASCADE, related_name="files"
+        VaultEntry, on_delete=models.CASCADE, related_name="files", db_index=False
     )
-    file = models.CharField(null=False)
+    # Ciphertext is kept inline in file unless VAULT_BLOB_STORAGE is set, in
+    # which case blob holds its storage key and file is null.
+    file = models.BinaryField(null=True)
+    blob = models.CharField(max_length=64, null=True, blank=True)
+    size = models.BigIntegerField(default=0)
     name = models.CharField(max_length=255, null=False)
-    iv = models.CharField(max_length=255, null=False)
+    iv = models.BinaryField(max_length=255, null=False)
+    revision = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    # Covers the ownership and blob lookups made for a vault's files, so
+    # they are answered from the index without touching the heap.
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["VaultEntry"],
+                include=["id", "blob", "size"],
+                name="vault_file_entry_covering",
+            )
+        ]
 
     def __str__(self):
         return "{}: {}".format(self.VaultEntry.user.username, self.name)
+
+    # With blob storage this must run inside the transaction that saves the
+    # row: the blob's lock is held until then, so a concurrent release_blobs
+    # cannot delete it before the row referencing it is committed.
+    def write(self, data):
+        storage = get_storage()
+        if self.blob:
+            self._replaced_blob = self.blob
+        if storage is None:
+            self.file, self.blob = data, None
+        else:
+            key = storage.key_for(data)
+            lock_blobs([key])
+            self.file, self.blob = None, storage.save(data)
+        self.size = len(data)
+
+    def iter_chunks(self, start=0, stop=None):
+        if self.blob:
+            return get_storage().iter_chunks(self.blob, start, stop)
+        data = memoryview(self.file)[start:stop]
+        return (
+            bytes(data[offset : offset + 64 * 1024])
+            for offset in range(0, len(data), 64 * 1024)
+        )
+
+    def save(self, *args, **kwargs):
+        if self.__dict__.get("file") is not None:
+            self.size = len(self.file)
+        super().save(*args, **kwargs)
+        replaced = self.__dict__.pop("_replaced_blob", None)
+        if replaced and replaced != self.blob:
+            release_blobs([replaced])
+
+
+# One row per key in blob storage, locked by whoever is about to write or
+# delete the blob. Rows are created on first use and removed with the blob.
+class Blob(models.Model):
+    key = models.CharField(max_length=64, primary_key=True)
+
+
+# Sliding-window log of one rate limit key for throttling.DatabaseStore: the
+# times of the hits allowed in the current window, and when the row can go.
+class ThrottleWindow(models.Model):
+    key = models.CharField(max_length=255, primary_key=True)
+    hits = models.JSONField(default=list)
+    expires = models.FloatField(db_index=True)
+
+
+# Locks the Blob rows of keys until the surrounding transaction ends,
+# creating them if needed. Keys are locked in order, so two callers cannot
+# deadlock, and a row deleted by release_blobs while this waited for its
+# lock is created again.
+def lock_blobs(keys):
+    keys = sorted(set(keys))
+    while True:
+        Blob.objects.bulk_create([Blob(key=key) for key in keys], ignore_conflicts=True)
+        locked = (
+            Blob.objects.select_for_update()
+            .filter(key__in=keys)
+            .order_by("key")
+            .values_list("key", flat=True)
+        )
+        if len(locked) == len(keys):
+            return
+
+
+# Deletes blobs from storage once the surrounding transaction commits and no
+# fileEntry refers to them any more. Callers deleting fileEntry rows collect
+# their blob keys first, since a post_delete hook would force Django to load
+# every row (ciphertext included) on cascading deletes.
+def release_blobs(keys):
+    keys = {key for key in keys if key}
+    if keys:
+        transaction.on_commit(lambda: delete_unreferenced(keys))
+
+
+# References are checked with the blobs locked, so a writer that stored one
+# of keys but has not committed its row yet is waited for rather than missed.
+# Returns the keys deleted.
+def delete_unreferenced(keys):
+    storage = get_storage()
+    with transaction.atomic():
+        lock_blobs(keys)
+        unused = set(keys) - set(
+            fileEntry.objects.filter(blob__in=keys).values_list("blob", flat=True)
+        )
+        for key in unused:
+            storage.delete(key)
+        Blob.objects.filter(key__in=unused).delete()
+    return unused
+
+
+# Records a deleted entry or file so vault/sync can report it
+class Tombstone(models.Model):
+    ENTRY = "entry"
+    FILE = "file"
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=8, choices=[(ENTRY, "Entry"), (FILE, "File")])
+    object_id = models.BigIntegerField()
+    revision = models.BigIntegerField()
+
+    class Meta:
+        indexes = [models.Index(fields=["user", "revision"])]
+
+
+# A resumable upload in progress. Parts are appended in order by
+# vault/files/uploads/<id> and joined into a fileEntry once size bytes
+# have arrived. Parts stay in the database rather than blob storage: blobs
+# are keyed by the hash of a whole file, and a file is at most
+# VAULT_MAX_FILE_SIZE bytes.
+class FileUpload(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    VaultEntry = models.ForeignKey(
+        VaultEntry, on_delete=models.CASCADE, related_name="uploads"
+    )
+    name = models.CharField(max_length=255, null=False)
+    iv = models.BinaryField(max_length=255, null=False)
+    size = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return "{}: {}".format(self.VaultEntry.user.username, self.name)
+
+    # Uploads created before this time have expired
+    @staticmethod
+    def cutoff():
+        return timezone.now() - datetime.timedelta(seconds=settings.VAULT_UPLOAD_TTL)
+
+
+class FileUploadPart(models.Model):
+    upload = models.ForeignKey(
+        FileUpload, on_delete=models.CASCADE, related_name="parts"
+    )
+    offset = models.BigIntegerField()
+    data = models.BinaryField()
+
+    class Meta:
+        ordering = ["offset"]
@@ -0,0 +1,119 @@
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from vault import compression
+import codecs
+import io
+import math
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Drop-in replacements for DRF's JSON renderer and parser backed by orjson.
+# Without orjson installed, or for requests orjson cannot serve (indented
+# output, non UTF-8 bodies), they behave exactly like the classes they
+# extend. Datetimes go through DRF's JSONEncoder as they would there (orjson
+# writes UTC as +00:00 rather than Z); orjson's own UUID, date and time
+# output already matches it. Data orjson rejects (integers wider than 64
+# bits) or writes differently (NaN and infinities as null, which DRF
+# refuses) is rendered by JSONRenderer.
+class ORJSONRenderer(JSONRenderer):
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None:
+            return super().render(data, accepted_media_type, renderer_context)
+        if self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(
+                data,
+                default=self.encoder_class().default,
+                option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS,
+            )
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        if b"null" in ret and non_finite(data):
+            return super().render(data, accepted_media_type, renderer_context)
+        # Same escaping as JSONRenderer so output stays a JavaScript subset
+        return ret.replace(b"\xe2\x80\xa8", b"\\u2028").replace(
+            b"\xe2\x80\xa9", b"\\u2029"
+        )
+
+
+# Wraps a render function, adding up the time spent in it, for responses
+# DRF does not render itself: those of the async views and NDJSON streams.
+# MetricsMiddleware records it from the response's render_timer.
+class RenderTimer:
+    def __init__(self, render):
+        self.render = render
+        self.seconds = 0.0
+
+    def __call__(self, data):
+        started = time.perf_counter()
+        try:
+            return self.render(data)
+        finally:
+            self.seconds += time.perf_counter() - started
+
+
+# Whether there is a NaN or infinite float anywhere in data
+def non_finite(data):
+    if isinstance(data, float):
+        return not math.isfinite(data)
+    if isinstance(data, dict):
+        return any(non_finite(k) or non_finite(v) for k, v in data.items())
+    if isinstance(data, (list, tuple)):
+        return any(non_finite(v) for v in data)
+    return False
+
+
+class ORJSONParser(JSONParser):
+    renderer_class = ORJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        encoding = (parser_context or {}).get("encoding", "utf-8")
+        if orjson is None or codecs.lookup(encoding).name != "utf-8":
+            return super().parse(stream, media_type, parser_context)
+        try:
+            return orjson.loads(stream.read())
+        except orjson.JSONDecodeError as exc:
+            raise ParseError("JSON parse error - %s" % str(exc))
+
+
+# ORJSONParser that also takes bodies sent with a Content-Encoding (gzip, or
+# zstd with zstandard installed), decompressed up to
+# VAULT_MAX_DECOMPRESSED_SIZE bytes. For the endpoints receiving large
+# bodies; see vault/compression.py.
+class CompressedJSONParser(ORJSONParser):
+    def parse(self, stream, media_type=None, parser_context=None):
+        request = (parser_context or {}).get("request")
+        encoding = "identity"
+        if request is not None:
+            encoding = request.headers.get("Content-Encoding", "identity")
+        if encoding.strip().lower() != "identity":
+            stream = io.BytesIO(
+                compression.decompress(
+                    stream, encoding, settings.VAULT_MAX_DECOMPRESSED_SIZE
+                )
+            )
+        return super().parse(stream, media_type, parser_context)
+
+
+# Newline-delimited JSON: one document per line. vault/retrieve streams
+# entries in this format itself (see StreamEntries); this renders the
+# responses it does not stream, such as errors.
+class NDJSONRenderer(ORJSONRenderer):
+    media_type = "application/x-ndjson"
+    format = "ndjson"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        lines = []
+        for item in data if isinstance(data, list) else [data]:
+            lines.append(super().render(item) + b"\n")
+        return b"".join(lines)
@@ -0,0 +1,201 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+import abc
+import functools
+import hashlib
+import os
+import tempfile
+
+CHUNK_SIZE = 64 * 1024
+
+
+# Encrypted attachments are stored under the sha256 of their ciphertext, so
+# identical blobs are stored once and keys never need to be generated or
+# tracked separately. A key can be shared by several fileEntry rows, so blobs
+# are only written and deleted under the lock of their models.Blob row (see
+# fileEntry.write and models.release_blobs).
+class BlobStorage(abc.ABC):
+    @abc.abstractmethod
+    def save(self, data):
+        pass
+
+    @abc.abstractmethod
+    def iter_chunks(self, key, start=0, stop=None, chunk_size=CHUNK_SIZE):
+        pass
+
+    @abc.abstractmethod
+    def delete(self, key):
+        pass
+
+    @abc.abstractmethod
+    def exists(self, key):
+        pass
+
+    # Every stored key, in no particular order
+    @abc.abstractmethod
+    def keys(self):
+        pass
+
+    def key_for(self, data):
+        return hashlib.sha256(data).hexdigest()
+
+
+class FileSystemStorage(BlobStorage):
+    def __init__(self, location):
+        self.location = os.fspath(location)
+
+    # Sharded as ab/cd/abcd... so no directory grows past 65536 entries
+    def path(self, key):
+        return os.path.join(self.location, key[:2], key[2:4], key)
+
+    def save(self, data):
+        key = self.key_for(data)
+        path = self.path(key)
+        if os.path.exists(path):
+            return key
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write under a temporary name and rename so readers never see a
+        # partially written blob.
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        return key
+
+    def iter_chunks(self, key, start=0, stop=None, chunk_size=CHUNK_SIZE):
+        with open(self.path(key), "rb") as f:
+            f.seek(start)
+            remaining = None if stop is None else stop - start
+            while remaining is None or remaining > 0:
+                size = chunk_size if remaining is None else min(chunk_size, remaining)
+                chunk = f.read(size)
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def delete(self, key):
+        try:
+            os.unlink(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def keys(self):
+        for _, _, names in os.walk(self.location):
+            for name in names:
+                if not name.startswith(".tmp-"):
+                    yield name
+
+
+# Works with AWS S3 and S3-compatible servers (MinIO, Ceph, R2) through
+# boto3, or any object exposing the same put/get/head/delete_object calls.
+class S3Storage(BlobStorage):
+    def __init__(
+        self,
+        bucket,
+        prefix="",
+        endpoint_url=None,
+        region_name=None,
+        access_key=None,
+        secret_key=None,
+        client=None,
+    ):
+        if client is None:
+            try:
+                import boto3
+            except ImportError:
+                raise ImproperlyConfigured("S3Storage requires the boto3 package")
+
+            client = boto3.client(
+                "s3",
+                endpoint_url=endpoint_url,
+                region_name=region_name,
+                aws_access_key_id=access_key,
+                aws_secret_access_key=secret_key,
+            )
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def object_key(self, key):
+        return "{}{}/{}/{}".format(self.prefix, key[:2], key[2:4], key)
+
+    def save(self, data):
+        key = self.key_for(data)
+        if not self.exists(key):
+            self.client.put_object(
+                Bucket=self.bucket,
+                Key=self.object_key(key),
+                Body=data,
+                ContentType="application/octet-stream",
+            )
+        return key
+
+    def iter_chunks(self, key, start=0, stop=None, chunk_size=CHUNK_SIZE):
+        params = {"Bucket": self.bucket, "Key": self.object_key(key)}
+        if start or stop is not None:
+            end = "" if stop is None else stop - 1
+            params["Range"] = "bytes={}-{}".format(start, end)
+        body = self.client.get_object(**params)["Body"]
+        try:
+            while True:
+                chunk = body.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            body.close()
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.object_key(key))
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.object_key(key))
+        except Exception as e:
+            status = getattr(e, "response", {}).get("Error", {}).get("Code")
+            if status in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+        return True
+
+    def keys(self):
+        params = {"Bucket": self.bucket, "Prefix": self.prefix}
+        while True:
+            page = self.client.list_objects_v2(**params)
+            for item in page.get("Contents", []):
+                yield item["Key"].rsplit("/", 1)[-1]
+            if not page.get("IsTruncated"):
+                break
+            params["ContinuationToken"] = page["NextContinuationToken"]
+
+
+# Returns the configured backend, or None when blobs are kept inline in
+# fileEntry.file. Built once at startup by VaultConfig.ready, so a missing
+# dependency or bad option fails there rather than on the first upload.
+@functools.lru_cache(maxsize=None)
+def get_storage():
+    config = settings.VAULT_BLOB_STORAGE
+    if not config:
+        return None
+    return import_string(config["BACKEND"])(**config.get("OPTIONS", {}))
+
+
+@receiver(setting_changed)
+def reset_storage(setting, **kwargs):
+    if setting == "VAULT_BLOB_STORAGE":
+        get_storage.cache_clear()
@@ -1,3 +1,2121 @@
-from django.test import TestCase
+from asgiref.sync import async_to_sync, iscoroutinefunction
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth import authenticate, hashers
+from django.core.handlers.base import BaseHandler
+from django.core.management import call_command
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.test import (
+    AsyncClient,
+    AsyncRequestFactory,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.urls import clear_url_caches, resolve
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
 
-# Create your tests here.
+from vault import (
+    async_views,
+    authentication,
+    compression,
+    hashing,
+    logs,
+    metrics,
+    middleware,
+    models,
+    renderers,
+    throttling,
+    urls,
+)
+from vault import db as vault_db
+from vault.codec import FromBytes, ToBytes
+from vault.views import BYTE_ENCODINGS, ByteEncoding
+from vault.storage import BlobStorage, FileSystemStorage, S3Storage
+import backend.urls
+import datetime
+import gzip
+import importlib
+import io
+import json
+import logging
+import math
+import os
+import pyotp
+import tempfile
+import threading
+import unittest
+import uuid
+from unittest import mock
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+
+def create_entries(user, count, files_per_entry=0, start=0):
+    for i in range(start, start + count):
+        entry = models.VaultEntry.objects.create(
+            user=user,
+            name="entry-{}".format(i),
+            username="user-{}".format(i),
+            password=b"\x00\x01\x02",
+            iv=b"\x03" * 12,
+        )
+        for j in range(files_per_entry):
+            models.fileEntry.objects.create(
+                VaultEntry=entry,
+                name="file-{}.txt".format(j),
+                file=b"\x04" * 32,
+                iv=b"\x05" * 12,
+            )
+
+
+# The body of a response, reading a streamed one to the end whether the view
+# streamed it from a sync or an async iterator
+def read_body(response):
+    if not response.streaming:
+        return response.content
+    if response.is_async:
+
+        async def read():
+            return b"".join([chunk async for chunk in response.streaming_content])
+
+        return async_to_sync(read)()
+    return b"".join(response.streaming_content)
+
+
+# vault.urls routes to the async views when VAULT_ASYNC_VIEWS is set, as it
+# is under ASGI, which it reads once on import
+def reload_urls():
+    importlib.reload(urls)
+    importlib.reload(backend.urls)
+    clear_url_caches()
+
+
+# Runs the tests of a view test class against the async views; decorate the
+# subclass with override_settings(VAULT_ASYNC_VIEWS=True)
+class AsyncViewsMixin:
+    @classmethod
+    def setUpClass(cls):
+        # Registered first so it runs after the settings are restored
+        cls.addClassCleanup(reload_urls)
+        super().setUpClass()
+        reload_urls()
+
+    def test_routes_async_views(self):
+        match = resolve("/api/vault/retrieve")
+        self.assertIs(match.func.view_class, async_views.AsyncVaultRetrieve)
+
+
+class VaultTestCase(TestCase):
+    def setUp(self):
+        throttling.get_store.cache_clear()
+        self.user = models.User.objects.create_user(username="alice", password="pw")
+        # The metrics vault size of the user is counted here rather than by
+        # the first request of each test
+        middleware._vault_sizes.clear()
+        middleware.VaultSize(self.user.id)
+        self.client = APIClient()
+        self.client.credentials(
+            HTTP_AUTHORIZATION="Bearer {}".format(AccessToken.for_user(self.user))
+        )
+
+    # Makes the request, reading a streamed body to the end, and fails if it
+    # ran more than `queries` SQL queries or returned more than `size` bytes
+    def assertWithinBudget(self, request, queries, size):
+        with CaptureQueriesContext(connection) as captured:
+            response = request()
+            body = read_body(response)
+        self.assertLess(response.status_code, 300, body[:200])
+        self.assertLessEqual(
+            len(captured),
+            queries,
+            "\n".join(q["sql"][:200] for q in captured.captured_queries),
+        )
+        self.assertLessEqual(len(body), size)
+        return response
+
+
+class VaultRetrieveTests(VaultTestCase):
+    def retrieve_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/vault/retrieve")
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_legacy_byte_dicts(self):
+        create_entries(self.user, 1, files_per_entry=1)
+        response, _ = self.retrieve_queries()
+        entry = response.json()[0]
+        self.assertEqual(entry["password"], {"0": 0, "1": 1, "2": 2})
+        self.assertEqual(entry["files"][0]["iv"], {str(i): 5 for i in range(12)})
+
+    def test_files_listed_without_contents(self):
+        create_entries(self.user, 1, files_per_entry=1)
+        response, _ = self.retrieve_queries()
+        file = response.json()[0]["files"][0]
+        self.assertEqual(file["size"], 32)
+        self.assertEqual(file["name"], "file-0.txt")
+        self.assertNotIn("file", file)
+
+    def test_base64_byte_strings(self):
+        create_entries(self.user, 1, files_per_entry=1)
+        response = self.client.get(
+            "/api/vault/retrieve", HTTP_ACCEPT="application/json; bytes=base64"
+        )
+        entry = response.json()[0]
+        self.assertEqual(entry["password"], "AAEC")
+        self.assertEqual(entry["files"][0]["iv"], "BQUFBQUFBQUFBQUF")
+
+    def test_query_count_does_not_grow_with_vault(self):
+        create_entries(self.user, 2, files_per_entry=1)
+        _, small = self.retrieve_queries()
+        create_entries(self.user, 50, files_per_entry=2, start=2)
+        response, large = self.retrieve_queries()
+        self.assertEqual(len(response.json()), 52)
+        self.assertEqual(small, large)
+
+    def test_keyset_pages(self):
+        create_entries(self.user, 5, files_per_entry=1)
+        names, after = [], 0
+        while after is not None:
+            response = self.client.get(
+                "/api/vault/retrieve", {"after": after, "limit": 2}
+            )
+            self.assertEqual(response.status_code, 200)
+            page = response.json()
+            self.assertLessEqual(len(page["entries"]), 2)
+            names += [entry["name"] for entry in page["entries"]]
+            after = page["next"]
+        self.assertEqual(names, ["entry-{}".format(i) for i in range(5)])
+
+    def test_invalid_page(self):
+        for params in ({"limit": 0}, {"limit": "x"}, {"after": "x", "limit": 1}):
+            response = self.client.get("/api/vault/retrieve", params)
+            self.assertEqual(response.status_code, 400)
+
+    @override_settings(VAULT_RETRIEVE_PAGE_SIZE=2)
+    def test_ndjson_stream(self):
+        create_entries(self.user, 5, files_per_entry=1)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                "/api/vault/retrieve",
+                HTTP_ACCEPT="application/x-ndjson; bytes=base64",
+            )
+            body = read_body(response)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        lines = [json.loads(line) for line in body.splitlines()]
+        self.assertEqual(
+            [entry["name"] for entry in lines],
+            ["entry-{}".format(i) for i in range(5)],
+        )
+        self.assertEqual(lines[0]["password"], "AAEC")
+        # Three pages of entries, each with its files prefetched
+        self.assertEqual(
+            sum('"vault_vaultentry"' in q["sql"] for q in queries.captured_queries),
+            3,
+        )
+
+
+@override_settings(VAULT_ASYNC_VIEWS=True)
+class AsyncVaultRetrieveTests(AsyncViewsMixin, VaultRetrieveTests):
+    pass
+
+
+class FileDownloadTests(VaultTestCase):
+    def setUp(self):
+        super().setUp()
+        entry = models.VaultEntry.objects.create(
+            user=self.user, name="entry", username="", password=b"", iv=b""
+        )
+        self.file = models.fileEntry.objects.create(
+            VaultEntry=entry, name="a.txt", file=bytes(range(200)), iv=b"\x00"
+        )
+        self.url = "/api/vault/files/{}".format(self.file.id)
+
+    def test_full_download(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Length"], "200")
+        self.assertEqual(read_body(response), bytes(range(200)))
+
+    def test_range_requests(self):
+        for header, expected, content_range in [
+            ("bytes=10-19", bytes(range(10, 20)), "bytes 10-19/200"),
+            ("bytes=190-", bytes(range(190, 200)), "bytes 190-199/200"),
+            ("bytes=-5", bytes(range(195, 200)), "bytes 195-199/200"),
+            ("bytes=150-999", bytes(range(150, 200)), "bytes 150-199/200"),
+        ]:
+            response = self.client.get(self.url, HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response["Content-Range"], content_range)
+            self.assertEqual(read_body(response), expected)
+
+    def test_unsatisfiable_range(self):
+        response = self.client.get(self.url, HTTP_RANGE="bytes=200-")
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], "bytes */200")
+
+    def test_other_users_file(self):
+        other = models.User.objects.create_user(username="mallory", password="pw")
+        self.client.credentials(
+            HTTP_AUTHORIZATION="Bearer {}".format(AccessToken.for_user(other))
+        )
+        self.assertEqual(self.client.get(self.url).status_code, 401)
+
+
+@override_settings(VAULT_ASYNC_VIEWS=True)
+class AsyncFileDownloadTests(AsyncViewsMixin, FileDownloadTests):
+    pass
+
+
+@override_settings(VAULT_MAX_FILE_SIZE=100, VAULT_UPLOAD_CHUNK_SIZE=40)
+class FileUploadTests(VaultTestCase):
+    def setUp(self):
+        super().setUp()
+        self.entry = models.VaultEntry.objects.create(
+            user=self.user, name="entry", username="", password=b"", iv=b""
+        )
+
+    def start(self, size):
+        return self.client.post(
+            "/api/vault/files/uploads",
+            {"id": self.entry.id, "name": "a.txt", "iv": "AAAA", "size": size},
+            format="json",
+        )
+
+    def put(self, upload, offset, data):
+        return self.client.put(
+            "/api/vault/files/uploads/{}".format(upload),
+            data,
+            content_type="application/octet-stream",
+            HTTP_UPLOAD_OFFSET=str(offset),
+        )
+
+    def test_chunked_upload(self):
+        payload = bytes(range(90))
+        upload = self.start(len(payload)).json()["upload"]
+        self.assertEqual(self.put(upload, 0, payload[:40]).json()["offset"], 40)
+        self.assertEqual(self.put(upload, 40, payload[40:80]).json()["offset"], 80)
+        status = self.client.get("/api/vault/files/uploads/{}".format(upload))
+        self.assertEqual(status.json(), {"offset": 80, "size": 90})
+        response = self.put(upload, 80, payload[80:])
+        self.assertEqual(response.status_code, 200)
+        file = models.fileEntry.objects.get(id=response.json()["id"])
+        self.assertEqual(bytes(file.file), payload)
+        self.assertFalse(models.FileUpload.objects.exists())
+
+    def test_offset_mismatch(self):
+        upload = self.start(50).json()["upload"]
+        self.put(upload, 0, b"x" * 10)
+        response = self.put(upload, 0, b"x" * 10)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()["offset"], 10)
+
+    def test_size_limits(self):
+        self.assertEqual(self.start(101).status_code, 413)
+        upload = self.start(60).json()["upload"]
+        self.assertEqual(self.put(upload, 0, b"x" * 41).status_code, 413)
+        self.put(upload, 0, b"x" * 40)
+        self.assertEqual(self.put(upload, 40, b"x" * 21).status_code, 413)
+
+    def expire(self, upload):
+        models.FileUpload.objects.filter(id=upload).update(
+            created_at=timezone.now()
+            - datetime.timedelta(seconds=settings.VAULT_UPLOAD_TTL + 1)
+        )
+
+    def test_expired_upload(self):
+        upload = self.start(50).json()["upload"]
+        self.put(upload, 0, b"x" * 10)
+        self.expire(upload)
+        self.assertEqual(self.put(upload, 10, b"x" * 10).status_code, 404)
+        out = io.StringIO()
+        call_command("expire_uploads", "--dry-run", stdout=out)
+        self.assertIn("1 uploads would be deleted", out.getvalue())
+        call_command("expire_uploads", stdout=out)
+        self.assertIn("Deleted 1 uploads", out.getvalue())
+        self.assertFalse(models.FileUploadPart.objects.exists())
+
+    @override_settings(VAULT_MAX_OPEN_UPLOADS=2)
+    def test_open_upload_limit(self):
+        first = self.start(50).json()["upload"]
+        self.start(50)
+        self.assertEqual(self.start(50).status_code, 429)
+        # Expired uploads no longer count, and are deleted
+        self.expire(first)
+        self.assertEqual(self.start(50).status_code, 201)
+        self.assertFalse(models.FileUpload.objects.filter(id=first).exists())
+
+    def test_legacy_upload_rejected_before_decoding(self):
+        response = self.client.post(
+            "/api/vault/files/add",
+            {
+                "id": self.entry.id,
+                "name": "a.txt",
+                "iv": "AAAA",
+                "file": {str(i): 0 for i in range(101)},
+            },
+            format="json",
+        )
+        self.assertEqual(response.status_code, 413)
+
+
+class LocalS3Client:
+    """In-memory stand-in for the boto3 S3 client calls S3Storage makes."""
+
+    class NotFound(Exception):
+        response = {"Error": {"Code": "404"}}
+
+    def __init__(self):
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[(Bucket, Key)] = bytes(Body)
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise self.NotFound()
+
+    def get_object(self, Bucket, Key, Range=None):
+        data = self.objects[(Bucket, Key)]
+        if Range:
+            start, end = Range[len("bytes=") :].split("-")
+            data = data[int(start) : int(end) + 1 if end else None]
+        return {"Body": io.BytesIO(data)}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+    # Pages of two keys, to exercise continuation
+    def list_objects_v2(self, Bucket, Prefix, ContinuationToken=0):
+        keys = sorted(
+            k for b, k in self.objects if b == Bucket and k.startswith(Prefix)
+        )
+        page = keys[ContinuationToken : ContinuationToken + 2]
+        return {
+            "Contents": [{"Key": key} for key in page],
+            "IsTruncated": ContinuationToken + 2 < len(keys),
+            "NextContinuationToken": ContinuationToken + 2,
+        }
+
+
+class CodecTests(TestCase):
+    def test_round_trip(self):
+        for size in (0, 16, 70000):
+            data = bytes(i % 256 for i in range(size))
+            self.assertEqual(ToBytes(FromBytes(data)), data)
+            self.assertEqual(ToBytes(FromBytes(data, "base64")), data)
+
+    def test_unordered_keys(self):
+        self.assertEqual(ToBytes({"2": 3, "0": 1, "1": 2}), b"\x01\x02\x03")
+
+    def test_rejects_malformed(self):
+        for value in ({"0": 1, "2": 2}, {"0": 1, "00": 2}, {"0": 256}, {"0": "a"}, [1]):
+            with self.assertRaises((TypeError, ValueError)):
+                ToBytes(value)
+
+
+@override_settings(
+    VAULT_HASH_WORKERS=0,
+    PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+)
+class ByteEncodingTests(VaultTestCase):
+    password = bytes(range(48))
+    iv = bytes(range(100, 112))
+
+    def entry(self, name, encoding="base64"):
+        return {
+            "name": name,
+            "username": "user",
+            "password": FromBytes(self.password, encoding),
+            "iv": FromBytes(self.iv, encoding),
+        }
+
+    def assertStored(self, entry):
+        entry.refresh_from_db()
+        self.assertEqual(bytes(entry.password), self.password)
+        self.assertEqual(bytes(entry.iv), self.iv)
+
+    def test_negotiation(self):
+        create_entries(self.user, 1)
+        for accept, password in [
+            (None, {"0": 0, "1": 1, "2": 2}),
+            ("application/json", {"0": 0, "1": 1, "2": 2}),
+            ("application/json; bytes=legacy", {"0": 0, "1": 1, "2": 2}),
+            ("application/json; bytes=base64", "AAEC"),
+            ("text/html, application/json; bytes=base64", "AAEC"),
+            ("application/json; bytes=hex", {"0": 0, "1": 1, "2": 2}),
+        ]:
+            with self.subTest(accept=accept):
+                extra = {"HTTP_ACCEPT": accept} if accept else {}
+                response = self.client.get("/api/vault/retrieve", **extra)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.json()[0]["password"], password)
+
+    def test_plain_django_request(self):
+        factory = AsyncRequestFactory()
+        for accept, encoding in [
+            ("application/x-ndjson; bytes=base64", "base64"),
+            ("text/html;q=0.9, application/json; bytes=base64", "base64"),
+            ("text/html; bytes=base64", "legacy"),
+            ("", "legacy"),
+        ]:
+            request = factory.get("/", headers={"Accept": accept})
+            self.assertEqual(ByteEncoding(request), encoding)
+
+    def test_add_and_edit(self):
+        for encoding in BYTE_ENCODINGS:
+            with self.subTest(encoding=encoding):
+                response = self.client.post(
+                    "/api/vault/add", self.entry(encoding, encoding), format="json"
+                )
+                self.assertEqual(response.status_code, 200)
+                entry = models.VaultEntry.objects.get(id=response.json()["id"])
+                self.assertStored(entry)
+                entry.password = entry.iv = b""
+                entry.save()
+                response = self.client.post(
+                    "/api/vault/edit",
+                    dict(self.entry(encoding, encoding), id=entry.id),
+                    format="json",
+                )
+                self.assertEqual(response.status_code, 200)
+                self.assertStored(entry)
+
+    def test_add_batch(self):
+        response = self.client.post(
+            "/api/vault/add-batch",
+            {"entries": [self.entry("a"), self.entry("b", "legacy")]},
+            format="json",
+        )
+        self.assertEqual(response.json(), {"message": "Success", "created": 2})
+        for entry in models.VaultEntry.objects.filter(user=self.user):
+            self.assertStored(entry)
+
+    def test_invalid_base64(self):
+        response = self.client.post(
+            "/api/vault/add", dict(self.entry("a"), password="AA=A"), format="json"
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(models.VaultEntry.objects.exists())
+
+    def test_recovery(self):
+        models.ClientKeyDerivationSalt.objects.create(user=self.user)
+        anonymous = APIClient()
+        response = anonymous.post(
+            "/api/recovery",
+            dict(self.entry("a"), username="alice", verify=False, secret="s"),
+            format="json",
+        )
+        self.assertEqual(response.status_code, 200)
+        secret = models.RecoverySecret.objects.get(user=self.user)
+        self.assertEqual(bytes(secret.password), self.password)
+        self.assertEqual(bytes(secret.iv), self.iv)
+        for accept, encoding in [
+            ("application/json", "legacy"),
+            ("application/json; bytes=base64", "base64"),
+        ]:
+            response = anonymous.post(
+                "/api/recovery",
+                {"username": "alice", "verify": True, "secret": "s"},
+                format="json",
+                HTTP_ACCEPT=accept,
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(
+                response.json()["password"], FromBytes(self.password, encoding)
+            )
+            self.assertIn("Accept", response["Vary"])
+
+
+class RendererTests(VaultTestCase):
+    data = {
+        "name": "\u2028caf\u00e9",
+        "when": datetime.datetime(2024, 1, 2, 3, 4, 5),
+        "updated_at": datetime.datetime(
+            2024, 1, 2, 3, 4, 5, 678901, tzinfo=datetime.timezone.utc
+        ),
+        "offset": datetime.datetime(
+            2024, 1, 2, 3, 4, 5, tzinfo=datetime.timezone(datetime.timedelta(hours=2))
+        ),
+        "day": datetime.date(2024, 1, 2),
+        "time": datetime.time(3, 4, 5, 678901),
+        "upload": uuid.UUID("12345678-1234-5678-1234-567812345678"),
+        "bytes": {"0": 1, "1": 255},
+    }
+
+    def test_matches_stdlib_output(self):
+        for orjson in (renderers.orjson, None):
+            with mock.patch.object(renderers, "orjson", orjson):
+                ret = renderers.ORJSONRenderer().render(self.data)
+            self.assertNotIn(b"\xe2\x80\xa8", ret)
+            self.assertEqual(
+                json.loads(ret),
+                json.loads(JSONRenderer().render(self.data)),
+            )
+
+    def test_falls_back_to_json_renderer(self):
+        for data in ({1: "a", None: "b"}, {"big": 2**64}, [-(2**70)]):
+            self.assertEqual(
+                renderers.ORJSONRenderer().render(data), JSONRenderer().render(data)
+            )
+        for value in (math.nan, math.inf, -math.inf):
+            for data in ({"x": value}, [None, [value]], {value: 1}):
+                with self.assertRaises(ValueError):
+                    renderers.ORJSONRenderer().render(data)
+        self.assertEqual(
+            renderers.ORJSONRenderer().render({"next": None}), b'{"next":null}'
+        )
+
+    def test_parser(self):
+        body = json.dumps({"entries": [{"name": "caf\u00e9"}]}).encode()
+        for orjson in (renderers.orjson, None):
+            with mock.patch.object(renderers, "orjson", orjson):
+                self.assertEqual(
+                    renderers.ORJSONParser().parse(io.BytesIO(body)),
+                    {"entries": [{"name": "caf\u00e9"}]},
+                )
+
+    def test_malformed_body(self):
+        response = self.client.post(
+            "/api/vault/add", b"{", content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+# 0015 converts the hex text columns to bytea and back. The early
+# migrations are Postgres-only, so this is skipped on SQLite.
+@unittest.skipUnless(connection.vendor == "postgresql", "needs Postgres")
+class BinaryFieldsMigrationTests(TransactionTestCase):
+    before = [("vault", "0014_recoverysecret")]
+    after = [("vault", "0015_binary_ciphertext_fields")]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_forward_and_back(self):
+        data = {
+            "password": bytes(range(48)),
+            "iv": bytes(range(200, 212)),
+            "file": bytes(range(256)) * 3,
+        }
+        apps = self.migrate(self.before)
+        user = apps.get_model(*settings.AUTH_USER_MODEL.split(".")).objects.create(
+            username="alice"
+        )
+        entry = apps.get_model("vault", "VaultEntry").objects.create(
+            user_id=user.id,
+            name="entry",
+            username="",
+            password=data["password"].hex(),
+            iv=data["iv"].hex(),
+        )
+        file = apps.get_model("vault", "fileEntry").objects.create(
+            VaultEntry_id=entry.id,
+            name="a.txt",
+            file=data["file"].hex(),
+            iv=data["iv"].hex(),
+        )
+        secret = apps.get_model("vault", "RecoverySecret").objects.create(
+            user_id=user.id,
+            secret_hash="!",
+            password=data["password"].hex(),
+            iv=data["iv"].hex(),
+        )
+        rows = [
+            (entry, "password", "iv"),
+            (file, "file", "iv"),
+            (secret, "password", "iv"),
+        ]
+
+        apps = self.migrate(self.after)
+        for row, *fields in rows:
+            migrated = apps.get_model("vault", row._meta.model_name).objects.get(
+                id=row.id
+            )
+            for field in fields:
+                self.assertEqual(bytes(getattr(migrated, field)), data[field])
+
+        apps = self.migrate(self.before)
+        for row, *fields in rows:
+            reverted = apps.get_model("vault", row._meta.model_name).objects.get(
+                id=row.id
+            )
+            for field in fields:
+                self.assertEqual(getattr(reverted, field), data[field].hex())
+
+
+class BlobStorageTests(TestCase):
+    def check_storage(self, storage):
+        data = bytes(range(256)) * 4
+        key = storage.save(data)
+        self.assertEqual(storage.save(data), key)
+        self.assertTrue(storage.exists(key))
+        others = [storage.save(bytes([i])) for i in range(3)]
+        self.assertEqual(sorted(storage.keys()), sorted(others + [key]))
+        self.assertEqual(b"".join(storage.iter_chunks(key, chunk_size=100)), data)
+        self.assertEqual(b"".join(storage.iter_chunks(key, 10, 20)), data[10:20])
+        storage.delete(key)
+        self.assertFalse(storage.exists(key))
+
+    def test_filesystem_storage(self):
+        with tempfile.TemporaryDirectory() as location:
+            storage = FileSystemStorage(location)
+            self.check_storage(storage)
+            key = storage.save(b"abc")
+            self.assertTrue(
+                storage.path(key).startswith(
+                    "{}/{}/{}/".format(location, key[:2], key[2:4])
+                )
+            )
+
+    def test_s3_storage(self):
+        client = LocalS3Client()
+        self.check_storage(S3Storage("vault", prefix="blobs/", client=client))
+
+    def test_s3_storage_without_boto3(self):
+        with mock.patch.dict("sys.modules", {"boto3": None}):
+            with self.assertRaises(ImproperlyConfigured):
+                S3Storage("vault")
+
+    def test_backends_implement_interface(self):
+        with self.assertRaises(TypeError):
+            BlobStorage()
+
+
+class BlobStorageViewTests(VaultTestCase):
+    def setUp(self):
+        super().setUp()
+        self.location = tempfile.TemporaryDirectory()
+        self.addCleanup(self.location.cleanup)
+        self.storage = {
+            "BACKEND": "vault.storage.FileSystemStorage",
+            "OPTIONS": {"location": self.location.name},
+        }
+        self.entry = models.VaultEntry.objects.create(
+            user=self.user, name="entry", username="", password=b"", iv=b""
+        )
+
+    def test_upload_download_delete(self):
+        with self.settings(VAULT_BLOB_STORAGE=self.storage):
+            response = self.client.post(
+                "/api/vault/files/add",
+                {"id": self.entry.id, "name": "a.txt", "iv": "AAAA", "file": "AQID"},
+                format="json",
+            )
+            file = models.fileEntry.objects.get(id=response.json()["id"])
+            self.assertIsNone(file.file)
+            self.assertEqual(file.size, 3)
+            storage = FileSystemStorage(self.location.name)
+            self.assertTrue(storage.exists(file.blob))
+
+            download = self.client.get("/api/vault/files/{}".format(file.id))
+            self.assertEqual(read_body(download), b"\x01\x02\x03")
+
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(
+                    "/api/vault/files/delete", {"id": file.id}, format="json"
+                )
+            self.assertFalse(storage.exists(file.blob))
+
+    def test_migrate_blobs(self):
+        file = models.fileEntry.objects.create(
+            VaultEntry=self.entry, name="a.txt", file=b"secret", iv=b""
+        )
+        with self.settings(VAULT_BLOB_STORAGE=self.storage):
+            call_command("migrate_blobs", stdout=io.StringIO())
+            file.refresh_from_db()
+            self.assertIsNone(file.file)
+            self.assertEqual(b"".join(file.iter_chunks()), b"secret")
+
+    def test_shared_blob_kept_until_unreferenced(self):
+        storage = FileSystemStorage(self.location.name)
+        with self.settings(VAULT_BLOB_STORAGE=self.storage):
+            files = [
+                models.fileEntry(VaultEntry=self.entry, name=name, iv=b"")
+                for name in ("a.txt", "b.txt")
+            ]
+            for file in files:
+                file.write(b"same")
+                file.save()
+            self.assertEqual(files[0].blob, files[1].blob)
+            with self.captureOnCommitCallbacks(execute=True):
+                files[0].delete()
+                models.release_blobs([files[0].blob])
+            self.assertTrue(storage.exists(files[1].blob))
+            with self.captureOnCommitCallbacks(execute=True):
+                files[1].delete()
+                models.release_blobs([files[1].blob])
+            self.assertFalse(storage.exists(files[1].blob))
+            self.assertFalse(models.Blob.objects.exists())
+
+    def test_sweep_deletes_rolled_back_blobs(self):
+        storage = FileSystemStorage(self.location.name)
+        with self.settings(VAULT_BLOB_STORAGE=self.storage):
+            kept = models.fileEntry(VaultEntry=self.entry, name="a.txt", iv=b"")
+            kept.write(b"kept")
+            kept.save()
+            try:
+                with transaction.atomic():
+                    file = models.fileEntry(VaultEntry=self.entry, name="b.txt", iv=b"")
+                    file.write(b"rolled back")
+                    raise IntegrityError()
+            except IntegrityError:
+                pass
+            self.assertTrue(storage.exists(file.blob))
+            out = io.StringIO()
+            call_command("migrate_blobs", "--sweep", "--dry-run", stdout=out)
+            self.assertIn("1 unused blobs would be deleted", out.getvalue())
+            self.assertTrue(storage.exists(file.blob))
+            call_command("migrate_blobs", "--sweep", "--batch-size=1", stdout=out)
+            self.assertFalse(storage.exists(file.blob))
+            self.assertTrue(storage.exists(kept.blob))
+
+
+# A release that runs while another transaction has written the same blob
+# but not committed its row yet waits for that row instead of deleting the
+# blob under it. Needs two connections and Postgres row locks.
+@unittest.skipUnless(connection.vendor == "postgresql", "needs Postgres")
+class BlobReleaseRaceTests(TransactionTestCase):
+    def test_release_waits_for_writer(self):
+        location = tempfile.TemporaryDirectory()
+        self.addCleanup(location.cleanup)
+        storage = {
+            "BACKEND": "vault.storage.FileSystemStorage",
+            "OPTIONS": {"location": location.name},
+        }
+        user = models.User.objects.create_user(username="alice")
+        entry = models.VaultEntry.objects.create(
+            user=user, name="entry", username="", password=b"", iv=b""
+        )
+        key = FileSystemStorage(location.name).key_for(b"shared")
+        written, commit = threading.Event(), threading.Event()
+        released = []
+
+        def writer():
+            try:
+                with transaction.atomic():
+                    file = models.fileEntry(VaultEntry=entry, name="a.txt", iv=b"")
+                    file.write(b"shared")
+                    file.save()
+                    written.set()
+                    commit.wait(5)
+            finally:
+                connection.close()
+
+        def releaser():
+            try:
+                released.append(models.delete_unreferenced([key]))
+            finally:
+                connection.close()
+
+        with self.settings(VAULT_BLOB_STORAGE=storage):
+            threads = [threading.Thread(target=writer)]
+            threads[0].start()
+            self.assertTrue(written.wait(5))
+            threads.append(threading.Thread(target=releaser))
+            threads[1].start()
+            threads[1].join(0.5)
+            self.assertTrue(threads[1].is_alive())
+            commit.set()
+            for thread in threads:
+                thread.join(5)
+            self.assertEqual(released, [set()])
+            self.assertTrue(FileSystemStorage(location.name).exists(key))
+
+
+class VaultSyncTests(VaultTestCase):
+    def post(self, path, data):
+        return self.client.post("/api/" + path, data, format="json")
+
+    def add(self, name):
+        response = self.post(
+            "vault/add",
+            {"name": name, "username": "", "password": "AA==", "iv": "AA=="},
+        )
+        return response.json()["id"]
+
+    def sync(self, since):
+        return self.client.get("/api/vault/sync", {"since": since}).json()
+
+    def test_changes_since_cursor(self):
+        first = self.add("first")
+        second = self.add("second")
+        cursor = int(self.client.get("/api/vault/retrieve")["X-Vault-Revision"])
+        self.assertEqual(cursor, 2)
+        self.assertEqual(self.sync(cursor)["entries"], [])
+
+        self.post(
+            "vault/edit",
+            {
+                "id": first,
+                "name": "renamed",
+                "username": "",
+                "password": "AA==",
+                "iv": "AA==",
+            },
+        )
+        file = self.post(
+            "vault/files/add",
+            {"id": second, "name": "a.txt", "iv": "AA==", "file": "AQID"},
+        ).json()["id"]
+        changes = self.sync(cursor)
+        self.assertEqual(changes["revision"], 4)
+        self.assertEqual([entry["name"] for entry in changes["entries"]], ["renamed"])
+        self.assertEqual([f["id"] for f in changes["files"]], [file])
+        self.assertEqual(changes["files"][0]["entry"], second)
+
+        self.post("vault/files/delete", {"id": file})
+        self.post("vault/delete", {"id": first})
+        changes = self.sync(changes["revision"])
+        self.assertEqual(changes["deleted"], {"entries": [first], "files": [file]})
+        self.assertEqual(changes["entries"], [])
+
+    def test_full_sync_without_cursor(self):
+        create_entries(self.user, 3)
+        changes = self.sync(0)
+        self.assertEqual(len(changes["entries"]), 3)
+        self.assertEqual(changes["revision"], 0)
+
+
+@override_settings(VAULT_ASYNC_VIEWS=True)
+class AsyncVaultSyncTests(AsyncViewsMixin, VaultSyncTests):
+    pass
+
+
+class ConditionalGetTests(VaultTestCase):
+    def test_retrieve_not_modified(self):
+        create_entries(self.user, 3, files_per_entry=1)
+        response = self.client.get("/api/vault/retrieve")
+        etag = response["ETag"]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/vault/retrieve", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+        self.assertFalse(
+            any(
+                "vault_vaultentry" in query["sql"] for query in queries.captured_queries
+            )
+        )
+
+    def test_retrieve_etag_changes_with_vault(self):
+        etag = self.client.get("/api/vault/retrieve")["ETag"]
+        self.client.post(
+            "/api/vault/add",
+            {"name": "a", "username": "", "password": "AA==", "iv": "AA=="},
+            format="json",
+        )
+        response = self.client.get("/api/vault/retrieve", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_retrieve_etag_depends_on_encoding(self):
+        etag = self.client.get("/api/vault/retrieve")["ETag"]
+        response = self.client.get(
+            "/api/vault/retrieve",
+            HTTP_IF_NONE_MATCH=etag,
+            HTTP_ACCEPT="application/json; bytes=base64",
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_salt_not_modified(self):
+        models.ClientKeyDerivationSalt.objects.create(user=self.user)
+        etag = self.client.get("/api/salt")["ETag"]
+        response = self.client.get("/api/salt", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+
+@override_settings(VAULT_ASYNC_VIEWS=True)
+class AsyncConditionalGetTests(AsyncViewsMixin, ConditionalGetTests):
+    pass
+
+
+class VaultAddBatchTests(VaultTestCase):
+    def entry(self, name):
+        return {"name": name, "username": "", "password": "AA==", "iv": "AA=="}
+
+    @override_settings(VAULT_BATCH_CHUNK_SIZE=2)
+    def test_bulk_insert_reports_duplicates(self):
+        create_entries(self.user, 1)
+        entries = [self.entry("entry-0"), self.entry("b"), self.entry("b")]
+        entries += [self.entry("new-{}".format(i)) for i in range(5)]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                "/api/vault/add-batch", {"entries": entries}, format="json"
+            )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["created"], 6)
+        self.assertEqual(
+            sorted(error["name"] for error in response.json()["errors"]),
+            ["b", "entry-0"],
+        )
+        self.assertEqual(models.VaultEntry.objects.filter(user=self.user).count(), 7)
+        inserts = [
+            q
+            for q in queries.captured_queries
+            if q["sql"].startswith('INSERT INTO "vault_vaultentry"')
+        ]
+        self.assertEqual(len(inserts), 3)
+
+    def test_success(self):
+        response = self.client.post(
+            "/api/vault/add-batch", {"entries": [self.entry("a")]}, format="json"
+        )
+        self.assertEqual(response.json(), {"message": "Success", "created": 1})
+
+
+class UniqueNameTests(VaultTestCase):
+    def entry(self, name):
+        return {"name": name, "username": "", "password": "AA==", "iv": "AA=="}
+
+    def test_add_relies_on_constraint(self):
+        create_entries(self.user, 1)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                "/api/vault/add", self.entry("entry-0"), format="json"
+            )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.json()["message"], "Entry with the same name already exists"
+        )
+        self.assertFalse(
+            any("EXISTS" in q["sql"] or "LIMIT 1" in q["sql"] for q in queries)
+        )
+        self.assertEqual(models.VaultEntry.objects.filter(user=self.user).count(), 1)
+        # The failed insert must not leave the revision bumped
+        self.assertEqual(models.current_revision(self.user), 0)
+
+    def test_edit_rename_conflict(self):
+        create_entries(self.user, 2)
+        entry = models.VaultEntry.objects.get(user=self.user, name="entry-1")
+        response = self.client.post(
+            "/api/vault/edit", dict(self.entry("entry-0"), id=entry.id), format="json"
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.json()["message"], "Entry with the same name already exists"
+        )
+
+    # Foreign keys are checked at commit, which a TestCase never reaches
+    # unless they are made immediate
+    @unittest.skipUnless(connection.vendor == "postgresql", "needs Postgres")
+    def test_other_integrity_errors(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SET CONSTRAINTS ALL IMMEDIATE")
+        # The token outlives the account
+        models.User.objects.filter(id=self.user.id).delete()
+        with self.assertLogs("vault.views", "ERROR"):
+            response = self.client.post(
+                "/api/vault/add", self.entry("entry-0"), format="json"
+            )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["message"], "Entry creation failed")
+
+    def test_same_name_for_different_users(self):
+        other = models.User.objects.create_user(username="bob", password="pw")
+        create_entries(other, 1)
+        response = self.client.post(
+            "/api/vault/add", self.entry("entry-0"), format="json"
+        )
+        self.assertEqual(response.status_code, 200)
+
+
+class VaultEditBatchTests(VaultTestCase):
+    def rekey(self, entry, files=()):
+        return {
+            "id": entry.id,
+            "name": entry.name,
+            "username": entry.username,
+            "password": "BwcH",
+            "iv": "CAgI",
+            "files": [
+                {"id": file.id, "name": file.name, "file": "CQkJCQ==", "iv": "CgoK"}
+                for file in files
+            ],
+        }
+
+    @override_settings(VAULT_BATCH_CHUNK_SIZE=2)
+    def test_rekeys_vault_in_one_transaction(self):
+        create_entries(self.user, 5, files_per_entry=1)
+        edits = [
+            self.rekey(entry, entry.files.all())
+            for entry in models.VaultEntry.objects.filter(user=self.user)
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(
+                "/api/vault/edit-batch", {"entries": edits}, format="json"
+            )
+        self.assertEqual(response.status_code, 200)
+        updates = [q for q in queries.captured_queries if q["sql"].startswith("UPDATE")]
+        # 3 chunks of entries, 1 of files and the revision bump
+        self.assertEqual(len(updates), 5)
+        revision = models.current_revision(self.user)
+        for entry in models.VaultEntry.objects.filter(user=self.user):
+            self.assertEqual(bytes(entry.password), b"\x07\x07\x07")
+            self.assertEqual(entry.revision, revision)
+        for file in models.fileEntry.objects.filter(VaultEntry__user=self.user):
+            self.assertEqual(bytes(file.file), b"\x09" * 4)
+            self.assertEqual(file.size, 4)
+            self.assertEqual(file.revision, revision)
+
+    def test_foreign_ids_reject_whole_batch(self):
+        create_entries(self.user, 2)
+        other = models.User.objects.create_user(username="bob", password="pw")
+        create_entries(other, 1, files_per_entry=1)
+        foreign_file = models.fileEntry.objects.get(VaultEntry__user=other)
+        edits = [
+            self.rekey(entry)
+            for entry in models.VaultEntry.objects.filter(user=self.user)
+        ]
+        edits[0]["files"] = self.rekey(foreign_file.VaultEntry, [foreign_file])["files"]
+        response = self.client.post(
+            "/api/vault/edit-batch", {"entries": edits}, format="json"
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.json()["errors"],
+            [{"id": foreign_file.id, "message": "Unauthorized"}],
+        )
+        for entry in models.VaultEntry.objects.all():
+            self.assertEqual(bytes(entry.password), b"\x00\x01\x02")
+
+    def test_malformed_item_rolls_back(self):
+        create_entries(self.user, 2)
+        edits = [
+            self.rekey(entry)
+            for entry in models.VaultEntry.objects.filter(user=self.user)
+        ]
+        del edits[1]["iv"]
+        response = self.client.post(
+            "/api/vault/edit-batch", {"entries": edits}, format="json"
+        )
+        self.assertEqual(response.status_code, 400)
+        for entry in models.VaultEntry.objects.filter(user=self.user):
+            self.assertEqual(bytes(entry.password), b"\x00\x01\x02")
+
+
+class AsyncViewTests(VaultTestCase):
+    def call(self, view, path, headers=None, **kwargs):
+        request = AsyncRequestFactory().get(
+            path,
+            headers=dict(
+                headers or {},
+                Authorization="Bearer {}".format(AccessToken.for_user(self.user)),
+            ),
+        )
+        return async_to_sync(view.as_view())(request, **kwargs)
+
+    def test_retrieve_and_sync_match_sync_views(self):
+        create_entries(self.user, 3, files_per_entry=1)
+        for path, view in (
+            ("/api/vault/retrieve", async_views.AsyncVaultRetrieve),
+            ("/api/vault/sync?since=0", async_views.AsyncVaultSync),
+        ):
+            response = self.call(view, path)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.content), self.client.get(path).json())
+
+    @override_settings(VAULT_RETRIEVE_PAGE_SIZE=2)
+    def test_retrieve_pages_and_stream(self):
+        create_entries(self.user, 3, files_per_entry=1)
+        path = "/api/vault/retrieve?after=0&limit=2"
+        response = self.call(async_views.AsyncVaultRetrieve, path)
+        self.assertEqual(json.loads(response.content), self.client.get(path).json())
+
+        response = self.call(
+            async_views.AsyncVaultRetrieve,
+            "/api/vault/retrieve",
+            {"Accept": "application/x-ndjson"},
+        )
+        lines = read_body(response).splitlines()
+        self.assertEqual(
+            [json.loads(line) for line in lines],
+            self.client.get("/api/vault/retrieve").json(),
+        )
+
+    def test_retrieve_not_modified(self):
+        create_entries(self.user, 1)
+        etag = self.client.get("/api/vault/retrieve")["ETag"]
+        response = self.call(
+            async_views.AsyncVaultRetrieve,
+            "/api/vault/retrieve",
+            {"If-None-Match": etag},
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def test_download_range(self):
+        create_entries(self.user, 1, files_per_entry=1)
+        file = models.fileEntry.objects.get()
+        response = self.call(
+            async_views.AsyncFileDownload,
+            "/api/vault/files/{}".format(file.id),
+            {"Range": "bytes=4-7"},
+            id=file.id,
+        )
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(read_body(response), b"\x04" * 4)
+
+    def test_requires_token(self):
+        request = AsyncRequestFactory().get("/api/vault/retrieve")
+        response = async_to_sync(async_views.AsyncVaultRetrieve.as_view())(request)
+        self.assertEqual(response.status_code, 401)
+        self.assertIn("WWW-Authenticate", response)
+
+
+class DatabaseConnectionMiddlewareTests(VaultTestCase):
+    def observed(self):
+        return sum(
+            sum(counts) for counts, _ in vault_db.connection_seconds.samples().values()
+        )
+
+    @override_settings(VAULT_SERVER_TIMING=True)
+    def test_records_connection_time(self):
+        before = self.observed()
+        # The persistent connection is health checked before its next query
+        connection.health_check_done = False
+        response = self.client.get("/api/salt")
+        self.assertRegex(response["Server-Timing"], r"^db-connect;dur=\d+\.\d$")
+        self.assertEqual(self.observed(), before + 1)
+
+    @override_settings(VAULT_SERVER_TIMING=True)
+    def test_no_connection_without_queries(self):
+        before = self.observed()
+        connection.health_check_done = False
+        for path in ("/metrics", "/no-such-page"):
+            with self.assertNumQueries(0):
+                response = self.client.get(path)
+            self.assertNotIn("Server-Timing", response)
+        self.assertEqual(self.observed(), before)
+        self.assertFalse(connection.health_check_done)
+
+    @override_settings(VAULT_SERVER_TIMING=False)
+    def test_server_timing_optional(self):
+        self.assertNotIn("Server-Timing", self.client.get("/api/salt"))
+
+    def test_histogram_buckets(self):
+        histogram = metrics.Histogram("test", "", buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value, state="new")
+        counts, total = histogram.samples()[(("state", "new"),)]
+        self.assertEqual(counts, [2, 1, 1])
+        self.assertAlmostEqual(total, 2.65)
+
+
+class AsyncMiddlewareTests(VaultTestCase):
+    @override_settings(DEBUG=True)
+    def test_no_thread_hops(self):
+        handler = BaseHandler()
+        with mock.patch("django.core.handlers.base.logger") as logger:
+            handler.load_middleware(is_async=True)
+        adapted = " ".join(str(call) for call in logger.debug.call_args_list)
+        self.assertNotIn("vault.middleware", adapted)
+        for method in handler._template_response_middleware:
+            self.assertTrue(iscoroutinefunction(method), method)
+
+    @override_settings(VAULT_COMPRESS_MIN_SIZE=0, VAULT_SERVER_TIMING=True)
+    def test_async_request(self):
+        create_entries(self.user, 20)
+        key = (("view", "vault-retrieve"),)
+        before = middleware.query_count.samples().get(key, ([], 0))[1]
+        response = async_to_sync(AsyncClient().get)(
+            "/api/vault/retrieve",
+            headers={
+                "Authorization": "Bearer {}".format(AccessToken.for_user(self.user)),
+                "Accept-Encoding": "gzip",
+                "X-Request-ID": "edge-1",
+            },
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-Request-ID"], "edge-1")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(len(json.loads(gzip.decompress(response.content))), 20)
+        # Queries of the sync view, run in a thread, are still counted
+        self.assertGreater(middleware.query_count.samples()[key][1], before)
+
+
+class MetricsTests(VaultTestCase):
+    def test_exposition(self):
+        histogram = metrics.Histogram("h", "Help", buckets=(0.1, 1))
+        histogram.observe(0.05, view="a")
+        histogram.observe(2, view="a")
+        counter = metrics.Counter("c_total", "Count")
+        counter.inc(3, scope='say "hi"')
+        registry = {"h": histogram, "c_total": counter}
+        with mock.patch.dict(metrics.REGISTRY, registry, clear=True):
+            text = metrics.exposition(metrics.collect())
+        self.assertEqual(
+            text.splitlines(),
+            [
+                "# HELP c_total Count",
+                "# TYPE c_total counter",
+                'c_total{scope="say \\"hi\\""} 3',
+                "# HELP h Help",
+                "# TYPE h histogram",
+                'h_bucket{view="a",le="0.1"} 1',
+                'h_bucket{view="a",le="1"} 1',
+                'h_bucket{view="a",le="+Inf"} 2',
+                'h_sum{view="a"} 2.05',
+                'h_count{view="a"} 2',
+            ],
+        )
+
+    def test_collect_adds_up_processes(self):
+        directory = tempfile.mkdtemp()
+        counter = metrics.Counter("c_total", "Count")
+        counter.inc(2, scope="x")
+        with mock.patch.dict(metrics.REGISTRY, {"c_total": counter}, clear=True):
+            with mock.patch("os.getpid", return_value=1):
+                metrics.write_snapshot(directory)
+            counter.inc(scope="x")
+            merged = metrics.collect(directory)
+        self.assertEqual(merged["c_total"]["samples"], {(("scope", "x"),): 5})
+
+    def test_compact_exited_process(self):
+        directory = tempfile.mkdtemp()
+        counter = metrics.Counter("c_total", "Count")
+        with mock.patch.dict(metrics.REGISTRY, {"c_total": counter}, clear=True):
+            # Two processes that got the same pid one after the other
+            for pid in (7, 7, 8):
+                with mock.patch("os.getpid", return_value=pid), mock.patch.object(
+                    metrics, "_snapshot_name", (None, None)
+                ):
+                    metrics.write_snapshot(directory)
+                    counter.inc(scope="x")
+                    metrics.write_snapshot(directory)
+            metrics.compact(directory, 7)
+            metrics.compact(directory, 8)
+            merged = metrics.collect(directory)
+            self.assertEqual(sorted(os.listdir(directory)), [metrics.AGGREGATE])
+            # Own snapshot of 3, and 1 + 2 + 3 from the exited processes
+            self.assertEqual(merged["c_total"]["samples"], {(("scope", "x"),): 9})
+
+    def test_collect_skips_compacted_files(self):
+        directory = tempfile.mkdtemp()
+        counter = metrics.Counter("c_total", "Count")
+        counter.inc(scope="x")
+        with mock.patch.dict(metrics.REGISTRY, {"c_total": counter}, clear=True):
+            with mock.patch("os.getpid", return_value=7):
+                metrics.write_snapshot(directory)
+            [name] = os.listdir(directory)
+            with open(os.path.join(directory, name)) as f:
+                stale = f.read()
+            metrics.compact(directory, 7)
+            # A scrape that listed the file before it was compacted
+            with open(os.path.join(directory, name), "w") as f:
+                f.write(stale)
+            merged = metrics.collect(directory)
+        self.assertEqual(merged["c_total"]["samples"], {(("scope", "x"),): 2})
+
+    # Values of the given samples on /metrics; earlier tests count too
+    @override_settings(VAULT_METRICS_PUBLIC=True)
+    def scrape(self, *samples):
+        values = dict.fromkeys(samples, 0.0)
+        for line in self.client.get("/metrics").content.decode().splitlines():
+            sample, _, value = line.rpartition(" ")
+            if sample in values:
+                values[sample] = float(value)
+        return values
+
+    def test_request_metrics(self):
+        samples = [
+            'vault_request_seconds_count{method="GET",status="200",'
+            'vault_size="10",view="vault-retrieve"}',
+            'vault_db_queries_count{view="vault-retrieve"}',
+            'vault_render_seconds_count{view="vault-retrieve"}',
+            'vault_response_bytes_count{view="vault-retrieve"}',
+        ]
+        create_entries(self.user, 2)
+        before = self.scrape(*samples)
+        self.client.get("/api/vault/retrieve")
+        after = self.scrape(*samples)
+        for sample in samples:
+            self.assertEqual(after[sample], before[sample] + 1, sample)
+
+    def test_streamed_render_metrics(self):
+        samples = [
+            'vault_render_seconds_count{view="vault-retrieve"}',
+            'vault_response_bytes_count{view="vault-retrieve"}',
+        ]
+        create_entries(self.user, 2)
+        before = self.scrape(*samples)
+        response = self.client.get(
+            "/api/vault/retrieve", HTTP_ACCEPT="application/x-ndjson"
+        )
+        # Recorded once the stream is sent
+        self.assertEqual(self.scrape(*samples), before)
+        read_body(response)
+        after = self.scrape(*samples)
+        for sample in samples:
+            self.assertEqual(after[sample], before[sample] + 1, sample)
+
+    @override_settings(VAULT_METRICS_TOKEN="secret")
+    def test_token(self):
+        client = APIClient()
+        self.assertEqual(client.get("/metrics").status_code, 401)
+        response = client.get("/metrics", HTTP_AUTHORIZATION="Bearer secret")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+
+    @override_settings(VAULT_METRICS_TOKEN=None, VAULT_METRICS_PUBLIC=False)
+    def test_closed_without_token(self):
+        self.assertEqual(APIClient().get("/metrics").status_code, 403)
+
+
+@override_settings(VAULT_ASYNC_VIEWS=True)
+class AsyncMetricsTests(AsyncViewsMixin, MetricsTests):
+    pass
+
+
+class HashingTests(VaultTestCase):
+    def setUp(self):
+        super().setUp()
+        self.slot_dir = tempfile.mkdtemp()
+
+    def test_login_hashes_in_worker_process(self):
+        with self.settings(VAULT_HASH_WORKERS=1, VAULT_HASH_SLOT_DIR=self.slot_dir):
+            self.assertEqual(authenticate(username="alice", password="pw"), self.user)
+            self.assertIsNone(authenticate(username="alice", password="wrong"))
+            self.assertIsNotNone(hashing.get_executor())
+
+    def test_busy_returns_503(self):
+        with self.settings(
+            VAULT_HASH_WORKERS=0,
+            VAULT_HASH_CONCURRENCY=1,
+            VAULT_HASH_SLOT_DIR=self.slot_dir,
+        ):
+            slots = hashing.Slots(self.slot_dir, 1)
+            fd = slots.acquire()
+            try:
+                response = self.client.post(
+                    "/api/token", {"username": "alice", "password": "pw"}
+                )
+            finally:
+                slots.release(fd)
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response["Retry-After"], "1")
+            response = self.client.post(
+                "/api/register", {"username": "bob", "password": "pw"}
+            )
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(
+                models.User.objects.get(username="bob").check_password("pw")
+            )
+
+
+# A fast hasher keeps the login well inside the TOTP code's 30 second step
+@override_settings(
+    VAULT_HASH_WORKERS=0,
+    PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+)
+class LoginTests(VaultTestCase):
+    def setUp(self):
+        super().setUp()
+        models.RecoverySecret.objects.create(
+            user=self.user, secret_hash="!", password=b"", iv=b""
+        )
+        self.device = models.TOTPDevice.objects.create(
+            user=self.user, secret=pyotp.random_base32(), confirmed=True
+        )
+
+    def login(self, **data):
+        data = {"username": "alice", "password": "pw", **data}
+        return APIClient().post("/api/token", data, format="json")
+
+    def test_login_loads_2fa_state_with_user(self):
+        code = pyotp.TOTP(self.device.secret).now()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.login(twoFA=code)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("access", response.json())
+        self.assertEqual(len(queries), 1)
+
+    def test_invalid_code(self):
+        response = self.login(twoFA="abc")
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue(models.User.objects.filter(pk=self.user.pk).exists())
+
+    def test_unconfirmed_2fa_deletes_account(self):
+        self.device.confirmed = False
+        self.device.save()
+        self.assertEqual(self.login(twoFA="123456").status_code, 400)
+        self.assertFalse(models.User.objects.filter(pk=self.user.pk).exists())
+
+    def test_missing_recovery_deletes_account(self):
+        models.RecoverySecret.objects.filter(user=self.user).delete()
+        self.assertEqual(self.login(twoFA="123456").status_code, 400)
+        self.assertFalse(models.User.objects.filter(pk=self.user.pk).exists())
+
+
+class ThrottlingTests(VaultTestCase):
+    def test_sliding_window(self):
+        store = throttling.LocalStore()
+        self.assertEqual(store.hit("k", 2, 60, now=0), (True, 0))
+        self.assertEqual(store.hit("k", 2, 60, now=30), (True, 0))
+        self.assertEqual(store.hit("k", 2, 60, now=45), (False, 15))
+        # The first hit has left the window, the second has not
+        self.assertEqual(store.hit("k", 2, 60, now=61), (True, 0))
+        self.assertEqual(store.hit("k", 2, 60, now=62), (False, 28))
+        self.assertEqual(store.hit("other", 2, 60, now=62), (True, 0))
+
+    def test_sweep_drops_idle_keys(self):
+        store = throttling.LocalStore()
+        store.SWEEP_INTERVAL = 2
+        store.hit("a", 1, 10, now=0)
+        store.hit("b", 1, 10, now=20)
+        self.assertEqual(set(store.hits), {"b"})
+
+    def test_login_rate(self):
+        rates = {**settings.REST_FRAMEWORK["DEFAULT_THROTTLE_RATES"], "login": "2/hour"}
+        with self.settings(
+            REST_FRAMEWORK={**settings.REST_FRAMEWORK, "DEFAULT_THROTTLE_RATES": rates}
+        ):
+            for _ in range(2):
+                response = self.client.post("/api/token", {"username": "alice"})
+                self.assertEqual(response.status_code, 400)
+            response = self.client.post("/api/token", {"username": "alice"})
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response["Retry-After"]), 3590)
+
+    def test_database_store_shared(self):
+        # As two server processes would have
+        first, second = throttling.DatabaseStore(), throttling.DatabaseStore()
+        self.assertEqual(first.hit("k", 2, 60, now=0), (True, 0))
+        self.assertEqual(second.hit("k", 2, 60, now=30), (True, 0))
+        self.assertEqual(first.hit("k", 2, 60, now=45), (False, 15))
+        self.assertEqual(second.hit("k", 2, 60, now=61), (True, 0))
+        self.assertEqual(first.hit("k", 2, 60, now=62), (False, 28))
+        first.SWEEP_INTERVAL = 1
+        self.assertEqual(first.hit("other", 1, 10, now=200), (True, 0))
+        self.assertEqual(
+            list(models.ThrottleWindow.objects.values_list("key", flat=True)),
+            ["other"],
+        )
+
+    def test_recovery_counted_in_shared_store(self):
+        for _ in range(3):
+            self.assertEqual(throttling.hit("recovery-account", 1), (True, 0))
+        throttling.get_store.cache_clear()
+        allowed, wait = throttling.hit("recovery-account", 1)
+        self.assertFalse(allowed)
+        self.assertGreater(wait, 3590)
+
+    def test_forwarded_for_ignored(self):
+        rates = {**settings.REST_FRAMEWORK["DEFAULT_THROTTLE_RATES"], "login": "2/hour"}
+        with self.settings(
+            REST_FRAMEWORK={**settings.REST_FRAMEWORK, "DEFAULT_THROTTLE_RATES": rates}
+        ):
+            for i in range(3):
+                response = self.client.post(
+                    "/api/token",
+                    {"username": "alice"},
+                    HTTP_X_FORWARDED_FOR="203.0.113.{}".format(i),
+                )
+        self.assertEqual(response.status_code, 429)
+
+    @override_settings(VAULT_HASH_WORKERS=0)
+    def test_recovery_attempts_limited_per_account(self):
+        secret = models.RecoverySecret.objects.create(
+            user=self.user, password=b"p", iv=b"i"
+        )
+        secret.set_secret("right")
+        data = {"username": "alice", "verify": True, "secret": "wrong"}
+        for address in ("10.0.0.1", "10.0.0.2", "10.0.0.3"):
+            response = self.client.post(
+                "/api/recovery", data, format="json", REMOTE_ADDR=address
+            )
+            self.assertEqual(response.status_code, 401)
+        data["secret"] = "right"
+        response = self.client.post(
+            "/api/recovery", data, format="json", REMOTE_ADDR="10.0.0.4"
+        )
+        self.assertEqual(response.status_code, 429)
+        self.assertIn("Retry-After", response)
+
+    @unittest.skipIf(fakeredis is None, "fakeredis is not installed")
+    def test_redis_sliding_window(self):
+        client = fakeredis.FakeRedis()
+        store = throttling.RedisStore(None, client=client)
+        self.assertEqual(store.hit("k", 2, 60, now=0), (True, 0))
+        self.assertEqual(store.hit("k", 2, 60, now=30), (True, 0))
+        self.assertEqual(store.hit("k", 2, 60, now=45), (False, 15))
+        self.assertEqual(store.hit("k", 2, 60, now=61), (True, 0))
+        self.assertEqual(store.hit("k", 2, 60, now=62), (False, 28))
+        self.assertEqual(store.hit("other", 2, 60, now=62), (True, 0))
+        # Refused hits are not recorded, and idle keys expire with the window
+        self.assertEqual(client.zcard("vault:throttle:k"), 2)
+        self.assertTrue(0 < client.pttl("vault:throttle:k") <= 60000)
+
+    def test_store_required_at_startup(self):
+        with mock.patch.object(throttling, "redis", None):
+            with self.assertRaises(ImproperlyConfigured):
+                throttling.RedisStore("redis://localhost")
+        store = {
+            "BACKEND": "vault.throttling.RedisStore",
+            "OPTIONS": {"url": "http://localhost"},
+        }
+        with self.settings(VAULT_THROTTLE_STORE=store):
+            with self.assertRaises(ValueError):
+                apps.get_app_config("vault").ready()
+
+    @override_settings(VAULT_HASH_WORKERS=0)
+    def test_store_failure(self):
+        secret = models.RecoverySecret.objects.create(
+            user=self.user, password=b"p", iv=b"i"
+        )
+        secret.set_secret("right")
+        store = mock.Mock()
+        store.hit.side_effect = ConnectionError("down")
+        with mock.patch.object(throttling, "get_store", return_value=store):
+            self.assertEqual(throttling.hit("login", "ip:10.0.0.1"), (True, 0))
+            response = self.client.post(
+                "/api/recovery",
+                {"username": "alice", "verify": True, "secret": "right"},
+                format="json",
+            )
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "60")
+
+
+class StatelessAuthenticationTests(VaultTestCase):
+    def test_vault_requests_do_not_load_user(self):
+        create_entries(self.user, 1)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/api/vault/retrieve")
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(
+            any('"auth_user"' in q["sql"] for q in queries.captured_queries)
+        )
+
+    def test_lazy_user_loads_fields_on_access(self):
+        user = authentication.LazyUser(self.user.id)
+        self.assertEqual(user, self.user)
+        with self.assertNumQueries(1):
+            self.assertEqual(user.username, "alice")
+
+    def test_other_users_entry(self):
+        other = models.User.objects.create_user(username="bob")
+        create_entries(other, 1)
+        entry = models.VaultEntry.objects.get(user=other)
+        response = self.client.post(
+            "/api/vault/delete", {"id": entry.id}, format="json"
+        )
+        self.assertEqual(response.status_code, 401)
+        self.assertTrue(models.VaultEntry.objects.filter(id=entry.id).exists())
+
+
+class LoggingTests(VaultTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "vault.log")
+
+    def read(self, path=None):
+        with open(path or self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_request_id_header(self):
+        response = self.client.get("/api/salt", HTTP_X_REQUEST_ID="edge-1.2")
+        self.assertEqual(response["X-Request-ID"], "edge-1.2")
+        response = self.client.get("/api/salt", HTTP_X_REQUEST_ID="bad id\n")
+        self.assertRegex(response["X-Request-ID"], "^[0-9a-f]{32}$")
+
+    def test_json_records_through_queue(self):
+        handler = logs.QueueHandler(self.path, console=False)
+        handler.addFilter(logs.RequestIdFilter())
+        logger = logging.getLogger("vault.tests.queue")
+        logger.addHandler(handler)
+        token = logs.request_id.set("req-1")
+        try:
+            try:
+                raise ValueError("boom")
+            except ValueError:
+                logger.exception("Failed for %s", "alice")
+        finally:
+            logs.request_id.reset(token)
+            logger.removeHandler(handler)
+            handler.close()
+        [record] = self.read()
+        self.assertEqual(record["message"], "Failed for alice")
+        self.assertEqual(record["request_id"], "req-1")
+        self.assertEqual(record["level"], "ERROR")
+        self.assertIn("ValueError: boom", record["exception"])
+
+    def test_full_queue_drops_records(self):
+        handler = logs.QueueHandler(self.path, console=False, maxsize=1)
+        handler.listener.stop()
+        before = logs.dropped.samples().get((), 0)
+        record = logging.makeLogRecord({"msg": "x"})
+        handler.handle(record)
+        handler.handle(record)
+        self.assertEqual(logs.dropped.samples()[()], before + 1)
+        handler.listener = None
+        handler.close()
+
+    def test_rotation_shared_between_processes(self):
+        first = logs.RotatingFileHandler(self.path, "a", 200, 2)
+        second = logs.RotatingFileHandler(self.path, "a", 200, 2)
+        for handler in (first, second):
+            handler.setFormatter(logs.JSONFormatter())
+        try:
+            for i in range(3):
+                first.handle(logging.makeLogRecord({"msg": "first-{}".format(i)}))
+            second.handle(logging.makeLogRecord({"msg": "second"}))
+        finally:
+            first.close()
+            second.close()
+        # The second handler reopened the file rotated by the first rather
+        # than appending to the rotated copy
+        self.assertEqual(self.read()[-1]["message"], "second")
+        self.assertTrue(os.path.exists(self.path + ".1"))
+
+
+class CompressionTests(VaultTestCase):
+    def entry(self, name):
+        return {"name": name, "username": "", "password": "AA==", "iv": "AA=="}
+
+    def test_negotiate(self):
+        self.assertEqual(compression.negotiate("gzip, deflate"), "gzip")
+        self.assertEqual(
+            compression.negotiate("*"), next(iter(compression.COMPRESSORS))
+        )
+        self.assertIsNone(compression.negotiate("gzip;q=0, deflate"))
+        self.assertIsNone(compression.negotiate(""))
+
+    def test_retrieve_compressed(self):
+        create_entries(self.user, 20, files_per_entry=1)
+        # Already a weak ETag, kept as is
+        plain = self.client.get("/api/vault/retrieve")
+        response = self.client.get("/api/vault/retrieve", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", response["Vary"])
+        self.assertEqual(response["ETag"], plain["ETag"])
+        self.assertEqual(int(response["Content-Length"]), len(response.content))
+        self.assertLess(len(response.content), len(plain.content) // 4)
+        self.assertEqual(gzip.decompress(response.content), plain.content)
+        self.assertFalse(plain.has_header("Content-Encoding"))
+        # The weak ETag still revalidates
+        response = self.client.get(
+            "/api/vault/retrieve",
+            HTTP_ACCEPT_ENCODING="gzip",
+            HTTP_IF_NONE_MATCH=response["ETag"],
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def test_small_responses_left_alone(self):
+        response = self.client.post(
+            "/api/vault/add",
+            self.entry("a"),
+            format="json",
+            HTTP_ACCEPT_ENCODING="gzip",
+        )
+        self.assertFalse(response.has_header("Content-Encoding"))
+
+    def test_stream_compressed(self):
+        create_entries(self.user, 20)
+        response = self.client.get(
+            "/api/vault/retrieve",
+            HTTP_ACCEPT="application/x-ndjson",
+            HTTP_ACCEPT_ENCODING="gzip",
+        )
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        body = gzip.decompress(read_body(response))
+        self.assertEqual(len(body.splitlines()), 20)
+
+    def test_file_download_left_alone(self):
+        create_entries(self.user, 1, files_per_entry=1)
+        file = models.fileEntry.objects.get()
+        response = self.client.get(
+            "/api/vault/files/{}".format(file.id), HTTP_ACCEPT_ENCODING="gzip"
+        )
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual(read_body(response), b"\x04" * 32)
+
+    def post_compressed(self, body, encoding="gzip"):
+        return self.client.post(
+            "/api/vault/add-batch",
+            body,
+            content_type="application/json",
+            HTTP_CONTENT_ENCODING=encoding,
+        )
+
+    def test_compressed_request(self):
+        body = json.dumps({"entries": [self.entry("a"), self.entry("b")]}).encode()
+        response = self.post_compressed(gzip.compress(body))
+        self.assertEqual(response.json(), {"message": "Success", "created": 2})
+
+    @unittest.skipIf(compression.zstandard is None, "zstandard is not installed")
+    def test_zstd_request(self):
+        body = json.dumps({"entries": [self.entry("a")]}).encode()
+        response = self.post_compressed(
+            compression.zstandard.ZstdCompressor().compress(body), "zstd"
+        )
+        self.assertEqual(response.json(), {"message": "Success", "created": 1})
+
+    @override_settings(VAULT_MAX_DECOMPRESSED_SIZE=1000)
+    def test_compressed_request_limits(self):
+        bomb = gzip.compress(b" " * 10**6)
+        self.assertEqual(self.post_compressed(bomb).status_code, 413)
+        self.assertEqual(self.post_compressed(b"not gzip").status_code, 400)
+        self.assertEqual(self.post_compressed(b"{}", "compress").status_code, 415)
+        response = self.client.post(
+            "/api/vault/files/add",
+            bomb,
+            content_type="application/json",
+            HTTP_CONTENT_ENCODING="gzip",
+        )
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(models.VaultEntry.objects.exists())
+
+
+@override_settings(VAULT_ASYNC_VIEWS=True)
+class AsyncCompressionTests(AsyncViewsMixin, CompressionTests):
+    pass
+
+
+# Upper bounds on the SQL queries and response bytes of every endpoint, for
+# vaults of 10 and 1000 entries with a file each. Query budgets that do not
+# depend on `entries` hold the endpoint to a fixed number of queries however
+# large the vault is, so a query per entry (files.all() in a loop, a get()
+# per row) fails them at the larger size.
+@override_settings(
+    VAULT_HASH_WORKERS=0,
+    PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+)
+class BudgetTests(VaultTestCase):
+    SIZES = (10, 1000)
+    # Response bytes per entry of a vault listing, by byte encoding
+    ENTRY_BYTES = {"legacy": 620, "base64": 245}
+    # {"message": ...} and similar short replies
+    MESSAGE_BYTES = 100
+
+    def setUp(self):
+        super().setUp()
+        self.user.set_password("pw")
+        self.user.save()
+        models.RecoverySecret.objects.create(
+            user=self.user,
+            secret_hash=hashers.make_password("secret"),
+            password=bytes(48),
+            iv=bytes(12),
+        )
+        self.device = models.TOTPDevice.objects.create(
+            user=self.user, secret=pyotp.random_base32(), confirmed=True
+        )
+        models.ClientKeyDerivationSalt.objects.create(user=self.user)
+        # Writes after the first one update the revision rather than create it
+        models.bump_revision(self.user)
+        self.entries = []
+
+    def grow(self, count):
+        entries = models.VaultEntry.objects.bulk_create(
+            models.VaultEntry(
+                user=self.user,
+                name="entry-{}".format(i),
+                username="user-{}@example.com".format(i),
+                password=bytes(48),
+                iv=bytes(12),
+            )
+            for i in range(len(self.entries), count)
+        )
+        models.fileEntry.objects.bulk_create(
+            models.fileEntry(
+                VaultEntry=entry,
+                name="file.txt",
+                file=bytes(1024),
+                size=1024,
+                iv=bytes(12),
+            )
+            for entry in entries
+        )
+        self.entries += entries
+
+    def get(self, path, **extra):
+        return lambda: self.client.get(path, **extra)
+
+    def post(self, path, data, client=None):
+        return lambda: (client or self.client).post(path, data, format="json")
+
+    def entry(self, name, encoding="base64"):
+        return {
+            "name": name,
+            "username": "user@example.com",
+            "password": FromBytes(bytes(48), encoding),
+            "iv": FromBytes(bytes(12), encoding),
+        }
+
+    def test_retrieve(self):
+        for entries in self.SIZES:
+            self.grow(entries)
+            with self.subTest(entries=entries):
+                for encoding in ("legacy", "base64"):
+                    self.assertWithinBudget(
+                        self.get(
+                            "/api/vault/retrieve",
+                            HTTP_ACCEPT="application/json; bytes={}".format(encoding),
+                        ),
+                        queries=3,
+                        size=self.ENTRY_BYTES[encoding] * entries,
+                    )
+
+    def test_retrieve_page(self):
+        for entries in self.SIZES:
+            self.grow(entries)
+            with self.subTest(entries=entries):
+                self.assertWithinBudget(
+                    self.get("/api/vault/retrieve?after=0&limit=100"),
+                    queries=3,
+                    size=self.ENTRY_BYTES["legacy"] * min(entries, 100),
+                )
+
+    # Two queries (entries, then their files) per page of
+    # VAULT_RETRIEVE_PAGE_SIZE entries
+    @override_settings(VAULT_RETRIEVE_PAGE_SIZE=100)
+    def test_retrieve_stream(self):
+        for entries in self.SIZES:
+            self.grow(entries)
+            with self.subTest(entries=entries):
+                self.assertWithinBudget(
+                    self.get("/api/vault/retrieve", HTTP_ACCEPT="application/x-ndjson"),
+                    queries=3 + 2 * (entries // 100),
+                    size=self.ENTRY_BYTES["legacy"] * entries,
+                )
+
+    def test_sync(self):
+        for entries in self.SIZES:
+            self.grow(entries)
+            with self.subTest(entries=entries):
+                self.assertWithinBudget(
+                    self.get("/api/vault/sync?since=0"),
+                    queries=3,
+                    size=self.MESSAGE_BYTES + self.ENTRY_BYTES["legacy"] * entries,
+                )
+                revision = models.bump_revision(self.user)
+                self.assertWithinBudget(
+                    self.get("/api/vault/sync?since={}".format(revision)),
+                    queries=4,
+                    size=self.MESSAGE_BYTES,
+                )
+
+    def test_entry_writes(self):
+        for entries in self.SIZES:
+            self.grow(entries)
+            with self.subTest(entries=entries):
+                response = self.assertWithinBudget(
+                    self.post("/api/vault/add", self.entry("added-{}".format(entries))),
+                    queries=7,
+                    size=self.MESSAGE_BYTES,
+                )
+                added = response.json()["id"]
+                self.assertWithinBudget(
+                    self.post(
+                        "/api/vault/add-batch",
+                        {
+                            "entries": [
+                                self.entry("batch-{}-{}".format(entries, i))
+                                for i in range(10)
+                            ]
+                        },
+                    ),
+                    queries=8,
+                    size=self.MESSAGE_BYTES,
+                )
+                self.assertWithinBudget(
+                    self.post(
+                        "/api/vault/edit",
+                        dict(self.entry("edited-{}".format(entries)), id=added),
+                    ),
+                    queries=8,
+                    size=self.MESSAGE_BYTES,
+                )
+                self.assertWithinBudget(
+                    self.post("/api/vault/delete", {"id": added}),
+                    queries=12,
+                    size=self.MESSAGE_BYTES,
+                )
+
+    # An UPDATE per VAULT_BATCH_CHUNK_SIZE entries
+    @override_settings(VAULT_BATCH_CHUNK_SIZE=100)
+    def test_edit_batch(self):
+        for entries in self.SIZES:
+            self.grow(entries)
+            with self.subTest(entries=entries):
+                edits = [
+                    dict(self.entry(entry.name), id=entry.id) for entry in self.entries
+                ]
+                self.assertWithinBudget(
+                    self.post("/api/vault/edit-batch", {"entries": edits}),
+                    queries=7 + math.ceil(entries / 100),
+                    size=self.MESSAGE_BYTES,
+                )
+
+    def test_files(self):
+        for entries in self.SIZES:
+            self.grow(entries)
+            with self.subTest(entries=entries):
+                entry = self.entries[-1]
+                self.assertWithinBudget(
+                    self.get("/api/vault/files/{}".format(entry.files.get().id)),
+                    queries=1,
+                    size=1024,
+                )
+                response = self.assertWithinBudget(
+                    self.post(
+                        "/api/vault/files/add",
+                        {
+                            "id": entry.id,
+                            "name": "added.txt",
+                            "iv": "AA==",
+                            "file": "AQID",
+                        },
+                    ),
+                    queries=8,
+                    size=self.MESSAGE_BYTES,
+                )
+                self.assertWithinBudget(
+                    self.post("/api/vault/files/delete", {"id": response.json()["id"]}),
+                    queries=9,
+                    size=self.MESSAGE_BYTES,
+                )
+                response = self.assertWithinBudget(
+                    self.post(
+                        "/api/vault/files/uploads",
+                        {
+                            "id": entry.id,
+                            "name": "uploaded.txt",
+                            "iv": "AA==",
+                            "size": 3,
+                        },
+                    ),
+                    queries=4,
+                    size=self.MESSAGE_BYTES,
+                )
+                self.assertWithinBudget(
+                    lambda: self.client.put(
+                        "/api/vault/files/uploads/{}".format(response.json()["upload"]),
+                        b"abc",
+                        content_type="application/octet-stream",
+                        HTTP_UPLOAD_OFFSET="0",
+                    ),
+                    queries=14,
+                    size=self.MESSAGE_BYTES,
+                )
+
+    def test_account(self):
+        anonymous = APIClient()
+        for entries in self.SIZES:
+            self.grow(entries)
+            with self.subTest(entries=entries):
+                self.assertWithinBudget(
+                    self.get("/api/salt"), queries=1, size=self.MESSAGE_BYTES
+                )
+                response = self.assertWithinBudget(
+                    self.post(
+                        "/api/token",
+                        {
+                            "username": "alice",
+                            "password": "pw",
+                            "twoFA": pyotp.TOTP(self.device.secret).now(),
+                        },
+                        anonymous,
+                    ),
+                    queries=1,
+                    size=500,
+                )
+                self.assertWithinBudget(
+                    self.post(
+                        "/api/token/refresh", {"refresh": response.json()["refresh"]}
+                    ),
+                    queries=0,
+                    size=300,
+                )
+                self.assertWithinBudget(
+                    self.post(
+                        "/api/recovery",
+                        {"username": "alice", "verify": True, "secret": "secret"},
+                        anonymous,
+                    ),
+                    # 5 counting the attempt in the shared throttle store,
+                    # with the savepoints of its transaction
+                    queries=8,
+                    size=500,
+                )
+                self.assertWithinBudget(
+                    self.post(
+                        "/api/recovery/password",
+                        {"oldPassword": "pw", "newPassword": "pw"},
+                    ),
+                    queries=2,
+                    size=self.MESSAGE_BYTES,
+                )
+                self.assertWithinBudget(
+                    self.post("/api/confirm2fa", {"user": "alice"}, anonymous),
+                    queries=3,
+                    size=self.MESSAGE_BYTES,
+                )
+                self.assertWithinBudget(
+                    self.post(
+                        "/api/register",
+                        {"username": "user-{}".format(entries), "password": "pw"},
+                        anonymous,
+                    ),
+                    queries=7,
+                    size=200,
+                )
+
+
+# The scenario processes read what the command committed, so this runs
+# outside a test transaction
+@unittest.skipUnless(connection.vendor == "postgresql", "needs Postgres")
+class BenchmarkSuiteTests(TransactionTestCase):
+    ENDPOINTS = ["salt", "vault/add", "vault/delete", "vault/files/uploads/<id>"]
+
+    def run_suite(self, *args):
+        path = os.path.join(tempfile.mkdtemp(), "report.json")
+        err = io.StringIO()
+        call_command(
+            "benchmark_suite",
+            "--users=2",
+            "--entries=2",
+            "--file-size=64",
+            "--requests=4",
+            "--batch=2",
+            "--output",
+            path,
+            "--endpoints",
+            *self.ENDPOINTS,
+            *args,
+            stderr=err,
+        )
+        with open(path) as f:
+            return json.load(f), err.getvalue()
+
+    def test_tiny_run(self):
+        report, _ = self.run_suite("--concurrency=2")
+        self.assertEqual(report["options"]["concurrency"], 2)
+        self.assertEqual(list(report["endpoints"]), self.ENDPOINTS)
+        for name, result in report["endpoints"].items():
+            self.assertEqual(result["statuses"], {"200": 4}, name)
+        # Seeded users are removed again
+        self.assertFalse(models.User.objects.exists())
+
+    def test_sqlite_runs_one_request_at_a_time(self):
+        with mock.patch.object(connection, "vendor", "sqlite"):
+            report, err = self.run_suite("--concurrency=4")
+        self.assertEqual(report["options"]["concurrency"], 1)
+        self.assertIn("--concurrency 1", err)
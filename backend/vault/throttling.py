@@ -0,0 +1,216 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+from rest_framework.throttling import ScopedRateThrottle
+from vault import metrics, models
+import collections
+import functools
+import itertools
+import logging
+import os
+import threading
+import time
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+throttled = metrics.counter(
+    "vault_throttled_total", "Requests refused by a rate limit, by scope"
+)
+store_errors = metrics.counter(
+    "vault_throttle_store_errors_total",
+    "Rate limit checks that failed because the store did, by scope",
+)
+
+
+# Sliding-window logs: a hit is allowed while fewer than `limit` hits were
+# allowed for the key in the last `window` seconds. All stores check and
+# record in one atomic step and return (allowed, seconds until a hit would
+# be allowed).
+#
+# LocalStore counts in the current process only, so with N server processes
+# a limit is effectively N times higher (gunicorn_config.py warns about it).
+# It is the default for most scopes; deployments with more than one process
+# should use RedisStore. The VAULT_THROTTLE_FAIL_CLOSED scopes always count
+# in a shared store, DatabaseStore unless Redis is configured.
+class LocalStore:
+    # Keys idle for longer than their window are dropped every this many hits
+    SWEEP_INTERVAL = 1000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = {}
+        self.expires = {}
+        self.count = 0
+
+    def hit(self, key, limit, window, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            self.count += 1
+            if self.count % self.SWEEP_INTERVAL == 0:
+                self.sweep(now)
+            hits = self.hits.setdefault(key, collections.deque())
+            while hits and hits[0] <= now - window:
+                hits.popleft()
+            if len(hits) >= limit:
+                return False, hits[0] + window - now
+            hits.append(now)
+            self.expires[key] = now + window
+            return True, 0
+
+    def sweep(self, now):
+        for key in [key for key, expires in self.expires.items() if expires <= now]:
+            del self.hits[key], self.expires[key]
+
+
+# Shared by every server process on every host. Each key is a sorted set of
+# hit timestamps, trimmed, counted and appended to by one Lua script so
+# concurrent hits cannot both take the last slot. Works with Redis 5+ and
+# compatible servers (Valkey, KeyDB, Dragonfly).
+class RedisStore:
+    SCRIPT = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", now - window)
+if redis.call("ZCARD", KEYS[1]) >= tonumber(ARGV[3]) then
+    local oldest = redis.call("ZRANGE", KEYS[1], 0, 0, "WITHSCORES")
+    return {0, tostring(tonumber(oldest[2]) + window - now)}
+end
+redis.call("ZADD", KEYS[1], now, ARGV[4])
+redis.call("PEXPIRE", KEYS[1], math.ceil(window * 1000))
+return {1, "0"}
+"""
+
+    def __init__(self, url, prefix="vault:throttle:", client=None):
+        if client is None:
+            if redis is None:
+                raise ImproperlyConfigured("RedisStore requires the redis package")
+            client = redis.Redis.from_url(url, socket_timeout=0.5)
+        self.client = client
+        self.prefix = prefix
+        self.script = client.register_script(self.SCRIPT)
+
+    def hit(self, key, limit, window, now=None):
+        now = time.time() if now is None else now
+        # Unique member, so hits in the same microsecond are all counted
+        member = "{:.6f}-{}".format(now, os.urandom(4).hex())
+        allowed, wait = self.script(
+            keys=[self.prefix + key], args=[now, window, limit, member]
+        )
+        return bool(allowed), float(wait)
+
+
+# Shared by every server process through the database, for deployments
+# without Redis. The key's row is locked while its hits are counted, so
+# concurrent hits cannot both take the last slot. A transaction per hit is
+# too much for the busy scopes, so by default only the
+# VAULT_THROTTLE_FAIL_CLOSED ones use it.
+class DatabaseStore:
+    # Rows idle for longer than their window are deleted every this many hits
+    SWEEP_INTERVAL = 1000
+
+    def __init__(self):
+        self.count = itertools.count(1)
+
+    def hit(self, key, limit, window, now=None):
+        now = time.time() if now is None else now
+        if next(self.count) % self.SWEEP_INTERVAL == 0:
+            models.ThrottleWindow.objects.filter(expires__lte=now).delete()
+        with transaction.atomic():
+            # Created if missing and locked; a sweep may delete the row in
+            # between, then it is created again
+            row = None
+            while row is None:
+                models.ThrottleWindow.objects.bulk_create(
+                    [models.ThrottleWindow(key=key, expires=now + window)],
+                    ignore_conflicts=True,
+                )
+                row = (
+                    models.ThrottleWindow.objects.select_for_update()
+                    .filter(key=key)
+                    .first()
+                )
+            hits = [at for at in row.hits if at > now - window]
+            if len(hits) >= limit:
+                return False, hits[0] + window - now
+            row.hits = hits + [now]
+            row.expires = now + window
+            row.save()
+            return True, 0
+
+
+# The stores named by the VAULT_THROTTLE_STORE and VAULT_THROTTLE_SHARED_STORE
+# settings, built once per process, first by VaultConfig.ready, so a missing
+# package or bad URL stops the server at startup instead of failing every
+# check
+@functools.lru_cache(maxsize=None)
+def get_store(setting="VAULT_THROTTLE_STORE"):
+    config = getattr(settings, setting)
+    return import_string(config["BACKEND"])(**config.get("OPTIONS", {}))
+
+
+@receiver(setting_changed)
+def reset_store(setting, **kwargs):
+    if setting in ("VAULT_THROTTLE_STORE", "VAULT_THROTTLE_SHARED_STORE"):
+        get_store.cache_clear()
+
+
+# Checks and records one hit for `ident` against the rate configured for
+# `scope` in DEFAULT_THROTTLE_RATES. If the store cannot be reached the hit
+# is allowed, as the limits slow down guessing rather than replace the
+# password and 2FA checks, except in the VAULT_THROTTLE_FAIL_CLOSED scopes:
+# there nothing else stops guessing, so their hits are counted in the shared
+# store and refused for STORE_DOWN_RETRY seconds when it fails.
+STORE_DOWN_RETRY = 60
+
+
+def hit(scope, ident):
+    limit, window = ScopedRateThrottle().parse_rate(
+        settings.REST_FRAMEWORK["DEFAULT_THROTTLE_RATES"][scope]
+    )
+    key = "{}:{}".format(scope, ident)
+    fail_closed = scope in settings.VAULT_THROTTLE_FAIL_CLOSED
+    try:
+        store = get_store(
+            "VAULT_THROTTLE_SHARED_STORE" if fail_closed else "VAULT_THROTTLE_STORE"
+        )
+        allowed, wait = store.hit(key, limit, window)
+    except Exception as e:
+        logger.error(f"Throttle store failed: {str(e)}")
+        store_errors.inc(scope=scope)
+        if fail_closed:
+            return False, STORE_DOWN_RETRY
+        return True, 0
+    if not allowed:
+        throttled.inc(scope=scope)
+    return allowed, wait
+
+
+# ScopedRateThrottle (views opt in with throttle_scope, anonymous clients
+# are counted per address, users per id) on a sliding window in the
+# configured store, instead of the fixed history kept in the cache.
+class SlidingWindowThrottle(ScopedRateThrottle):
+    def allow_request(self, request, view):
+        self.scope = getattr(view, self.scope_attr, None)
+        if not self.scope:
+            return True
+        key = self.get_cache_key(request, view)
+        if key is None:
+            return True
+        allowed, self.retry_after = hit(self.scope, key)
+        return allowed
+
+    def get_cache_key(self, request, view):
+        if request.user and request.user.is_authenticated:
+            return "user:{}".format(request.user.pk)
+        return "ip:{}".format(self.get_ident(request))
+
+    def wait(self):
+        return self.retry_after
@@ -1,8 +1,14 @@
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path
 
 from .views import *
 
+if settings.VAULT_ASYNC_VIEWS:
+    from .async_views import AsyncFileDownload as FileDownload
+    from .async_views import AsyncVaultRetrieve as VaultRetrieve
+    from .async_views import AsyncVaultSync as VaultSync
+
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 
 urlpatterns = [
@@ -14,9 +20,17 @@ urlpatterns = [
     path("vault/add", VaultAdd.as_view(), name="vault-add"),
     path("vault/add-batch", VaultAddBatch.as_view(), name="vault-add-batch"),
     path("vault/retrieve", VaultRetrieve.as_view(), name="vault-retrieve"),
+    path("vault/sync", VaultSync.as_view(), name="vault-sync"),
     path("vault/delete", VaultDelete.as_view(), name="vault-delete"),
     path("vault/edit", VaultEdit.as_view(), name="vault-edit"),
     path("vault/files/add", FileAdd.as_view(), name="file-add"),
+    path("vault/files/<int:id>", FileDownload.as_view(), name="file-download"),
+    path("vault/files/uploads", FileUploadStart.as_view(), name="file-upload"),
+    path(
+        "vault/files/uploads/<uuid:id>",
+        FileUploadAppend.as_view(),
+        name="file-upload-append",
+    ),
     path("vault/files/delete", FileDelete.as_view(), name="file-delete"),
     path("recovery", Recovery.as_view(), name="recovery"),
     path("recovery/password", ResetPassword.as_view(), name="reset-password"),
@@ -1,15 +1,26 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.throttling import ScopedRateThrottle
-from vault import models
+from vault import compression, hashing, metrics, models, throttling
+from vault.authentication import StatelessJWTAuthentication
+from vault.codec import FromBytes, ToBytes
+from vault.renderers import CompressedJSONParser, NDJSONRenderer, RenderTimer
 from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
 from rest_framework import serializers
 from rest_framework_simplejwt.views import TokenObtainPairView
 from dotenv import load_dotenv
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Prefetch
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags, parse_header_parameters
+from django.views import View
 import logging
+import math
 import pyotp
-import time
 
 load_dotenv()
 
@@ -17,15 +28,18 @@ logger = logging.getLogger(__name__)
 
 
 class Register(APIView):
+    throttle_scope = "register"
+
     def post(self, request):
         try:
+            # Hashed first so a refused hash does not leave a passwordless user
+            password = hashing.make_password(request.data["password"])
             user, created = models.User.objects.get_or_create(
                 username=request.data["username"],
+                defaults={"password": password},
             )
             if not created:
                 return Response({"error": "User already exists"}, status=409)
-            user.set_password(request.data["password"])
-            user.save()
             salt = models.ClientKeyDerivationSalt.objects.create(user=user)
             salt.save()
 
@@ -40,6 +54,8 @@ class Register(APIView):
             return Response(
                 {"message": "User created", "uri": uri, "salt": salt.salt}, status=200
             )
+        except hashing.HashingBusy:
+            raise
         except Exception as e:
             return Response({"error": "User creation failed"}, status=400)
 
@@ -69,34 +85,29 @@ class Recovery(APIView):
             if request.data["verify"]:
                 provided_secret = request.data["secret"]
                 recovery_secret = models.RecoverySecret.objects.get(user=user)
-                if recovery_secret.attempts >= 3:
-                    if time.time() - recovery_secret.last_attempt.timestamp() < 60 * 60:
-                        return Response(
-                            {"message": "Too many attempts. Try again later"},
-                            status=429,
-                        )
-                    recovery_secret.attempts = 0
+                # Limited per account as well, whichever addresses guess
+                allowed, wait = throttling.hit("recovery-account", user.pk)
+                if not allowed:
+                    return Response(
+                        {"message": "Too many attempts. Try again later"},
+                        status=429,
+                        headers={"Retry-After": str(math.ceil(wait))},
+                    )
                 is_valid = recovery_secret.check_secret(provided_secret)
-                password_bytes = bytes.fromhex(recovery_secret.password)
-                password = {
-                    str(index): byte for index, byte in enumerate(password_bytes)
-                }
-                iv_bytes = bytes.fromhex(recovery_secret.iv)
-                iv = {str(index): byte for index, byte in enumerate(iv_bytes)}
                 if is_valid:
+                    encoding = ByteEncoding(request)
                     salt = models.ClientKeyDerivationSalt.objects.get(user=user)
-                    return Response(
+                    response = Response(
                         {
-                            "password": password,
-                            "iv": iv,
+                            "password": FromBytes(recovery_secret.password, encoding),
+                            "iv": FromBytes(recovery_secret.iv, encoding),
                             "salt": salt.salt,
                         },
                         status=200,
                     )
+                    patch_vary_headers(response, ["Accept"])
+                    return response
                 else:
-                    recovery_secret.attempts += 1
-                    recovery_secret.last_attempt = time.strftime("%Y-%m-%d %H:%M:%S")
-                    recovery_secret.save()
                     return Response({"message": "Unauthorized"}, status=401)
             else:
                 raw_secret = request.data["secret"]
@@ -106,10 +117,12 @@ class Recovery(APIView):
                 recovery_secret.set_secret(raw_secret)
                 password_bytes = ToBytes(request.data["password"])
                 iv_bytes = ToBytes(request.data["iv"])
-                recovery_secret.iv = iv_bytes.hex()
-                recovery_secret.password = password_bytes.hex()
+                recovery_secret.iv = iv_bytes
+                recovery_secret.password = password_bytes
                 recovery_secret.save()
                 return Response({"message": "Recovery secret set"}, status=200)
+        except hashing.HashingBusy:
+            raise
         except Exception as e:
             logger.error(f"Recovery failed: {str(e)}")
             return Response({"message": "Failed to set recovery secret"}, status=400)
@@ -123,101 +136,156 @@ class ResetPassword(APIView):
             user = request.user
             oldPassword = request.data["oldPassword"]
             newPassword = request.data["newPassword"]
-            if not user.check_password(oldPassword):
+            if not hashing.check_user_password(user, oldPassword):
                 return Response({"message": "Unauthorized"}, status=401)
 
-            user.set_password(newPassword)
+            hashing.set_user_password(user, newPassword)
             user.save()
             return Response({"message": "Password reset"}, status=200)
+        except hashing.HashingBusy:
+            raise
         except Exception as e:
             logger.error(f"Password reset failed: {str(e)}")
             return Response({"message": "Failed to reset password"}, status=400)
 
 
 class SaltResponse(APIView):
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [StatelessJWTAuthentication]
 
     def get(self, request):
         try:
+            # A user's salt is generated at registration and never changes
+            etag = 'W/"salt-{}"'.format(request.user.id)
+            if NotModified(request, etag):
+                return CacheHeaders(Response(status=304), etag)
             salt = models.ClientKeyDerivationSalt.objects.get(user=request.user)
-            return Response({"salt": salt.salt}, status=200)
+            return CacheHeaders(Response({"salt": salt.salt}, status=200), etag)
         except Exception as e:
             return Response({"message": "Failed to retrieve Salt"}, status=400)
 
 
 class VaultAdd(APIView):
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [StatelessJWTAuthentication]
 
     def post(self, request):
         try:
             password_bytes = ToBytes(request.data["password"])
             iv_bytes = ToBytes(request.data["iv"])
-            if models.VaultEntry.objects.filter(
-                user=request.user, name=request.data["name"]
-            ).exists():
-                return Response(
-                    {"message": "Entry with the same name already exists"}, status=400
+            with transaction.atomic():
+                entry = models.VaultEntry.objects.create(
+                    user=request.user,
+                    name=request.data["name"],
+                    username=request.data["username"],
+                    password=password_bytes,
+                    iv=iv_bytes,
+                    revision=models.bump_revision(request.user),
                 )
-            entry = models.VaultEntry.objects.create(
-                user=request.user,
-                name=request.data["name"],
-                username=request.data["username"],
-                password=password_bytes.hex(),
-                iv=iv_bytes.hex(),
-            )
-            entry.save()
             return Response({"message": "Entry created", "id": entry.id}, status=200)
+        except IntegrityError as e:
+            if not DuplicateName(e):
+                logger.error(f"Entry creation failed: {str(e)}")
+                return Response({"message": "Entry creation failed"}, status=400)
+            return Response(
+                {"message": "Entry with the same name already exists"}, status=400
+            )
         except Exception as e:
             logger.error(f"Entry creation failed: {str(e)}")
             return Response({"message": "Entry creation failed"}, status=400)
 
 
 class VaultAddBatch(APIView):
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [StatelessJWTAuthentication]
+    parser_classes = [CompressedJSONParser]
 
     def post(self, request):
         errors = []
-        entries = request.data["entries"]
-        for entry in entries:
+        new_entries = {}
+        for entry in request.data["entries"]:
             try:
-                password_bytes = ToBytes(entry["password"])
-                iv_bytes = ToBytes(entry["iv"])
-                if models.VaultEntry.objects.filter(
-                    user=request.user, name=entry["name"]
-                ).exists():
+                name = entry["name"]
+                if name in new_entries:
                     errors.append(
                         {
-                            "name": entry["name"],
+                            "name": name,
                             "message": "Entry with the same name already exists",
                         }
                     )
                     continue
-                entry = models.VaultEntry.objects.create(
+                new_entries[name] = models.VaultEntry(
                     user=request.user,
-                    name=entry["name"],
+                    name=name,
                     username=entry["username"],
-                    password=password_bytes.hex(),
-                    iv=iv_bytes.hex(),
+                    password=ToBytes(entry["password"]),
+                    iv=ToBytes(entry["iv"]),
                 )
-                entry.save()
             except Exception as e:
-                errors.append({"name": entry["name"], "message": str(e)})
+                errors.append({"name": entry.get("name"), "message": str(e)})
+
+        chunk_size = settings.VAULT_BATCH_CHUNK_SIZE
+        names = list(new_entries)
+        for i in range(0, len(names), chunk_size):
+            existing = models.VaultEntry.objects.filter(
+                user=request.user, name__in=names[i : i + chunk_size]
+            ).values_list("name", flat=True)
+            for name in existing:
+                del new_entries[name]
+                errors.append(
+                    {
+                        "name": name,
+                        "message": "Entry with the same name already exists",
+                    }
+                )
+
+        try:
+            if new_entries:
+                with transaction.atomic():
+                    revision = models.bump_revision(request.user)
+                    for entry in new_entries.values():
+                        entry.revision = revision
+                    models.VaultEntry.objects.bulk_create(
+                        new_entries.values(), batch_size=chunk_size
+                    )
+        # An entry added concurrently with one of the names checked above
+        except IntegrityError as e:
+            if not DuplicateName(e):
+                logger.error(f"Batch entry creation failed: {str(e)}")
+                return Response({"message": "Failed to create entries"}, status=400)
+            return Response(
+                {"message": "Entry with the same name already exists"}, status=400
+            )
+        except Exception as e:
+            logger.error(f"Batch entry creation failed: {str(e)}")
+            return Response({"message": "Failed to create entries"}, status=400)
         if len(errors) > 0:
             return Response(
-                {"message": "Failed to create entries", "errors": errors}, status=400
+                {
+                    "message": "Failed to create entries",
+                    "errors": errors,
+                    "created": len(new_entries),
+                },
+                status=400,
             )
-        return Response({"message": "Success"}, status=200)
+        return Response({"message": "Success", "created": len(new_entries)}, status=200)
 
 
 class VaultDelete(APIView):
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [StatelessJWTAuthentication]
 
     def post(self, request):
         try:
             entry = models.VaultEntry.objects.get(id=request.data["id"])
-            if entry.user != request.user:
+            if entry.user_id != request.user.id:
                 return Response({"message": "Unauthorized"}, status=401)
-            entry.delete()
+            blobs = list(entry.files.exclude(blob=None).values_list("blob", flat=True))
+            with transaction.atomic():
+                models.Tombstone.objects.create(
+                    user=request.user,
+                    kind=models.Tombstone.ENTRY,
+                    object_id=entry.id,
+                    revision=models.bump_revision(request.user),
+                )
+                entry.delete()
+            models.release_blobs(blobs)
             return Response({"message": "Entry deleted"}, status=200)
         except Exception as e:
             logger.error(f"Failed to delete entry: {str(e)}")
@@ -225,72 +293,120 @@ class VaultDelete(APIView):
 
 
 class VaultEdit(APIView):
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [StatelessJWTAuthentication]
 
     def post(self, request):
         try:
             entry = models.VaultEntry.objects.get(id=request.data["id"])
-            if entry.user != request.user:
+            if entry.user_id != request.user.id:
                 return Response({"message": "Unauthorized"}, status=401)
             password_bytes = ToBytes(request.data["password"])
             iv_bytes = ToBytes(request.data["iv"])
             entry.name = request.data["name"]
             entry.username = request.data["username"]
-            entry.password = password_bytes.hex()
-            entry.iv = iv_bytes.hex()
-            entry.save()
+            entry.password = password_bytes
+            entry.iv = iv_bytes
+            with transaction.atomic():
+                entry.revision = models.bump_revision(request.user)
+                entry.save()
             return Response({"message": "Entry edited"}, status=200)
+        except IntegrityError as e:
+            if not DuplicateName(e):
+                logger.error(f"Failed to edit entry: {str(e)}")
+                return Response({"message": "Failed to edit entry"}, status=400)
+            return Response(
+                {"message": "Entry with the same name already exists"}, status=400
+            )
         except Exception as e:
             return Response({"message": "Failed to edit entry"}, status=400)
 
 
+# The whole vault as one JSON list by default. Large vaults can be fetched
+# in pages, ?limit=<n>[&after=<next>] returning {"entries": [...], "next":
+# <cursor or null>}, or streamed as NDJSON, one entry per line, with
+# "Accept: application/x-ndjson" (?after= resumes an interrupted stream).
+# Pages and streams are in id order and read at most
+# VAULT_RETRIEVE_PAGE_SIZE entries at a time, so memory does not grow with
+# the vault. X-Vault-Revision of the first page (or of the stream) is the
+# cursor to sync from afterwards.
 class VaultRetrieve(APIView):
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [StatelessJWTAuthentication]
+    renderer_classes = APIView.renderer_classes + [NDJSONRenderer]
 
     def get(self, request):
         try:
-            entries = models.VaultEntry.objects.filter(user=request.user)
-            response = []
-            for entry in entries:
-                password_bytes = bytes.fromhex(entry.password)
-                password = {
-                    str(index): byte for index, byte in enumerate(password_bytes)
-                }
-
-                iv_bytes = bytes.fromhex(entry.iv)
-                iv = {str(index): byte for index, byte in enumerate(iv_bytes)}
-
-                files = []
-                for file in entry.files.all():
-                    fileBytes = bytes.fromhex(file.file)
-                    ivBytes = bytes.fromhex(file.iv)
-                    files.append(
-                        {
-                            "name": file.name,
-                            "iv": {
-                                str(index): byte for index, byte in enumerate(ivBytes)
-                            },
-                            "file": {
-                                str(index): byte for index, byte in enumerate(fileBytes)
-                            },
-                            "id": file.id,
-                        }
-                    )
-                response.append(
+            after, limit = ParsePage(request)
+        except ValueError:
+            return Response({"message": "Invalid cursor"}, status=400)
+        try:
+            encoding = ByteEncoding(request)
+            stream = StreamRequested(request)
+            # Read the revision first: anything that lands between the two
+            # queries is reported again by the next sync, never skipped.
+            revision = models.current_revision(request.user)
+            etag = RetrieveETag(request.user, revision, encoding, stream, after, limit)
+            if NotModified(request, etag):
+                response = Response(status=304)
+            elif stream:
+                render = RenderTimer(NDJSONRenderer().render)
+                response = StreamingHttpResponse(
+                    StreamEntries(request.user, encoding, render, after),
+                    content_type=NDJSONRenderer.media_type,
+                )
+                response.render_timer = render
+            elif limit is not None:
+                entries = list(EntryPage(request.user, after, limit))
+                response = Response(
                     {
-                        "name": entry.name,
-                        "username": entry.username,
-                        "password": password,
-                        "iv": iv,
-                        "id": entry.id,
-                        "files": files,
-                    }
+                        "entries": [
+                            SerializeEntry(entry, encoding) for entry in entries
+                        ],
+                        "next": entries[-1].id if len(entries) == limit else None,
+                    },
+                    status=200,
+                )
+            else:
+                response = Response(
+                    [
+                        SerializeEntry(entry, encoding)
+                        for entry in VaultEntries(request.user)
+                    ],
+                    status=200,
                 )
-            return Response(response, status=200)
+            response["X-Vault-Revision"] = revision
+            patch_vary_headers(response, ["Accept"])
+            return CacheHeaders(response, etag)
         except Exception as e:
             return Response({"message": "Failed to retrieve entries"}, status=400)
 
 
+# Returns what changed since the ?since=<revision> cursor: entries written
+# after it (with their current file list), files changed on entries that did
+# not change themselves, and ids deleted since. Without a cursor everything
+# is returned. Clients store "revision" as their next cursor.
+class VaultSync(APIView):
+    authentication_classes = [StatelessJWTAuthentication]
+
+    def get(self, request):
+        try:
+            since = int(request.query_params.get("since", 0))
+        except ValueError:
+            return Response({"message": "Invalid cursor"}, status=400)
+        try:
+            encoding = ByteEncoding(request)
+            revision = models.current_revision(request.user)
+            entries, files, tombstones = SyncChanges(request.user, since)
+            response = Response(
+                SerializeChanges(revision, entries, files, tombstones, encoding),
+                status=200,
+            )
+            patch_vary_headers(response, ["Accept"])
+            return response
+        except Exception as e:
+            logger.error(f"Sync failed: {str(e)}")
+            return Response({"message": "Failed to sync entries"}, status=400)
+
+
 # Extend the default TokenObtainPairSerializer to include 2FA
 class TokenObtainPairSerializerWith2FA(TokenObtainPairSerializer):
     default_error_messages = {
@@ -305,14 +421,14 @@ class TokenObtainPairSerializerWith2FA(TokenObtainPairSerializer):
 
         user = self.user
 
-        recovery = models.RecoverySecret.objects.filter(user=user).exists()
-        if not recovery:
+        # Both relations come with the user from HashingModelBackend
+        if not hasattr(user, "recovery_secret"):
             user.delete()
             raise serializers.ValidationError(
                 self.default_error_messages["no_recovery"]
             )
-        topt = models.TOTPDevice.objects.get(user=user)
-        if not topt.confirmed:
+        device = getattr(user, "totpdevice", None)
+        if device is None or not device.confirmed:
             user.delete()
             raise serializers.ValidationError(self.default_error_messages["no_2fa"])
 
@@ -326,7 +442,7 @@ class TokenObtainPairSerializerWith2FA(TokenObtainPairSerializer):
                 self.default_error_messages["invalid_2fa"]
             )
         # Verify the 2FA token
-        totp = pyotp.TOTP(user.totpdevice.secret)
+        totp = pyotp.TOTP(device.secret)
         if not totp.verify(two_fa_token):
             raise serializers.ValidationError(
                 self.default_error_messages["invalid_2fa"]
@@ -336,104 +452,570 @@ class TokenObtainPairSerializerWith2FA(TokenObtainPairSerializer):
 
 
 class TokenObtainPairViewWith2FA(TokenObtainPairView):
+    throttle_scope = "login"
     serializer_class = TokenObtainPairSerializerWith2FA
 
 
+# Prometheus scrape endpoint for the metrics of every server process, see
+# vault/metrics.py and MetricsMiddleware. A plain Django view so scrapes
+# skip JWT authentication and throttling.
+class Metrics(View):
+    def get(self, request):
+        token = settings.VAULT_METRICS_TOKEN
+        if token:
+            if not constant_time_compare(
+                request.headers.get("Authorization", ""), "Bearer {}".format(token)
+            ):
+                return HttpResponse(status=401)
+        elif not settings.VAULT_METRICS_PUBLIC:
+            return HttpResponse(status=403)
+        return HttpResponse(
+            metrics.exposition(metrics.collect(settings.VAULT_METRICS_DIR)),
+            content_type="text/plain; version=0.0.4; charset=utf-8",
+        )
+
+
 # class VaultImport(APIView):
 #     authentication_classes = [JWTAuthentication]
 
 #     def post(self, request):
 
 
-def ToBytes(input):
-    return bytes([input[str(k)] for k in sorted(input.keys(), key=int)])
+# Binary fields (ciphertexts, IVs, files) travel either as the legacy
+# index-keyed dict produced by JSON.stringify(Uint8Array), e.g. {"0": 12, ...},
+# or as a base64 string. Requests may use either form; responses use the
+# legacy form unless the client asks for base64 with
+# "Accept: application/json; bytes=base64".
+BYTE_ENCODINGS = ("legacy", "base64")
+
+
+def ByteEncoding(request):
+    accepted = getattr(request, "accepted_media_type", None)
+    if accepted is None:
+        # Plain Django requests (the async views) are not content negotiated
+        accepted = next(
+            (
+                media_type
+                for media_type in request.headers.get("Accept", "").split(",")
+                if media_type.strip().startswith(
+                    ("application/json", NDJSONRenderer.media_type)
+                )
+            ),
+            "",
+        )
+    _, params = parse_header_parameters(accepted)
+    encoding = params.get("bytes", "legacy")
+    return encoding if encoding in BYTE_ENCODINGS else "legacy"
+
+
+# If-None-Match uses weak comparison, so W/ prefixes are ignored
+def NotModified(request, etag):
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return False
+    tags = [tag.removeprefix("W/") for tag in parse_etags(header)]
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+
+# Responses are per-user, so shared caches must not store them and browsers
+# must revalidate with the ETag before reusing them.
+def CacheHeaders(response, etag):
+    response["ETag"] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ["Authorization"])
+    return response
+
+
+# File contents are not inlined; clients fetch them from vault/files/<id>.
+def SerializeFile(file, encoding="legacy"):
+    return {
+        "name": file.name,
+        "iv": FromBytes(file.iv, encoding),
+        "size": file.size,
+        "id": file.id,
+    }
+
+
+# Expects entry.files to be prefetched, otherwise each entry costs a query.
+def SerializeEntry(entry, encoding="legacy"):
+    return {
+        "name": entry.name,
+        "username": entry.username,
+        "password": FromBytes(entry.password, encoding),
+        "iv": FromBytes(entry.iv, encoding),
+        "id": entry.id,
+        "files": [SerializeFile(file, encoding) for file in entry.files.all()],
+    }
+
+
+# Entries with their file metadata, as returned by vault/retrieve
+def VaultEntries(user):
+    return models.VaultEntry.objects.filter(user=user).prefetch_related(
+        Prefetch("files", queryset=models.fileEntry.objects.defer("file"))
+    )
+
+
+# ?after=<id>&limit=<n> of vault/retrieve as (after, limit); limit is None
+# when the whole vault is requested. Raises ValueError if either is invalid.
+def ParsePage(request):
+    after = int(request.GET.get("after", 0))
+    if "limit" not in request.GET:
+        return after, None
+    limit = int(request.GET["limit"])
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    return after, min(limit, settings.VAULT_RETRIEVE_PAGE_SIZE)
+
+
+# Keyset pagination: the entries after the one with id `after`, in id order
+def EntryPage(user, after, limit):
+    return VaultEntries(user).filter(id__gt=after).order_by("id")[:limit]
+
+
+def RetrieveETag(user, revision, encoding, stream, after, limit):
+    if stream:
+        variant = "-ndjson-{}".format(after)
+    elif limit is not None:
+        variant = "-{}-{}".format(after, limit)
+    else:
+        variant = ""
+    return 'W/"vault-{}-{}-{}{}"'.format(user.id, revision, encoding, variant)
+
+
+def StreamRequested(request):
+    renderer = getattr(request, "accepted_renderer", None)
+    if renderer is not None:
+        return isinstance(renderer, NDJSONRenderer)
+    return any(
+        media_type.strip().startswith(NDJSONRenderer.media_type)
+        for media_type in request.headers.get("Accept", "").split(",")
+    )
+
+
+# NDJSON lines of every entry, rendered with `render` (a RenderTimer) and
+# fetched a page at a time. Keyset pages rather
+# than one server-side cursor: they work behind PgBouncer (where server-side
+# cursors are disabled and psycopg would buffer the whole result) and no
+# cursor is held open while a slow client reads.
+def StreamEntries(user, encoding, render, after=0):
+    size = settings.VAULT_RETRIEVE_PAGE_SIZE
+    while True:
+        entries = list(EntryPage(user, after, size))
+        for entry in entries:
+            yield render(SerializeEntry(entry, encoding))
+            # Prefetched files point back at their entry. Breaking the cycle
+            # lets each page be freed as soon as it is sent instead of by
+            # the next full garbage collection.
+            entry._prefetched_objects_cache.clear()
+        if len(entries) < size:
+            return
+        after = entries[-1].id
+
+
+# The querysets behind vault/sync, see VaultSync
+def SyncChanges(user, since):
+    entries = VaultEntries(user)
+    files = models.fileEntry.objects.none()
+    tombstones = models.Tombstone.objects.none()
+    if since:
+        entries = entries.filter(revision__gt=since)
+        files = (
+            models.fileEntry.objects.filter(VaultEntry__user=user, revision__gt=since)
+            .exclude(VaultEntry__revision__gt=since)
+            .defer("file")
+        )
+        tombstones = models.Tombstone.objects.filter(user=user, revision__gt=since)
+    return entries, files, tombstones.values_list("kind", "object_id")
+
+
+def SerializeChanges(revision, entries, files, tombstones, encoding="legacy"):
+    deleted = {"entries": [], "files": []}
+    for kind, object_id in tombstones:
+        key = "entries" if kind == models.Tombstone.ENTRY else "files"
+        deleted[key].append(object_id)
+    return {
+        "revision": revision,
+        "entries": [SerializeEntry(entry, encoding) for entry in entries],
+        "files": [
+            dict(SerializeFile(file, encoding), entry=file.VaultEntry_id)
+            for file in files
+        ],
+        "deleted": deleted,
+    }
+
+
+ALLOWED_FILE_TYPES = (".txt", ".csv", ".json", ".pdf", ".zip")
+
+
+# Decoded size of a byte field without decoding it
+def ByteLength(input):
+    if isinstance(input, str):
+        return len(input) * 3 // 4 - input[-2:].count("=")
+    return len(input)
 
 
 class FileAdd(APIView):
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [StatelessJWTAuthentication]
+    parser_classes = [CompressedJSONParser]
 
     def post(self, request):
         try:
             entry = models.VaultEntry.objects.get(id=request.data["id"])
-            file = request.data["file"]
-            fileBytes = ToBytes(file)
             name = request.data["name"]
-            iv = request.data["iv"]
-            ivBytes = ToBytes(iv)
-            if entry.user != request.user:
+            if entry.user_id != request.user.id:
                 return Response({"message": "Unauthorized"}, status=401)
             # check file extension
-            if not name.endswith((".txt", ".csv", ".json", ".pdf", ".zip")):
+            if not name.endswith(ALLOWED_FILE_TYPES):
                 return Response({"message": "Invalid file type"}, status=422)
-            # make sure fize size below 5MB
-            if len(fileBytes) > 5 * 1024 * 1024:
+            # reject oversized files before decoding them
+            if ByteLength(request.data["file"]) > settings.VAULT_MAX_FILE_SIZE:
                 return Response({"message": "Content Too Large"}, status=413)
-            file = models.fileEntry.objects.create(
+            file = models.fileEntry(
                 VaultEntry=entry,
-                file=fileBytes.hex(),
-                name=request.data["name"],
-                iv=ivBytes.hex(),
+                name=name,
+                iv=ToBytes(request.data["iv"]),
+            )
+            data = ToBytes(request.data["file"])
+            with transaction.atomic():
+                file.write(data)
+                file.revision = models.bump_revision(request.user)
+                file.save()
+            return Response({"message": "File uploaded", "id": file.id}, status=200)
+        except compression.DecompressionError:
+            raise
+        except Exception as e:
+            return Response({"message": "Failed to upload file"}, status=400)
+
+
+# Resumable uploads: POST vault/files/uploads with the entry id, name, iv and
+# total size, then PUT the raw encrypted bytes to vault/files/uploads/<id> in
+# order, each request carrying an Upload-Offset header. GET reports the
+# offset to resume from after a dropped connection. Uploads expire
+# VAULT_UPLOAD_TTL seconds after they start, and a user's expired uploads
+# are deleted when they start another one.
+class FileUploadStart(APIView):
+    authentication_classes = [StatelessJWTAuthentication]
+
+    def post(self, request):
+        try:
+            entry = models.VaultEntry.objects.get(id=request.data["id"])
+            if entry.user_id != request.user.id:
+                return Response({"message": "Unauthorized"}, status=401)
+            name = request.data["name"]
+            if not name.endswith(ALLOWED_FILE_TYPES):
+                return Response({"message": "Invalid file type"}, status=422)
+            size = int(request.data["size"])
+            if size <= 0:
+                return Response({"message": "Invalid file size"}, status=400)
+            if size > settings.VAULT_MAX_FILE_SIZE:
+                return Response({"message": "Content Too Large"}, status=413)
+            uploads = models.FileUpload.objects.filter(VaultEntry__user=request.user)
+            uploads.filter(created_at__lt=models.FileUpload.cutoff()).delete()
+            if uploads.count() >= settings.VAULT_MAX_OPEN_UPLOADS:
+                return Response({"message": "Too many open uploads"}, status=429)
+            upload = models.FileUpload.objects.create(
+                VaultEntry=entry,
+                name=name,
+                iv=ToBytes(request.data["iv"]),
+                size=size,
+            )
+            return Response(
+                {
+                    "upload": upload.id,
+                    "offset": 0,
+                    "chunkSize": settings.VAULT_UPLOAD_CHUNK_SIZE,
+                },
+                status=201,
+            )
+        except Exception as e:
+            logger.error(f"Upload creation failed: {str(e)}")
+            return Response({"message": "Failed to start upload"}, status=400)
+
+
+class FileUploadAppend(APIView):
+    authentication_classes = [StatelessJWTAuthentication]
+
+    def get_upload(self, request, id):
+        try:
+            upload = models.FileUpload.objects.select_related("VaultEntry").get(
+                id=id, created_at__gte=models.FileUpload.cutoff()
+            )
+        except models.FileUpload.DoesNotExist:
+            return None, Response({"message": "Upload not found"}, status=404)
+        if upload.VaultEntry.user_id != request.user.id:
+            return None, Response({"message": "Unauthorized"}, status=401)
+        return upload, None
+
+    def get(self, request, id):
+        upload, error = self.get_upload(request, id)
+        if error:
+            return error
+        return Response({"offset": upload.offset, "size": upload.size}, status=200)
+
+    def delete(self, request, id):
+        upload, error = self.get_upload(request, id)
+        if error:
+            return error
+        upload.delete()
+        return Response({"message": "Upload cancelled"}, status=200)
+
+    def put(self, request, id):
+        upload, error = self.get_upload(request, id)
+        if error:
+            return error
+        try:
+            offset = int(request.headers["Upload-Offset"])
+        except (KeyError, ValueError):
+            return Response({"message": "Missing Upload-Offset"}, status=400)
+        if offset != upload.offset:
+            return Response(
+                {"message": "Offset mismatch", "offset": upload.offset}, status=409
             )
-            file.save()
+
+        # Read the body incrementally so an oversized request is cut off as
+        # soon as it crosses the limit instead of after it has been buffered.
+        limit = min(upload.size - offset, settings.VAULT_UPLOAD_CHUNK_SIZE)
+        data = bytearray()
+        stream = request.stream
+        while stream is not None:
+            piece = stream.read(64 * 1024)
+            if not piece:
+                break
+            data += piece
+            if len(data) > limit:
+                return Response({"message": "Content Too Large"}, status=413)
+        if not data:
+            return Response({"message": "Empty chunk"}, status=400)
+
+        try:
+            with transaction.atomic():
+                upload = models.FileUpload.objects.select_for_update().get(id=id)
+                if offset != upload.offset:
+                    return Response(
+                        {"message": "Offset mismatch", "offset": upload.offset},
+                        status=409,
+                    )
+                models.FileUploadPart.objects.create(
+                    upload=upload, offset=offset, data=bytes(data)
+                )
+                upload.offset = offset + len(data)
+                if upload.offset < upload.size:
+                    upload.save(update_fields=["offset"])
+                    return Response({"offset": upload.offset}, status=200)
+
+                file = models.fileEntry(
+                    VaultEntry_id=upload.VaultEntry_id,
+                    name=upload.name,
+                    iv=upload.iv,
+                )
+                file.write(
+                    b"".join(
+                        part.data
+                        for part in upload.parts.only("data").iterator(chunk_size=16)
+                    )
+                )
+                file.revision = models.bump_revision(request.user)
+                file.save()
+                upload.delete()
             return Response({"message": "File uploaded", "id": file.id}, status=200)
         except Exception as e:
+            logger.error(f"Upload failed: {str(e)}")
             return Response({"message": "Failed to upload file"}, status=400)
 
 
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+# Parses a single "bytes=start-end" range into inclusive offsets. Returns None
+# when the whole file should be sent (no header, other units, multiple ranges
+# or malformed values, which RFC 9110 says to ignore).
+def ParseRange(header, size):
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start, sep, end = header[len("bytes=") :].strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if not start:
+            length = int(end)
+            if length <= 0 or size == 0:
+                raise RangeNotSatisfiable()
+            return max(size - length, 0), size - 1
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable()
+    if start < 0 or end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+class FileDownload(APIView):
+    authentication_classes = [StatelessJWTAuthentication]
+
+    def get(self, request, id):
+        try:
+            file = models.fileEntry.objects.select_related("VaultEntry").get(id=id)
+        except models.fileEntry.DoesNotExist:
+            return Response({"message": "File not found"}, status=404)
+        if file.VaultEntry.user_id != request.user.id:
+            return Response({"message": "Unauthorized"}, status=401)
+
+        try:
+            return StreamFile(request, file)
+        except RangeNotSatisfiable:
+            response = Response({"message": "Range Not Satisfiable"}, status=416)
+            response["Content-Range"] = "bytes */{}".format(file.size)
+            return response
+
+
 class FileDelete(APIView):
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [StatelessJWTAuthentication]
 
     def post(self, request):
         try:
-            file = models.fileEntry.objects.get(id=request.data["id"])
-            if file.VaultEntry.user != request.user:
+            file = (
+                models.fileEntry.objects.select_related("VaultEntry")
+                .defer("file")
+                .get(id=request.data["id"])
+            )
+            if file.VaultEntry.user_id != request.user.id:
                 return Response({"message": "Unauthorized"}, status=401)
-            file.delete()
+            with transaction.atomic():
+                models.Tombstone.objects.create(
+                    user=request.user,
+                    kind=models.Tombstone.FILE,
+                    object_id=file.id,
+                    revision=models.bump_revision(request.user),
+                )
+                file.delete()
+            models.release_blobs([file.blob])
             return Response({"message": "File deleted"}, status=200)
         except Exception as e:
             return Response({"message": "Failed to delete file"}, status=400)
 
 
+# Used by the client to re-encrypt the whole vault under a new key, so it is
+# all or nothing: ownership of every entry and file is checked up front in
+# two queries, and the rows are rewritten with bulk_update in one
+# transaction. Any error leaves the vault untouched.
 class VaultEditBatch(APIView):
-    authentication_classes = [JWTAuthentication]
+    authentication_classes = [StatelessJWTAuthentication]
+    parser_classes = [CompressedJSONParser]
 
     def post(self, request):
+        new_blobs = []
         try:
-            entries = request.data["entries"]
-            errors = []
-            for editedEntry in entries:
-                try:
-                    entry = models.VaultEntry.objects.get(id=editedEntry["id"])
-                    if entry.user != request.user:
-                        errors.append(
-                            {
-                                "id": editedEntry["id"],
-                                "message": "Unauthorized",
-                            }
-                        )
-                        continue
-                    password_bytes = ToBytes(editedEntry["password"])
-                    iv_bytes = ToBytes(editedEntry["iv"])
-                    entry.name = editedEntry["name"]
-                    entry.username = editedEntry["username"]
-                    entry.password = password_bytes.hex()
-                    entry.iv = iv_bytes.hex()
-                    entry.save()
-
-                    for file in editedEntry["files"]:
-                        db_file = models.fileEntry.objects.get(id=file["id"])
-                        db_file.file = ToBytes(file["file"]).hex()
-                        db_file.name = file["name"]
-                        db_file.iv = ToBytes(file["iv"]).hex()
-                        db_file.save()
-
-                except Exception as e:
-                    errors.append({"id": entry["id"], "message": str(e)})
-            if len(errors) > 0:
+            edits = request.data["entries"]
+            file_edits = {
+                file["id"]: file for edit in edits for file in edit.get("files", [])
+            }
+            entry_ids = [edit["id"] for edit in edits]
+            owned_entries = set(
+                models.VaultEntry.objects.filter(
+                    user=request.user, id__in=entry_ids
+                ).values_list("id", flat=True)
+            )
+            old_blobs = dict(
+                models.fileEntry.objects.filter(
+                    VaultEntry__user=request.user, id__in=list(file_edits)
+                ).values_list("id", "blob")
+            )
+            errors = [
+                {"id": id, "message": "Unauthorized"}
+                for id in entry_ids
+                if id not in owned_entries
+            ] + [
+                {"id": id, "message": "Unauthorized"}
+                for id in file_edits
+                if id not in old_blobs
+            ]
+            if errors:
                 return Response(
                     {"message": "Failed to edit entries", "errors": errors}, status=400
                 )
+
+            now = timezone.now()
+            entries = [
+                models.VaultEntry(
+                    id=edit["id"],
+                    name=edit["name"],
+                    username=edit["username"],
+                    password=ToBytes(edit["password"]),
+                    iv=ToBytes(edit["iv"]),
+                    updated_at=now,
+                )
+                for edit in edits
+            ]
+            files, contents = [], []
+            for id, edit in file_edits.items():
+                files.append(
+                    models.fileEntry(
+                        id=id, name=edit["name"], iv=ToBytes(edit["iv"]), updated_at=now
+                    )
+                )
+                contents.append(ToBytes(edit["file"]))
+
+            with transaction.atomic():
+                # Blobs are written before the revision is taken, so other
+                # writes of the user are not held up by the uploads
+                for file, data in zip(files, contents):
+                    file.write(data)
+                    new_blobs.append(file.blob)
+                revision = models.bump_revision(request.user)
+                for row in entries + files:
+                    row.revision = revision
+                models.VaultEntry.objects.bulk_update(
+                    entries,
+                    ["name", "username", "password", "iv", "revision", "updated_at"],
+                    batch_size=settings.VAULT_BATCH_CHUNK_SIZE,
+                )
+                # Each row can carry megabytes of ciphertext, so keep the
+                # UPDATE statements small.
+                models.fileEntry.objects.bulk_update(
+                    files,
+                    ["file", "blob", "size", "name", "iv", "revision", "updated_at"],
+                    batch_size=10,
+                )
+            models.release_blobs(old_blobs.values())
             return Response({"message": "Success"}, status=200)
+        except compression.DecompressionError:
+            raise
         except Exception as e:
+            # Blobs written to external storage for a failed batch are not
+            # referenced by any row once it has rolled back; release drops
+            # them immediately.
+            models.release_blobs(new_blobs)
             logger.error(f"Failed to edit entries: {str(e)}")
             return Response({"message": "Failed to edit entries"}, status=400)
+
+
+# Streams file (or the requested Range of it) to the client. wrap lets the
+# async download view adapt the chunk iterator. Raises RangeNotSatisfiable.
+def StreamFile(request, file, wrap=iter):
+    size = file.size
+    byte_range = ParseRange(request.headers.get("Range"), size)
+    start, end = byte_range or (0, size - 1)
+    response = StreamingHttpResponse(
+        wrap(file.iter_chunks(start, end + 1)),
+        status=206 if byte_range else 200,
+        content_type="application/octet-stream",
+    )
+    response["Content-Length"] = end + 1 - start
+    response["Accept-Ranges"] = "bytes"
+    if byte_range:
+        response["Content-Range"] = "bytes {}-{}/{}".format(start, end, size)
+    return response
+
+
+# Whether an IntegrityError is a second entry of the same name for a user,
+# rather than some other constraint (a foreign key to a deleted account)
+def DuplicateName(error):
+    diag = getattr(error.__cause__, "diag", None)
+    if diag is not None:
+        return diag.constraint_name == "vault_entry_unique_user_name"
+    # SQLite reports the columns instead of the constraint name
+    return "vault_vaultentry.user_id, vault_vaultentry.name" in str(error)
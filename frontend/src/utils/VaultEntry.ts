@@ -86,6 +86,24 @@ async function AddFile(
   return res.json();
 }
 
+async function DownloadFile(id: number): Promise<Uint8Array> {
+  const response: any = await fetch(`${serverURL}/api/vault/files/${id}`, {
+    method: "GET",
+    headers: {
+      Authorization: `Bearer ${cookies.get("access_token")}`,
+    },
+  });
+  if (response.status === 401) {
+    const refresh = await RefreshToken();
+    if (refresh.error) {
+      return DownloadFile(id);
+    } else {
+      alert("Log in again");
+    }
+  }
+  return new Uint8Array(await response.arrayBuffer());
+}
+
 async function DeleteFile(id: number) {
   const response: any = await fetch(`${serverURL}/api/vault/files/delete`, {
     method: "POST",
@@ -182,4 +200,13 @@ async function Retrieve() {
   }
   return response.json();
 }
-export { Add, AddBatch, Edit, Delete, Retrieve, AddFile, DeleteFile };
+export {
+  Add,
+  AddBatch,
+  Edit,
+  Delete,
+  Retrieve,
+  AddFile,
+  DownloadFile,
+  DeleteFile,
+};